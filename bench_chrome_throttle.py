@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""Benchmark chrome_throttle on fake /proc trees of several sizes.
+
+Discovery and sampling run against a FakeProcTree written to tmpfs,
+so the numbers include the real open/read/listdir system calls.
+Signalling needs real processes and uses children running sleep.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, '.')
+from chrome_utils import chrome_throttle
+from chrome_utils.chrome_throttle import get_chromium_renderers, \
+     RendererCache, RendererTreeCache, CpuSampler, SignalThrottle, \
+     PidfdSignaller, JIFFIES_PER_SECOND
+from chrome_utils.test.proc_fixture import FakeProcTree
+
+
+def parse_scales(text):
+    """Parse "procs:renderers,..." into a list of (procs, renderers)."""
+
+    scales = []
+    for item in text.split(','):
+        n_procs, n_renderers = item.split(':')
+        scales.append((int(n_procs), int(n_renderers)))
+    return scales
+
+def timed(fn, repeat):
+    """Return the mean seconds taken by FN over REPEAT calls."""
+
+    t0 = time.time()
+    for i in range(repeat):
+        fn()
+    return (time.time() - t0) / repeat
+
+def bench_discovery(repeat):
+    print("discovery")
+    print("  %-10s %12s %12s" % ("mode", "ms/scan", "files/scan"))
+    elapsed = timed(get_chromium_renderers, repeat)
+    print("  %-10s %12.3f %12s" % ("uncached", elapsed*1000, "-"))
+    for name, cache in [("sweep", RendererCache()),
+                        ("tree", RendererTreeCache())]:
+        get_chromium_renderers(cache)     # first scan classifies everything
+        cost = cache.scan_cost
+        elapsed = timed(lambda: get_chromium_renderers(cache), repeat)
+        print("  %-10s %12.3f %12.1f" % (name, elapsed*1000,
+              (cache.scan_cost - cost) / float(repeat)))
+
+def bench_sampling(tree, repeat):
+    pids = tree.renderers()
+    print("sampling %d renderers" % len(pids))
+    print("  %-10s %12s %12s" % ("clock", "ms/open", "ms/sample"))
+    for clock in ("schedstat", "stat"):
+        sampler = CpuSampler(clock)
+        t0 = time.time()
+        sampler.sample(pids)
+        opened = time.time() - t0
+        elapsed = 0.0
+        for i in range(repeat):
+            tree.advance(0.1)
+            t0 = time.time()
+            sampler.sample(pids)
+            elapsed += (time.time() - t0) / repeat
+        sampler.close()
+        print("  %-10s %12.3f %12.3f" % (clock, opened*1000, elapsed*1000))
+
+def bench_signalling(n_children, repeat):
+    children = [subprocess.Popen(["sleep", "600"]) for i in range(n_children)]
+    pids = [child.pid for child in children]
+    print("signalling %d processes" % n_children)
+    print("  %-10s %12s" % ("method", "ms/stop+cont"))
+    try:
+        throttle = SignalThrottle()
+        def cycle():
+            throttle.disable_many(pids)
+            throttle.enable_many(pids)
+        print("  %-10s %12.3f" % ("kill", timed(cycle, repeat)*1000))
+        signaller = PidfdSignaller()
+        t0 = time.time()
+        signaller.open(pids)
+        opened = time.time() - t0
+        throttle = SignalThrottle(signaller=signaller)
+        print("  %-10s %12.3f  (open %.3f ms)" %
+              ("pidfd", timed(cycle, repeat)*1000, opened*1000))
+        signaller.close()
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+op = OptionParser()
+op.add_option("--scales",
+              action="store", dest="scales", default="1000:40,10000:300",
+              help="Comma separated list of processes:renderers sizes of"
+                   " fake /proc trees to benchmark.")
+op.add_option("--repeat",
+              action="store", dest="repeat", type="int", default=20,
+              help="Number of times to repeat each timed operation.")
+op.add_option("--signal-procs",
+              action="store", dest="signal_procs", type="int", default=100,
+              help="Largest number of real processes to signal.")
+(opts, args) = op.parse_args()
+
+for n_procs, n_renderers in parse_scales(opts.scales):
+    print("== %d processes, %d renderers, %d repeats" %
+          (n_procs, n_renderers, opts.repeat))
+    t0 = time.time()
+    tree = FakeProcTree(n_procs, n_renderers, hz=JIFFIES_PER_SECOND)
+    print("built %s in %.1f s" % (tree.root, time.time() - t0))
+    chrome_throttle.PROC_ROOT = tree.root
+    try:
+        bench_discovery(opts.repeat)
+        bench_sampling(tree, opts.repeat)
+    finally:
+        chrome_throttle.PROC_ROOT = "/proc"
+        tree.cleanup()
+    bench_signalling(min(n_renderers, opts.signal_procs), opts.repeat)
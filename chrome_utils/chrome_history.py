@@ -10,6 +10,8 @@ import os
 import stat
 import re
 import operator
+import io
+import itertools
 from chrome_lib import *
 import sqlite3
 
@@ -20,7 +22,7 @@ sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
 
 
 op = OptionParser()
-op.usage = "%prog [options] <history_file>"
+op.usage = "%prog [options] <history_file> [<history_file> ...]"
 op.add_option("--after", "-A",
               action="store", type="string", dest="after_time",
               help="Restrict visit times to after AFTER_TIME.")
@@ -42,6 +44,50 @@ op.add_option("--order-by",
                    "to sort in descending order (You may need to quote the"
                    " entire string for the shell).  More than one sort"
                    " field may be used by delimiting them with commas (,).")
+op.add_option("--limit",
+              action="store", type="int", dest="limit",
+              help="Report at most LIMIT visits.")
+op.add_option("--offset",
+              action="store", type="int", dest="offset", default=0,
+              help="Skip the first OFFSET visits.")
+op.add_option("--batch-size",
+              action="store", type="int", dest="batch_size", default=1000,
+              help="Number of rows to read from the database at a time.")
+op.add_option("--snapshot",
+              action="store_true", dest="snapshot", default=False,
+              help="Query an in-memory copy of the history file, so that"
+                   " the browser may keep running.")
+op.add_option("--snapshot-file",
+              action="store", type="string", dest="snapshot_file",
+              help="Like --snapshot, but copy the history file to"
+                   " SNAPSHOT_FILE (on tmpfs, say) instead of memory.")
+op.add_option("--since-state",
+              action="store", type="string", dest="since_state",
+              help="Only report visits added since the last run with the"
+                   " same SINCE_STATE file, and record the newest visit"
+                   " reported in it.")
+op.add_option("--no-cache",
+              action="store_false", dest="use_cache", default=True,
+              help="Neither use nor store cached query results.")
+op.add_option("--cache-dir",
+              action="store", type="string", dest="cache_dir",
+              default=default_cache_dir(),
+              help="Directory for cached query results"
+                   " (default %default).")
+op.add_option("--cache-size",
+              action="store", type="int", dest="cache_size", default=64,
+              help="Size in MiB that cached results may take up"
+                   " (default %default).")
+op.add_option("--format",
+              action="store", type="choice", dest="format",
+              choices=OUTPUT_FORMATS, default="space",
+              help="Output format: "+", ".join(OUTPUT_FORMATS)+"."
+                   "  csv and tsv start with a header line.")
+op.add_option("--stats",
+              action="store", type="choice", dest="stats",
+              choices=sorted(STATS_REPORTS),
+              help="Report the number of visits per group instead of the"
+                   " visits: "+", ".join(sorted(STATS_REPORTS))+".")
 op.add_option("--show-visit-id",
               action="store_true", dest="show_visit_id", default=False,
               help="Show the visit ID.")
@@ -74,6 +120,33 @@ Examine URL visit history for the Chromium browser.
 
 BEFORE_TIME and AFTER_TIME are specified as decimal digit strings of
 format  YYYY[MM[DD[HH[MM[SS]]]]]
+
+With --snapshot or --snapshot-file the history file is copied
+read-only with the SQLite backup API before it is queried, so it
+may be used while the browser is running.  With several history files
+SNAPSHOT_FILE.0, SNAPSHOT_FILE.1 and so on are used, one per file.
+
+With --since-state only visits with a visits.id above the one recorded
+in SINCE_STATE for the history file are reported, in visits.id order
+unless --order-by is given, and without a csv or tsv header line after
+the first run; the output can then be appended to an earlier export.
+
+Several history files may be given.  They are queried at the same time,
+one thread each, and their visits merged in the --order-by order.
+
+Query results are cached in CACHE_DIR, keyed by the query and the
+inode, size and modification time of the history file, so a repeated
+query of an unchanged file is answered without opening it.  Results
+larger than CACHE_SIZE, and those of --since-state, are not cached.
+
+With --stats the visits are counted per host (URL scheme, host and
+port, as --show-urlbase), per day, per hour of the week or per page
+title, in UTC, by the database itself.  Hosts and titles are listed
+with the most visited first; --limit and --offset select from the
+list.
+
+Visits are read from the database in batches of BATCH_SIZE rows and
+printed as they arrive; --limit and --offset are applied by the query.
 """
 
 (opts, args) = op.parse_args()
@@ -81,13 +154,31 @@ if len(args) < 1:
     print("Path to history file not specified.", file=sys.stderr)
     sys.exit(3)
 
-fname = args[0]
+if opts.limit is not None and opts.limit < 0:
+    op.error("--limit must not be negative.")
+if opts.offset < 0:
+    op.error("--offset must not be negative.")
+if opts.batch_size < 1:
+    op.error("--batch-size must be at least 1.")
+
+fnames = args
 filters = []
 if opts.order_by:
     orderings = opts.order_by.split(',')
+elif opts.since_state:
+    orderings = ["visits.id"]
 else:
     orderings = ["last_visit_time desc"]
 
+if opts.since_state and opts.limit is not None:
+    if orderings != ["visits.id"]:
+        op.error("--since-state with --limit needs --order-by visits.id.")
+    if len(fnames) > 1:
+        op.error("--since-state with --limit needs a single history file.")
+
+if opts.stats and (opts.since_state or opts.order_by):
+    op.error("--stats cannot be used with --since-state or --order-by.")
+
 if opts.use_last:
     restrict_var = "last_visit_time"
 else:
@@ -100,56 +191,107 @@ if opts.before_time:
     ts = CrTimeStamp.parse_tstamp(opts.before_time)
     filters.append("%s<%d" % (restrict_var, ts))
 
-if not os.access(fname, os.R_OK):
-    print("Cannot open file "+fname, file=sys.stderr)
-    sys.exit(5)
+for fname in fnames:
+    if not os.access(fname, os.R_OK):
+        print("Cannot open file "+fname, file=sys.stderr)
+        sys.exit(5)
 
-url_scheme_netloc = re.compile("^(\S+?://[^/]*/).*$")
+states = []
+if opts.since_state:
+    try:
+        states = [SinceState(opts.since_state, fname) for fname in fnames]
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(8)
 
-opts_d = opts.__dict__
-show_specific_items = any([opts_d[k] for k in opts_d if k.startswith("show_")])
+if opts.snapshot_file:
+    snapshot = opts.snapshot_file
+elif opts.snapshot:
+    snapshot = ":memory:"
+else:
+    snapshot = None
+snapshots = snapshot_targets(snapshot, len(fnames))
 
-crh = CrHistory(fname)
+sys.stdout.flush()
+out = io.open(sys.stdout.fileno(), "w", encoding="utf-8",
+              buffering=1 << 20, closefd=False)
 
-try:
-    out = codecs.getwriter('utf-8')(sys.stdout.buffer)
-except AttributeError:
-    out = codecs.getwriter('utf-8')(sys.stdout)
+if opts.stats:
+    try:
+        rows = visit_stats_of_files(fnames, opts.stats, filters, snapshot)
+    except sqlite3.OperationalError as e:
+        print("Error (%s) accessing %s as sqlite database." %
+              (e, ' '.join(fnames)), file=sys.stderr)
+        sys.exit(6)
+    rows = rows[opts.offset:]
+    if opts.limit is not None:
+        rows = rows[:opts.limit]
+    out.writelines(format_stats(opts.stats, rows, opts.format))
+    out.flush()
+    sys.exit(0)
+
+opts_d = opts.__dict__
+columns = [c[0] for c in HISTORY_COLUMNS if opts_d["show_"+c[0]]]
+format_visit = make_row_formatter(columns, opts.format, opts.report_raw_times)
+
+# with several files each is queried in a thread of its own for the
+# rows that could be among the first LIMIT+OFFSET, and the results
+# are merged in order
+multi = len(fnames) > 1
+if multi and opts.limit is not None:
+    file_limit = opts.limit + opts.offset
+else:
+    file_limit = opts.limit
+file_offset = 0 if multi else opts.offset
 
-def my_print_sp(s, end=' '):
-    print(s, end=end, file=out)
+# under --since-state the cache key includes the moving mark, so a
+# stored result would never be asked for again
+use_cache = opts.use_cache and not states
 
 try:
-    visits = crh.geturl_visits(filters, orderings)
-    for visit in visits:
-        if show_specific_items:
-            if opts.show_visit_id:
-                my_print_sp(visit[0])
-            if opts.show_url_id:
-                my_print_sp(visit[1])
-            if opts.show_visit_time:
-                if opts.report_raw_times:
-                    my_print_sp(visit[2])
-                else:
-                    my_print_sp(CrTimeStamp.fmt_tstamp(visit[2]))
-            if opts.show_url:
-                my_print_sp(visit[4])
-            if opts.show_urlbase:
-                my_print_sp(url_scheme_netloc.match(visit[4]).group(1))
-            if opts.show_title:
-                my_print_sp(visit[5])
-            if opts.show_visit_count:
-                my_print_sp(visit[6])
-            if opts.show_last_visit_time:
-                if opts.report_raw_times:
-                    my_print_sp(visit[8])
-                else:
-                    my_print_sp(CrTimeStamp.fmt_tstamp(visit[8]))
-            my_print_sp('', end="\n")
-        else:
-            my_print_sp(visit)
+    streams = []
+    for i, fname in enumerate(fnames):
+        file_filters = filters + (states[i].filters() if states else [])
+        visits = None
+        if use_cache:
+            cache = ResultCache(opts.cache_dir, opts.cache_size << 20,
+                                opts.batch_size)
+            key = cache.key(fname, file_filters, orderings, file_limit,
+                            file_offset)
+            visits = cache.get(key)
+        if visits is None:
+            if multi:
+                visits = iter_visits_in_thread(fname, file_filters, orderings,
+                                               file_limit, opts.batch_size,
+                                               snapshots[i])
+            else:
+                crh = CrHistory(fname, snapshots[i])
+                visits = crh.iter_url_visits(file_filters, orderings,
+                                             file_limit, file_offset,
+                                             opts.batch_size)
+            if use_cache:
+                visits = cache.put(key, visits)
+        if states:
+            visits = states[i].track(visits)
+        streams.append(visits)
+    if multi:
+        visits = merge_visits(streams, orderings)
+        if opts.limit is not None or opts.offset:
+            visits = itertools.islice(visits, opts.offset,
+                                      None if opts.limit is None else
+                                      opts.offset + opts.limit)
+    else:
+        visits = streams[0]
+    if all(state.mark is None for state in states):
+        out.write(format_header(columns, opts.format))
+    out.writelines(map(format_visit, visits))
+    out.flush()
+    for state in states:
+        state.save()
 except sqlite3.OperationalError as e:
-    print("Error (%s) accessing %s as sqlite database." % (e, fname), file=sys.stderr)
+    out.flush()
+    print("Error (%s) accessing %s as sqlite database." % (e, ' '.join(fnames)),
+          file=sys.stderr)
     sys.exit(6)
 except OrderSpecificationError as e:
     print(e, file=sys.stderr)
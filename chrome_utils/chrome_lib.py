@@ -4,17 +4,115 @@
 
 import datetime
 import sqlite3
-from six import advance_iterator
+import re
+import json
+import os
+import marshal
+import struct
+import hashlib
+import heapq
+import itertools
+import threading
+from six import advance_iterator, integer_types
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 class OrderSpecificationError(Exception):
     pass
 
+def snapshot_history(fname, target=":memory:", pages=256, pause=0.005,
+                     timeout=1.0):
+    """Copy the history database FNAME to TARGET; return a connection to it.
+
+    TARGET is ":memory:" or the name of a file, best on tmpfs.  FNAME
+    is opened read-only and copied PAGES pages at a time with the
+    SQLite online backup API, which sleeps PAUSE seconds whenever the
+    browser is writing to it.
+
+    A running Chromium keeps its History file locked.  If FNAME cannot
+    be read within TIMEOUT seconds it is opened as immutable instead,
+    which ignores the lock; changes the browser has not yet written to
+    the file are then missing from the copy.
+    """
+
+    uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(fname))
+    src = sqlite3.connect(uri, uri=True, timeout=timeout)
+    try:
+        try:
+            src.execute("select count(*) from sqlite_master").fetchone()
+        except sqlite3.OperationalError:
+            src.close()
+            src = sqlite3.connect(uri + "&immutable=1", uri=True)
+        dst = sqlite3.connect(target)
+        src.backup(dst, pages=pages, sleep=pause)
+    finally:
+        src.close()
+    return dst
+
+# seconds from the Chromium epoch (1601) to the Unix epoch (1970)
+UNIX_EPOCH_OFFSET = 11644473600
+
+WEEKDAYS = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+
+def _sql_url_base(url):
+    """Return an SQL expression for url_base() of the column URL."""
+
+    start = "instr(%s, '://')" % url
+    slash = "instr(substr(%s, %s + 3), '/')" % (url, start)
+    return ("case when %s = 0 or %s = 0 then %s"
+            " else substr(%s, 1, %s + 2 + %s) end" %
+            (start, slash, url, url, start, slash))
+
+def _sql_visit_time(fmt):
+    """Return an SQL expression formatting the visit time with FMT (UTC)."""
+
+    return "strftime('%s', visit_time/1000000 - %d, 'unixepoch')" % \
+           (fmt, UNIX_EPOCH_OFFSET)
+
+# report -> (SQL expression grouped on, SQL order of the groups)
+STATS_REPORTS = {
+    "host": (_sql_url_base("urls.url"), "visits desc, 1"),
+    "day": (_sql_visit_time("%Y%m%d"), "1"),
+    "hour-of-week": ("substr('%s', 1 + 3*%s, 3) || %s" %
+                     (''.join(WEEKDAYS), _sql_visit_time("%w"),
+                      _sql_visit_time(" %H")),
+                     "min(%s)" % _sql_visit_time("%w%H")),
+    "title": ("title", "visits desc, 1"),
+}
+
+def snapshot_targets(target, n):
+    """Return the snapshot targets for N history files copied to TARGET.
+
+    Each ":memory:" database is separate, but a file can hold only one
+    copy, so with more than one history file the copies go to TARGET.0,
+    TARGET.1 and so on.
+    """
+
+    if target is None or target == ":memory:" or n == 1:
+        return [target] * n
+    return ["%s.%d" % (target, i) for i in range(n)]
+
 class CrHistory(object):
-    """Mapping to Chromium browser history."""
+    """Mapping to Chromium browser history.
+
+    If SNAPSHOT is given, the history is first copied there with
+    snapshot_history() and all queries run against the copy.
+    """
 
-    def __init__(self, fname):
+    def __init__(self, fname, snapshot=None):
         self.fname = fname
-        self.conn = sqlite3.connect(fname)
+        if snapshot is None:
+            self.conn = sqlite3.connect(fname)
+        else:
+            self.conn = snapshot_history(fname, snapshot)
 
     FIELDS = [
         "visits.id", "visits.url", "visit_time", "from_visit",
@@ -37,16 +135,450 @@ class CrHistory(object):
             else:
                 raise OrderSpecificationError("empty sort order field")
 
-    def geturl_visits(self, filters, orderings):
-        cur = self.conn.cursor()
+    def _visits_stmt(self, filters, orderings, limit=None, offset=None):
+        """Return the SQL statement and its parameters for a visits query."""
+
         selections = ','.join(CrHistory.FIELDS)
         stmt = "select "+selections+" from visits, urls on visits.url=urls.id"
+        params = []
         if filters:
             stmt += " where " + " and ".join(filters)
         if orderings:
             self._vfy_orderings(orderings)
             stmt += " order by " + ",".join(orderings)
-        return cur.execute(stmt).fetchall()
+        if limit is not None or offset:
+            # sqlite needs a limit for an offset; -1 means no limit
+            stmt += " limit ?"
+            params.append(-1 if limit is None else limit)
+            if offset:
+                stmt += " offset ?"
+                params.append(offset)
+        return stmt, params
+
+    def geturl_visits(self, filters, orderings):
+        cur = self.conn.cursor()
+        stmt, params = self._visits_stmt(filters, orderings)
+        return cur.execute(stmt, params).fetchall()
+
+    def iter_url_visits(self, filters, orderings, limit=None, offset=None,
+                        batch_size=1000):
+        """Return an iterator over the visits, as geturl_visits().
+
+        Rows are fetched BATCH_SIZE at a time, so memory use does not
+        grow with the size of the history.  LIMIT and OFFSET are
+        applied by the database.  Errors in the query are raised here
+        rather than on the first row.
+        """
+
+        cur = self.conn.cursor()
+        stmt, params = self._visits_stmt(filters, orderings, limit, offset)
+        cur.execute(stmt, params)
+        return self._fetch_batches(cur, batch_size)
+
+    def visit_stats(self, report, filters):
+        """Return the number of visits in each group of REPORT.
+
+        REPORT is one of STATS_REPORTS.  The grouping and counting
+        are done by SQLite, so only the (group, visits) rows reach
+        Python, in the order of the report.
+        """
+
+        group, order = STATS_REPORTS[report]
+        stmt = "select %s, count(*) as visits" \
+               " from visits, urls on visits.url=urls.id" % group
+        if filters:
+            stmt += " where " + " and ".join(filters)
+        stmt += " group by 1 order by " + order
+        return self.conn.execute(stmt).fetchall()
+
+    @staticmethod
+    def _fetch_batches(cur, batch_size):
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
+def default_cache_dir():
+    """Return the directory for cached query results."""
+
+    base = os.environ.get("XDG_CACHE_HOME") or \
+           os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "chrome_utils")
+
+class ResultCache(object):
+    """On-disk cache of history query results.
+
+    Results are keyed by the inode, size and modification time of the
+    history file (and of its write-ahead log, if any) together with
+    the query, so a cached result is only used while the file is
+    unchanged.  Each result is a file in DIRNAME of length-prefixed
+    marshalled batches of rows, read back one batch at a time.  A
+    result larger than MAX_BYTES is not stored; when the files take
+    more than MAX_BYTES, the least recently used are removed.
+    """
+
+    SUFFIX = ".rows"
+
+    def __init__(self, dirname=None, max_bytes=64 << 20, batch_size=1000):
+        self.dirname = dirname or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+
+    @staticmethod
+    def fingerprint(fname):
+        r = []
+        for name in (fname, fname + "-wal"):
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            r.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime))
+        return r
+
+    def key(self, fname, filters, orderings, limit=None, offset=None):
+        """Return the cache key of a query of history file FNAME."""
+
+        def norm(s):
+            return ' '.join(s.lower().split())
+
+        query = (os.path.abspath(fname), self.fingerprint(fname),
+                 sorted(norm(f) for f in filters),
+                 [norm(o) for o in orderings], limit, offset or 0,
+                 marshal.version)
+        return hashlib.sha1(repr(query).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, key + ResultCache.SUFFIX)
+
+    def get(self, key):
+        """Return an iterator over the cached rows of KEY, or None."""
+
+        try:
+            f = open(self.path(key), "rb")
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(self.path(key), None)     # most recently used
+        except OSError:
+            pass
+        return self._read_batches(f)
+
+    @staticmethod
+    def _read_batches(f):
+        try:
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                # marshal.load() on a file is slow; loads() of a frame is not
+                batch = marshal.loads(f.read(struct.unpack("<I", header)[0]))
+                for row in batch:
+                    yield row
+        finally:
+            f.close()
+
+    def put(self, key, rows):
+        """Return an iterator over ROWS that also stores them under KEY.
+
+        The result is only stored once ROWS has been read to the end,
+        and not at all if the cache directory cannot be written.  It
+        stops being written as soon as it grows past max_bytes.
+        """
+
+        tmp = "%s.%d.tmp" % (self.path(key), os.getpid())
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            f = open(tmp, "wb")
+        except (IOError, OSError):
+            return iter(rows)     # no cache rather than no result
+        return self._write_batches(key, rows, f, tmp)
+
+    def _write_batches(self, key, rows, f, tmp):
+        done = False
+        written = 0
+        rows = iter(rows)
+        try:
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                if f is not None:
+                    written += self._write_frame(f, batch)
+                    if written > self.max_bytes:
+                        # too big to keep: stop writing it
+                        f.close()
+                        os.remove(tmp)
+                        f = None
+                for row in batch:
+                    yield row
+            if f is not None:
+                f.close()
+                os.rename(tmp, self.path(key))
+            done = True
+        finally:
+            if not done and f is not None:
+                f.close()
+                os.remove(tmp)
+        if f is not None:
+            self.evict()
+
+    @staticmethod
+    def _write_frame(f, batch):
+        data = marshal.dumps(batch)
+        f.write(struct.pack("<I", len(data)))
+        f.write(data)
+        return 4 + len(data)
+
+    def evict(self):
+        """Remove the least recently used results beyond max_bytes."""
+
+        entries = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith(ResultCache.SUFFIX):
+                continue
+            path = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class SinceState(object):
+    """High-water mark of the visits exported from a history file.
+
+    STATE_FILE holds a JSON object that maps the absolute path of each
+    history file to the highest visits.id exported from it, so one
+    state file can serve several history files.  visits.id only ever
+    grows, so filters() selects just the visits added since the last
+    export, as a range on the primary key.
+    """
+
+    def __init__(self, state_file, history):
+        self.state_file = state_file
+        self.history = os.path.abspath(history)
+        self.mark = self.load().get(self.history)
+        self.highest = self.mark
+
+    def load(self):
+        try:
+            with open(self.state_file) as f:
+                marks = json.load(f)
+        except (IOError, OSError):
+            return {}           # first export
+        if not isinstance(marks, dict):
+            raise ValueError("bad state file " + self.state_file)
+        for history, mark in marks.items():
+            if not isinstance(mark, integer_types) or isinstance(mark, bool):
+                raise ValueError("bad visit ID %r for %s in state file %s" %
+                                 (mark, history, self.state_file))
+        return marks
+
+    def filters(self):
+        if self.mark is None:
+            return []
+        return ["visits.id>%d" % self.mark]
+
+    def track(self, visits):
+        """Return an iterator over VISITS that notes the highest ID."""
+
+        highest = self.highest
+        try:
+            for visit in visits:
+                if highest is None or visit[0] > highest:
+                    highest = visit[0]
+                yield visit
+        finally:
+            self.highest = highest
+
+    def save(self):
+        """Record the highest visit ID seen by track()."""
+
+        if self.highest is None or self.highest == self.mark:
+            return
+        marks = self.load()     # may have been updated for other files
+        marks[self.history] = self.highest
+        tmp = "%s.%d.tmp" % (self.state_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(marks, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.state_file)
+        self.mark = self.highest
+
+class _Descending(object):
+    """Sort key wrapper that reverses the order of the key it wraps."""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+def _sql_sort_key(value):
+    # SQLite sorts NULL before numbers, numbers before text and text
+    # before blobs; text is compared as UTF-8 bytes, which sort in the
+    # same order as the code points Python compares
+    if value is None:
+        return (0, 0)
+    elif isinstance(value, (int, float)):
+        return (1, value)
+    elif isinstance(value, bytes):
+        return (3, value)
+    return (2, value)
+
+def visit_sort_key(orderings):
+    """Return (key, reverse) that sort visit rows as ORDERINGS do in SQL.
+
+    When every ordering runs the same way the key is plain and REVERSE
+    says which way, as wrapping each part in _Descending is slow.
+    """
+
+    fields = [f.lower() for f in CrHistory.FIELDS]
+    parts = []
+    for o in orderings:
+        oa = o.split()
+        try:
+            index = fields.index(oa[0].lower())
+        except (IndexError, ValueError):
+            raise OrderSpecificationError("cannot merge on sort order field "+o)
+        parts.append((index, len(oa) == 2 and oa[1].lower() == "desc"))
+
+    reverse = parts[0][1]
+    if all(desc == reverse for index, desc in parts):
+        if len(parts) == 1:
+            index = parts[0][0]
+            return (lambda visit: _sql_sort_key(visit[index])), reverse
+        indexes = [index for index, desc in parts]
+        return (lambda visit: [_sql_sort_key(visit[i]) for i in indexes]), \
+               reverse
+
+    def key(visit):
+        r = []
+        for index, desc in parts:
+            k = _sql_sort_key(visit[index])
+            r.append(_Descending(k) if desc else k)
+        return r
+    return key, False
+
+def merge_visits(streams, orderings):
+    """Merge STREAMS of visit rows, each already in ORDERINGS order.
+
+    A k-way merge with a heap: only the next row of each stream is held.
+    """
+
+    if not orderings:
+        return itertools.chain(*streams)
+    key, reverse = visit_sort_key(orderings)
+    return heapq.merge(*streams, key=key, reverse=reverse)
+
+def iter_visits_in_thread(fname, filters, orderings, limit=None,
+                          batch_size=1000, snapshot=None, queue_size=4):
+    """Query history file FNAME in a thread; return an iterator over the rows.
+
+    The thread opens its own connection (and snapshot) and passes the
+    rows on in batches of BATCH_SIZE through a queue of QUEUE_SIZE
+    batches, so it runs ahead of the reader by a bounded amount.
+    Errors in the thread are raised by the iterator.
+    """
+
+    q = Queue(queue_size)
+
+    def run():
+        try:
+            crh = CrHistory(fname, snapshot)
+            try:
+                batch = []
+                for row in crh.iter_url_visits(filters, orderings, limit,
+                                               None, batch_size):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        q.put(batch)
+                        batch = []
+                if batch:
+                    q.put(batch)
+            finally:
+                crh.conn.close()
+        except Exception as e:
+            q.put(e)
+        q.put(None)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True      # abandoned if the reader stops early
+    thread.start()
+    return _read_queue(q)
+
+def _read_queue(q):
+    while True:
+        batch = q.get()
+        if batch is None:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        for row in batch:
+            yield row
+
+def stats_sort_key(report):
+    """Return a key function that sorts visit_stats(REPORT) rows."""
+
+    if STATS_REPORTS[report][1].startswith("visits desc"):
+        return lambda row: (-row[1], _sql_sort_key(row[0]))
+    elif report == "hour-of-week":
+        return lambda row: (WEEKDAYS.index(row[0][:3]), row[0])
+    return lambda row: _sql_sort_key(row[0])
+
+def visit_stats_of_files(fnames, report, filters, snapshot=None):
+    """Return visit_stats() of REPORT summed over the history files FNAMES.
+
+    Each file is queried in a thread of its own; SQLite does not hold
+    the interpreter lock while it aggregates.
+    """
+
+    results = [None] * len(fnames)
+    snapshots = snapshot_targets(snapshot, len(fnames))
+
+    def run(i):
+        try:
+            crh = CrHistory(fnames[i], snapshots[i])
+            try:
+                results[i] = crh.visit_stats(report, filters)
+            finally:
+                crh.conn.close()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(fnames))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    if len(results) == 1:
+        return results[0]
+    totals = {}
+    for group, visits in itertools.chain(*results):
+        totals[group] = totals.get(group, 0) + visits
+    return sorted(totals.items(), key=stats_sort_key(report))
 
 def parse_int(s, default=0):
     if len(s) == 0:
@@ -61,6 +593,7 @@ class CrTimeStamp(object):
     """
 
     epoch = datetime.datetime(1601, 1, 1)
+    _dates = {}       # days since the epoch -> "YYYYMMDD"
     
     @staticmethod
     def parse_tstamp(s):
@@ -87,11 +620,132 @@ class CrTimeStamp(object):
         This is the inverse of the parse_tstamp function.
         """
     
-        t = CrTimeStamp.epoch + datetime.timedelta(microseconds=ts)
-        parts = ["year", "month", "day", "hour", "minute", "second"]
-        return ''.join(["%02d" % getattr(t, k) for k in parts])
+        seconds = int(round(ts)) // 1000000
+        days, seconds = divmod(seconds, 86400)
+        date = CrTimeStamp._dates.get(days)
+        if date is None:
+            t = CrTimeStamp.epoch + datetime.timedelta(days=days)
+            date = "%02d%02d%02d" % (t.year, t.month, t.day)
+            CrTimeStamp._dates[days] = date
+        hh, seconds = divmod(seconds, 3600)
+        mm, ss = divmod(seconds, 60)
+        return "%s%02d%02d%02d" % (date, hh, mm, ss)
     
 
+URL_BASE = re.compile(r"^(\S+?://[^/]*/).*$")
+
+def url_base(url):
+    """Return the scheme, host and port part of URL."""
+
+    m = URL_BASE.match(url)
+    if m is None:
+        return url
+    return m.group(1)
+
+# (column name, expression of the visit row v, is a timestamp)
+HISTORY_COLUMNS = [
+    ("visit_id", "v[0]", False),
+    ("url_id", "v[1]", False),
+    ("visit_time", "v[2]", True),
+    ("url", "v[4]", False),
+    ("urlbase", "url_base(v[4])", False),
+    ("title", "v[5]", False),
+    ("visit_count", "v[6]", False),
+    ("last_visit_time", "v[7]", True),
+]
+
+OUTPUT_FORMATS = ["space", "csv", "tsv", "jsonl"]
+
+CSV_QUOTE = re.compile('[,"\r\n]')
+
+def csv_field(x):
+    if x is None:
+        return ""
+    s = "%s" % (x,)
+    if CSV_QUOTE.search(s):
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+def tsv_field(x):
+    if x is None:
+        return ""
+    return ("%s" % (x,)).replace("\t", " ").replace("\n", " ") \
+                        .replace("\r", " ")
+
+def _columns(columns, raw_times):
+    """Return the names and expressions of COLUMNS, or of every field."""
+
+    if not columns:
+        return (CrHistory.FIELDS,
+                ["v[%d]" % i for i in range(len(CrHistory.FIELDS))])
+    exprs = dict((name, (expr, is_time))
+                 for name, expr, is_time in HISTORY_COLUMNS)
+    r = []
+    for name in columns:
+        expr, is_time = exprs[name]
+        if is_time and not raw_times:
+            expr = "fmt_tstamp(%s)" % expr
+        r.append(expr)
+    return columns, r
+
+def make_row_formatter(columns, fmt="space", raw_times=False):
+    """Return a function that formats a visit row as a line of text.
+
+    COLUMNS are names from HISTORY_COLUMNS, in output order; with
+    none, the "space" format prints the whole row as a tuple and the
+    others print every one of CrHistory.FIELDS.  The selected columns
+    are compiled into a single expression, so no per-row decisions
+    are left.
+    """
+
+    names, exprs = _columns(columns, raw_times)
+    if fmt == "space":
+        if columns:
+            src = "lambda v: %r %% (%s,)" % ("%s " * len(exprs) + "\n",
+                                             ", ".join(exprs))
+        else:
+            src = "lambda v: '%s ' % (v,)"
+    elif fmt in ("csv", "tsv"):
+        sep = "," if fmt == "csv" else "\t"
+        src = "lambda v: %r.join([%s]) + '\\n'" % (
+              sep, ", ".join("%s_field(%s)" % (fmt, e) for e in exprs))
+    elif fmt == "jsonl":
+        src = "lambda v: dumps({%s}, ensure_ascii=False) + '\\n'" % \
+              ", ".join("%r: %s" % (n, e) for n, e in zip(names, exprs))
+    else:
+        raise ValueError("unknown output format " + fmt)
+    env = {"fmt_tstamp": CrTimeStamp.fmt_tstamp, "url_base": url_base,
+           "csv_field": csv_field, "tsv_field": tsv_field,
+           "dumps": json.dumps}
+    return eval(src, env)
+
+def format_header(columns, fmt="space"):
+    """Return the header line for format FMT, if it has one."""
+
+    names, exprs = _columns(columns, True)
+    if fmt == "csv":
+        return ",".join(csv_field(n) for n in names) + "\n"
+    elif fmt == "tsv":
+        return "\t".join(names) + "\n"
+    return ""
+
+def format_stats(report, rows, fmt="space"):
+    """Return the lines of visit_stats(REPORT) ROWS in format FMT."""
+
+    if fmt == "space":
+        return ["%s %d\n" % row for row in rows]
+    elif fmt in ("csv", "tsv"):
+        sep = "," if fmt == "csv" else "\t"
+        field = csv_field if fmt == "csv" else tsv_field
+        return [sep.join([report, "visits"]) + "\n"] + \
+               [field(group) + sep + "%d\n" % visits
+                for group, visits in rows]
+    elif fmt == "jsonl":
+        return [json.dumps({report: group, "visits": visits},
+                           ensure_ascii=False) + "\n"
+                for group, visits in rows]
+    raise ValueError("unknown output format " + fmt)
+
 def reduce(function, iterable, initial=None): 
     """reduce(function, iterable[, initial]) -> value
 
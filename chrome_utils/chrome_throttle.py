@@ -6,49 +6,110 @@ from __future__ import print_function
 
 import sys
 from optparse import OptionParser
-from signal import SIGSTOP, SIGCONT
+from signal import SIGSTOP, SIGCONT, SIGTERM
+import signal
 import os
+import select
+import errno
+import heapq
+import socket
+import struct
+import mmap
+import threading
 import stat
 import re
 import operator
+import json
+import fnmatch
+from array import array
 from procfs import Proc
 import time
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
 try:
     from chrome_lib import *
 except ImportError:
     from .chrome_lib import *
 
-JIFFIES_PER_SECOND = 100.0
+try:
+    JIFFIES_PER_SECOND = float(os.sysconf("SC_CLK_TCK"))
+except (ValueError, OSError, AttributeError):
+    JIFFIES_PER_SECOND = 100.0
+
+CGROUP_MOUNT = "/sys/fs/cgroup"
+CGROUP_ROOT = CGROUP_MOUNT + "/chrome_throttle"
+CGROUP_ORIGINS = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or
+                              default_cache_dir(), "chrome_throttle.cgroups")
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (ValueError, OSError, AttributeError):
+    PAGE_SIZE = 4096
+
+MIB = 1024.0 * 1024.0
+
+CR_BROWSER = "/usr/lib/chromium/chromium"
+
+PROC_ROOT = "/proc"
 
-def get_chromium_renderers():
+def proc_path(*parts):
+    """Return the path of PARTS below PROC_ROOT."""
+    return "/".join([PROC_ROOT] + [str(part) for part in parts])
+
+def is_chromium_renderer(pid, status=None):
+    """Return True if the process is a Chromium renderer.
+
+    STATUS, if given, is the already read content of
+    /proc/<pid>/status as a list of lines.
+    """
+
+    if status is None:
+        with open(proc_path(pid, "status")) as f:
+            status = f.readlines()
+    if status[0] != "Name:\tchromium\n":
+        return False
+    with open(proc_path(pid, "cmdline")) as f:
+        cmdline = f.readline()
+    return (CR_BROWSER, "--type=renderer") == tuple(cmdline.split()[:2])
+
+def get_chromium_renderers(cache=None):
     """Return list of Chromium renderer processes.
 
     Each list item is a 2-tuple of:
     process_ID - integer
     status     - Linux process status character
+
+    If CACHE (a RendererCache) is given, it is used to avoid
+    re-classifying processes that have been seen before.
     """
 
+    if cache is not None:
+        return cache.refresh()
+
     p = re.compile("^State:\s+(.)\s+\(([^)]*)\).*$")
     r = []
-    pids = [proc for proc in os.listdir("/proc") if proc[0] in "123456789"]
-    # no need to test  os.stat("/proc/"+proc).st_mode & stat.S_IFDIR
+    pids = [proc for proc in os.listdir(PROC_ROOT) if proc[0] in "123456789"]
+    # no need to test  os.stat(proc_path(proc)).st_mode & stat.S_IFDIR
 
     for pid in pids:
-        pdir = "/proc/"+pid
-        with open(pdir+"/status") as f:
+        with open(proc_path(pid, "status")) as f:
             status = f.readlines()
-        if status[0] != "Name:\tchromium\n":
+        if not is_chromium_renderer(int(pid), status):
             continue
-        with open(pdir+"/cmdline") as f:
-            cmdline = f.readline()
-        if ("/usr/lib/chromium/chromium", "--type=renderer") == \
-                tuple(cmdline.split()[:2]):
-            try:
-                state = p.match(status[1]).group(1)
-            except AttributeError:
-                continue
-            r.append((int(pid), state))
+        # State: follows Umask: on kernels since 4.7
+        matches = [m for m in map(p.match, status) if m]
+        if not matches:
+            continue
+        r.append((int(pid), matches[0].group(1)))
     return sorted(r, key=lambda pair: pair[0])
 
 """
@@ -100,37 +161,1907 @@ As of Linux 2.6.30-rc7  /proc/<PID>/stat  shows:
   cgtime        guest time of the task children in jiffies
 """
 
+# indices into the list returned by split_proc_stat()
+STAT_STATE = 2
+STAT_PPID = 3
+STAT_MAJ_FLT = 11
+STAT_UTIME = 13
+STAT_STIME = 14
+STAT_START_TIME = 21
+STAT_RSS = 23
+
+def split_proc_stat(line):
+    """Split a line of /proc/<pid>/stat into its fields.
+
+    The command name may itself contain spaces and parentheses,
+    so it is taken as everything between the first '(' and the
+    last ')' and returned without the parentheses.  The indices
+    of the returned list match the field list above.
+    """
+
+    lpar = line.index('(')
+    rpar = line.rindex(')')
+    return [line[:lpar].strip(), line[lpar+1:rpar]] + line[rpar+2:].split()
+
+def read_proc_stat(pid):
+    with open(proc_path(pid, "stat")) as fd:
+        return split_proc_stat(fd.readline())
+
+class RendererCache(object):
+    """Remember which processes are Chromium renderers between scans.
+
+    Each process seen is remembered by its process ID together
+    with its start_time from /proc/<pid>/stat, so that a process ID
+    that has been reused by a new process is noticed.  Processes
+    already known only have their stat file read to refresh their
+    state; only new processes have their status and cmdline read.
+
+    Renderers are forked from the zygote and change their command line
+    afterwards, so a Chromium process that is not a renderer is looked
+    at again by each scan for SETTLE seconds before it is remembered.
+
+    scan_cost counts the number of /proc files opened by the scans.
+    stats holds the stat fields of the renderers read by the latest
+    scan, so that callers need not read them again.
+    """
+
+    def __init__(self, settle=1.0, clock=time.time):
+        self.entries = {}     # pid -> (start_time, is_renderer)
+        self.pending = {}     # pid -> time first seen, not yet a renderer
+        self.stats = {}       # pid -> stat fields of a renderer
+        self.settle = settle
+        self.clock = clock
+        self.scan_cost = 0
+
+    def candidate_pids(self):
+        return [int(proc) for proc in os.listdir(PROC_ROOT)
+                if proc[0] in "123456789"]
+
+    def classify(self, pid, start_time):
+        """Classify a process not seen before (or reused)."""
+
+        with open(proc_path(pid, "status")) as f:
+            status = f.readlines()
+        self.scan_cost += 1
+        is_renderer = is_chromium_renderer(pid, status)
+        if status[0] == "Name:\tchromium\n":
+            self.scan_cost += 1   # cmdline was read too
+            if not is_renderer:
+                now = self.clock()
+                if now - self.pending.setdefault(pid, now) < self.settle:
+                    self.entries.pop(pid, None)   # may yet become one
+                    return False
+        self.pending.pop(pid, None)
+        self.entries[pid] = (start_time, is_renderer)
+        return is_renderer
+
+    def refresh(self):
+        """Return the current list of (process_ID, status) renderers."""
+
+        r = []
+        seen = set()
+        stats = {}
+        for pid in self.candidate_pids():
+            try:
+                flds = read_proc_stat(pid)
+                self.scan_cost += 1
+                start_time = int(flds[STAT_START_TIME])
+                entry = self.entries.get(pid)
+                if entry is not None and entry[0] == start_time:
+                    is_renderer = entry[1]
+                else:
+                    is_renderer = self.classify(pid, start_time)
+            except (IOError, OSError, IndexError, ValueError):
+                # process exited while we were looking at it
+                continue
+            seen.add(pid)
+            if is_renderer:
+                r.append((pid, flds[STAT_STATE]))
+                stats[pid] = flds
+        for pid in list(self.entries):
+            if pid not in seen:
+                del self.entries[pid]
+        for pid in list(self.pending):
+            if pid not in seen:
+                del self.pending[pid]
+        self.stats = stats
+        return sorted(r, key=lambda pair: pair[0])
+
+class RendererTreeCache(RendererCache):
+    """RendererCache that only looks at the Chromium process tree.
+
+    The browser processes (Chromium processes without a --type=
+    argument) are found once with a full sweep of /proc.  After that
+    only their descendants are examined, found by reading
+    /proc/<pid>/task/<tid>/children, so the cost of a scan depends on
+    the number of Chromium processes rather than on the number of
+    processes on the system.
+
+    If the kernel does not provide the children files (it needs
+    CONFIG_PROC_CHILDREN), each scan falls back to a full sweep.
+
+    While no browser is running every scan looks for one again, but
+    processes already found not to be Chromium are remembered by
+    process ID and start_time, as RendererCache does, and skipped.
+    """
+
+    def __init__(self):
+        super(RendererTreeCache, self).__init__()
+        self.roots = []       # list of (pid, start_time)
+        self.not_roots = {}   # pid -> start_time of non-Chromium processes
+
+    def find_roots(self):
+        roots = []
+        not_roots = {}
+        for pid in RendererCache.candidate_pids(self):
+            try:
+                start_time = int(read_proc_stat(pid)[STAT_START_TIME])
+                self.scan_cost += 1
+                if self.not_roots.get(pid) == start_time:
+                    not_roots[pid] = start_time
+                    continue
+                with open(proc_path(pid, "status")) as f:
+                    name = f.readline()
+                self.scan_cost += 1
+                if name != "Name:\tchromium\n":
+                    not_roots[pid] = start_time
+                    continue
+                # Chromium processes are looked at every time: the
+                # launcher script is also called chromium, and later
+                # exec()s the browser
+                with open(proc_path(pid, "cmdline")) as f:
+                    args = f.readline().split()
+                self.scan_cost += 1
+                if args[:1] != [CR_BROWSER] or \
+                        any(a.startswith("--type=") for a in args[1:]):
+                    continue
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+            roots.append((pid, start_time))
+        self.not_roots = not_roots
+        return roots
+
+    def roots_alive(self):
+        if not self.roots:
+            return False
+        for pid, start_time in self.roots:
+            try:
+                flds = read_proc_stat(pid)
+                self.scan_cost += 1
+            except (IOError, OSError):
+                return False
+            if int(flds[STAT_START_TIME]) != start_time:
+                return False
+        return True
+
+    def children(self, pid):
+        """Return the child process IDs of all threads of PID.
+
+        Raises IOError if the kernel has no children files.
+        """
+
+        kids = []
+        tdir = proc_path(pid, "task")
+        try:
+            tids = os.listdir(tdir)
+        except OSError:
+            return kids      # process has exited
+        self.scan_cost += 1
+        for tid in tids:
+            with open("%s/%s/children" % (tdir, tid)) as f:
+                kids.extend(int(c) for c in f.read().split())
+            self.scan_cost += 1
+        return kids
+
+    def candidate_pids(self):
+        if not self.roots_alive():
+            self.roots = self.find_roots()
+        pids = []
+        todo = [pid for pid, start_time in self.roots]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            entry = self.entries.get(pid)
+            if entry is not None and entry[1]:
+                continue     # renderers do not have children of interest
+            try:
+                todo.extend(self.children(pid))
+            except (IOError, OSError):
+                return RendererCache.candidate_pids(self)
+        return pids
+
+# netlink process connector (linux/connector.h, linux/cn_proc.h)
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+NLMSG_DONE = 3
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+
+NLMSGHDR = struct.Struct("=IHHII")
+CN_MSG = struct.Struct("=IIIIHH")
+PROC_EVENT = struct.Struct("=IIQ")
+PROC_EVENT_PIDS = struct.Struct("=IIII")
+
+def parse_proc_events(data):
+    """Return the process events in a datagram from the proc connector.
+
+    Each event is a 2-tuple of ("fork", "exec" or "exit", process_ID).
+    Events about threads other than the main thread are left out.
+    """
+
+    events = []
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length = NLMSGHDR.unpack_from(data, offset)[0]
+        if length < NLMSGHDR.size:
+            break
+        body = offset + NLMSGHDR.size + CN_MSG.size
+        if body + PROC_EVENT.size <= offset + length:
+            what = PROC_EVENT.unpack_from(data, body)[0]
+            pids = body + PROC_EVENT.size
+            if what == PROC_EVENT_FORK:
+                ppid, ptgid, pid, tgid = PROC_EVENT_PIDS.unpack_from(data, pids)
+                if pid == tgid:
+                    events.append(("fork", pid))
+            elif what in (PROC_EVENT_EXEC, PROC_EVENT_EXIT):
+                pid, tgid = struct.unpack_from("=II", data, pids)
+                if pid == tgid:
+                    events.append(("exec" if what == PROC_EVENT_EXEC
+                                   else "exit", pid))
+        offset += (length + 3) & ~3
+    return events
+
+class ProcConnector(object):
+    """Source of process events from the netlink process connector.
+
+    Subscribing needs CAP_NET_ADMIN; socket.error (OSError) is raised
+    by the constructor if that or the connector is unavailable.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                  NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, CN_IDX_PROC))
+            op = struct.pack("=I", PROC_CN_MCAST_LISTEN)
+            cn_msg = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0)
+            self.sock.send(NLMSGHDR.pack(NLMSGHDR.size+len(cn_msg)+len(op),
+                                         NLMSG_DONE, 0, 0, os.getpid()) +
+                           cn_msg + op)
+        except (socket.error, OSError):
+            self.sock.close()
+            raise
+
+    def read_events(self, timeout=0):
+        """Return the events that arrive within TIMEOUT seconds.
+
+        If events were lost because the socket buffer overflowed,
+        OSError is raised with errno ENOBUFS.
+        """
+
+        events = []
+        ready = select.select([self.sock], [], [], timeout)[0]
+        while ready:
+            events.extend(parse_proc_events(self.sock.recv(65536)))
+            ready = select.select([self.sock], [], [], 0)[0]
+        return events
+
+    def close(self):
+        self.sock.close()
+
+class ProcessTracker(object):
+    """Keep the set of renderers up to date from process events.
+
+    After one full scan with CACHE, renderers are only added and
+    removed as SOURCE reports processes being forked, exec()ed and
+    exiting, so /proc is not listed again.  SOURCE is any object with
+    a read_events(timeout) method returning (event, process_ID) pairs
+    as ProcConnector does; by default a ProcConnector is used, and if
+    that is unavailable every refresh() is a scan with CACHE instead.
+
+    Chromium renderers are forked from the zygote and change their
+    command line afterwards, so a new Chromium process that is not
+    yet a renderer is looked at again for SETTLE seconds.  If events
+    are lost (ENOBUFS), the next refresh() is a full scan again.
+
+    A ProcessTracker can be passed as the cache argument of
+    get_chromium_renderers() and RendererMonitor.
+    """
+
+    def __init__(self, cache=None, source=None, settle=1.0,
+                 clock=time.time):
+        self.cache = cache or RendererCache()
+        self.entries = self.cache.entries
+        self.settle = settle
+        self.clock = clock
+        if source is None:
+            try:
+                source = ProcConnector()
+            except (socket.error, OSError, AttributeError):
+                source = None
+        self.source = source
+        self.renderers = None     # set of pids once scanned
+        self.pending = {}         # pid -> time first seen
+        self.stats = {}           # pid -> stat fields of a renderer
+        self.scan_cost = 0
+
+    def classify(self, pid, now):
+        """Return True if PID is a renderer, False if it is not, or None
+        if it is a new Chromium process that may yet become one."""
+
+        try:
+            start_time = int(read_proc_stat(pid)[STAT_START_TIME])
+            self.scan_cost += 1
+            with open(proc_path(pid, "status")) as f:
+                status = f.readlines()
+            self.scan_cost += 1
+            if status[0] != "Name:\tchromium\n":
+                return False
+            self.scan_cost += 1
+            if is_chromium_renderer(pid, status):
+                self.cache.entries[pid] = (start_time, True)
+                return True
+        except (IOError, OSError, IndexError, ValueError):
+            return False
+        if now - self.pending.get(pid, now) >= self.settle:
+            return False
+        return None
+
+    def refresh(self):
+        """Return the current list of (process_ID, status) renderers."""
+
+        if self.source is None or self.renderers is None:
+            r = self.cache.refresh()
+            self.stats = self.cache.stats
+            if self.source is not None:
+                self.renderers = set(ps[0] for ps in r)
+            return r
+
+        try:
+            events = self.source.read_events(0)
+        except (socket.error, OSError) as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # events were lost, so the set cannot be trusted: rescan
+            self.renderers = None
+            self.pending = {}
+            return self.refresh()
+        now = self.clock()
+        for event, pid in events:
+            if event == "exit":
+                self.renderers.discard(pid)
+                self.pending.pop(pid, None)
+                self.cache.entries.pop(pid, None)
+            else:
+                self.renderers.discard(pid)
+                self.pending.setdefault(pid, now)
+        for pid in list(self.pending):
+            is_renderer = self.classify(pid, now)
+            if is_renderer is not None:
+                del self.pending[pid]
+                if is_renderer:
+                    self.renderers.add(pid)
+
+        r = []
+        self.stats = {}
+        for pid in sorted(self.renderers):
+            try:
+                flds = read_proc_stat(pid)
+                r.append((pid, flds[STAT_STATE]))
+                self.scan_cost += 1
+            except (IOError, OSError, IndexError):
+                self.renderers.discard(pid)
+                continue
+            self.stats[pid] = flds
+        return r
+
+    def close(self):
+        if self.source is not None and hasattr(self.source, "close"):
+            self.source.close()
+
 def cpu_usage(pid):
-    with open("/proc/%d/stat" % pid) as fd:
+    with open(proc_path(pid, "stat")) as fd:
         # want user mode jiffies  and  kernel mode jiffies
         flds = [int(s) for s in fd.readline().split()[13:15]] 
     return flds[0]+flds[1]
     
-def find_cpu_piggies(procs, time_window, threshold):
-    proc = Proc()
-    before_usage = [cpu_usage(pid) for pid in procs]
+class CpuSampler(object):
+    """Sample the CPU use of a changing set of processes.
+
+    The CPU time of a process is read from /proc/<pid>/schedstat,
+    which counts nanoseconds and so is good for windows well under a
+    second, when CLOCK is "schedstat", or when it is "auto" and the
+    kernel provides that file.  Otherwise the utime and stime jiffies
+    of /proc/<pid>/stat are used.  CPU times are kept in ticks of
+    ticks_per_second.
+
+    The files of each process are opened once and kept open, and are
+    re-read by seeking back to their start on every sample.  Samples
+    are keyed by (pid, start_time): a process that exits is dropped
+    (reading its open file fails, even if the process ID has been
+    reused) and a process seen for the first time has no previous
+    sample to compare with, which is reported as None ("insufficient
+    data") rather than as an error.
+    """
+
+    def __init__(self, clock="auto"):
+        self.clock = clock
+        self.files = {}       # pid -> (key, stat file, schedstat file or None)
+        self.last = {}        # key -> CPU ticks at previous sample
+
+    @property
+    def ticks_per_second(self):
+        if self.clock == "schedstat":
+            return 1e9
+        return JIFFIES_PER_SECOND
+
+    @staticmethod
+    def ticks(flds, sf):
+        if sf is None:
+            return int(flds[STAT_UTIME]) + int(flds[STAT_STIME])
+        sf.seek(0)
+        return int(sf.read().split()[0])
+
+    def open(self, pid, flds=None):
+        """Open the files of PID; return as read() does.
+
+        FLDS are the stat fields of PID if they have just been read.
+        """
+
+        f = open(proc_path(pid, "stat"))
+        sf = None
+        try:
+            if flds is None:
+                flds = split_proc_stat(f.read())
+            key = (pid, int(flds[STAT_START_TIME]))
+            if self.clock != "stat":
+                try:
+                    sf = open(proc_path(pid, "schedstat"))
+                    self.clock = "schedstat"
+                except (IOError, OSError):
+                    if self.clock == "schedstat":
+                        raise
+                    # make sure it is the kernel, not the process, that
+                    # is missing before settling on the stat file
+                    f.seek(0)
+                    f.read()
+                    self.clock = "stat"
+            ticks = self.ticks(flds, sf)
+        except Exception:
+            f.close()
+            if sf is not None:
+                sf.close()
+            raise
+        self.files[pid] = (key, f, sf)
+        return key, flds, ticks
+
+    def drop(self, pid):
+        key, f, sf = self.files.pop(pid)
+        self.last.pop(key, None)
+        f.close()
+        if sf is not None:
+            sf.close()
+
+    def read(self, pid, flds=None, fields=True):
+        """Return ((pid, start_time), stat fields, CPU ticks) for PID.
+
+        FLDS are the stat fields of PID if they have just been read
+        elsewhere, and are used instead of reading the stat file
+        again.  If FIELDS is false and the CPU time comes from
+        schedstat, the stat file is not read and None is returned
+        for the fields.  Raises IOError or OSError if the process
+        cannot be read.
+        """
+
+        if pid in self.files:
+            key, f, sf = self.files[pid]
+            try:
+                if flds is None and (fields or sf is None):
+                    f.seek(0)
+                    flds = split_proc_stat(f.read())
+                if flds is None or int(flds[STAT_START_TIME]) == key[1]:
+                    return key, flds, self.ticks(flds, sf)
+            except (IOError, OSError, IndexError, ValueError):
+                flds = None
+            # gone; the process ID may since have been reused
+            self.drop(pid)
+        return self.open(pid, flds)
+
+    def forget(self, pids):
+        """Drop the tracked processes not in PIDS."""
+
+        for pid in set(self.files) - set(pids):
+            self.drop(pid)
+
+    def sample(self, pids):
+        """Sample the processes PIDS.
+
+        Return a dictionary mapping (pid, start_time) to the CPU
+        seconds used since the previous sample, or to None for
+        processes not sampled before.  Processes that could not be
+        read, and tracked processes not in PIDS, are forgotten.
+        """
+
+        deltas = {}
+        self.forget(pids)
+        for pid in pids:
+            try:
+                key, flds, ticks = self.read(pid, fields=False)
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+            prev = self.last.get(key)
+            deltas[key] = None if prev is None \
+                          else (ticks - prev) / self.ticks_per_second
+            self.last[key] = ticks
+        return deltas
+
+    def close(self):
+        self.forget(())
+
+def find_cpu_piggies(procs, time_window, threshold, samples=1, alpha=0.5,
+                     clock="auto"):
+    """Return list of (CPU share, process_ID) at or above THRESHOLD.
+
+    The CPU share is measured over TIME_WINDOW seconds.  If SAMPLES
+    is more than one, the window is split into that many shorter
+    windows and the share reported is an exponentially weighted
+    moving average of them, with weight ALPHA for the newest.  PROCS
+    are sampled with RendererMonitor.find_cpu_piggies().
+    """
+
+    slept = [0.0]
+
+    def sleep(seconds):
+        time.sleep(seconds)
+        slept[0] += seconds
+
+    # shares are of the time asked for rather than of the time measured
+    monitor = RendererMonitor(clock=clock, now=lambda: slept[0])
+    try:
+        return monitor.find_cpu_piggies(time_window, threshold, samples,
+                                        alpha, sleep=sleep, pids=procs)
+    finally:
+        monitor.close()
+
+def thread_cpu_times(pid):
+    """Return the CPU time of each thread of a process.
+
+    The result maps thread IDs to 2-tuples of (CPU seconds, thread
+    name).  The name is the tcomm field of /proc/<pid>/task/<tid>/stat,
+    which is the same as /proc/<pid>/task/<tid>/comm, so each thread
+    costs one read.
+    """
+
+    times = {}
+    tdir = proc_path(pid, "task")
+    for tid in os.listdir(tdir):
+        try:
+            with open("%s/%s/stat" % (tdir, tid)) as f:
+                flds = split_proc_stat(f.readline())
+        except (IOError, OSError):
+            continue      # thread has exited
+        times[int(tid)] = ((int(flds[STAT_UTIME]) + int(flds[STAT_STIME])) /
+                           JIFFIES_PER_SECOND, flds[1])
+    return times
+
+def find_thread_hogs(piggies, time_window, top_n=3):
+    """Break down the CPU use of the worst renderers by thread.
+
+    PIGGIES is a list of (CPU share, process_ID) as returned by
+    find_cpu_piggies(); only the first TOP_N of them are sampled,
+    over TIME_WINDOW seconds.  Return a list of 3-tuples of
+    (CPU share, process_ID, threads) where threads is a list of
+    (CPU share, thread_ID, thread name), busiest first.  Threads
+    started during the window are left out.
+    """
+
+    pids = [piggy[1] for piggy in piggies[:top_n]]
+    before = {}
+    for pid in pids:
+        try:
+            before[pid] = thread_cpu_times(pid)
+        except (IOError, OSError):
+            pass
     time.sleep(time_window)
-    # FIXME: what if processes have come and gone?
-    after_usage = [cpu_usage(pid) for pid in procs]
-    deltas = [after_usage[i]-before_usage[i] for i in range(len(procs))]
-    divisor = JIFFIES_PER_SECOND * time_window
-    deltas = [delta/divisor for delta in deltas]
-
-    def int_diff(a, b):
-        # comparison function with requisite resolution
-        return int((a[0]-b[0])*divisor)
-
-    def sort_key(a):
-        return a[0]
-
-    total_use = 0
-    for d in deltas:
-        total_use += d   # Python3 deprecated apply()
-    ta = zip(deltas, procs)
-    #ta_sorted = sorted(ta, int_diff, reverse=True)
-    ta_sorted = sorted(ta, key=sort_key, reverse=True)
+    r = []
+    for pid in pids:
+        if pid not in before:
+            continue
+        try:
+            after = thread_cpu_times(pid)
+        except (IOError, OSError):
+            continue      # process has exited
+        threads = [((seconds - before[pid][tid][0]) / time_window, tid, name)
+                   for tid, (seconds, name) in after.items()
+                   if tid in before[pid]]
+        threads.sort(key=lambda a: a[0], reverse=True)
+        r.append((sum([t[0] for t in threads]), pid, threads))
+    return r
+
+def memory_usage(pid):
+    """Return the memory used by a process in bytes.
+
+    This is the proportional set size (PSS) from
+    /proc/<pid>/smaps_rollup, which shares pages used by several
+    processes out between them, or the resident set size from
+    /proc/<pid>/statm on kernels without smaps_rollup (before 4.14)
+    or where it may not be read.
+    """
+
+    try:
+        with open(proc_path(pid, "smaps_rollup")) as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    with open(proc_path(pid, "statm")) as f:
+        return int(f.readline().split()[1]) * PAGE_SIZE
+
+def find_memory_piggies(procs, threshold):
+    """Return list of (MiB used, process_ID) at or above THRESHOLD MiB.
+
+    Processes that have gone are skipped.
+    """
+
+    ta = []
+    for pid in procs:
+        try:
+            ta.append((memory_usage(pid) / MIB, pid))
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    ta_sorted = sorted(ta, key=lambda a: a[0], reverse=True)
     return [ta for ta in ta_sorted if ta[0] >= threshold]
 
+def read_io_bytes(pid):
+    """Return the bytes read and written by a process to storage."""
+
+    total = 0
+    with open(proc_path(pid, "io")) as f:
+        for line in f:
+            if line.startswith("read_bytes:") or \
+                    line.startswith("write_bytes:"):
+                total += int(line.split()[1])
+    return total
+
+# Each collector is (is_counter, scale, function).  The function is
+# called with the process ID and the fields of its stat file, which is
+# read once for all collectors.  Counters are turned into rates per
+# second; the value or rate is then divided by scale, the amount that
+# on its own marks a renderer as a hog.
+HOG_COLLECTORS = {
+    "cpu": (True, 1.0,                 # one CPU core
+            lambda pid, flds: (int(flds[STAT_UTIME]) + int(flds[STAT_STIME]))
+                              / JIFFIES_PER_SECOND),
+    "rss": (False, 1024 * MIB,         # 1 GiB resident
+            lambda pid, flds: int(flds[STAT_RSS]) * PAGE_SIZE),
+    "majflt": (True, 100.0,            # 100 major page faults a second
+               lambda pid, flds: int(flds[STAT_MAJ_FLT])),
+    "io": (True, 10 * MIB,             # 10 MiB/s of storage I/O
+           lambda pid, flds: read_io_bytes(pid)),
+}
+
+def parse_weights(s):
+    """Convert "metric=weight,..." to a dictionary.
+
+    Raises ValueError for unknown metrics or bad weights.
+    """
+
+    weights = {}
+    for item in s.split(','):
+        name, sep, weight = item.partition('=')
+        name = name.strip()
+        if name not in HOG_COLLECTORS:
+            raise ValueError("unknown metric " + name)
+        weights[name] = float(weight) if sep else 1.0
+    return weights
+
+class HogScorer(object):
+    """Rank renderers by a weighted mix of several metrics.
+
+    The metrics are those of HOG_COLLECTORS given a weight in WEIGHTS.
+    Each is divided by its scale, so that 1.0 is hog-like, and the
+    score of a renderer is the weighted sum.  All the metrics for a
+    process come from a single read of its stat file plus any files
+    a collector reads itself (/proc/<pid>/io for "io").
+
+    costs accumulates the seconds spent in each collector, and in
+    reading the stat files ("stat"), so that their cost can be seen.
+    metrics holds the values measured for each process by the last
+    call of find_piggies().
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.costs = dict((name, 0.0) for name in weights)
+        self.costs["stat"] = 0.0
+        self.metrics = {}
+
+    def collect(self, pids):
+        """Return {pid: {metric: value}} for the processes in PIDS."""
+
+        r = {}
+        for pid in pids:
+            t0 = time.time()
+            try:
+                flds = read_proc_stat(pid)
+            except (IOError, OSError):
+                continue
+            t1 = time.time()
+            self.costs["stat"] += t1 - t0
+            values = {}
+            for name in self.weights:
+                try:
+                    values[name] = HOG_COLLECTORS[name][2](pid, flds)
+                except (IOError, OSError, IndexError, ValueError):
+                    values[name] = None
+                t2 = time.time()
+                self.costs[name] += t2 - t1
+                t1 = t2
+            r[(pid, int(flds[STAT_START_TIME]))] = values
+        return r
+
+    def find_piggies(self, procs, time_window, threshold):
+        """Return list of (score, process_ID) at or above THRESHOLD.
+
+        Counters are measured over TIME_WINDOW seconds.
+        """
+
+        before = self.collect(procs)
+        time.sleep(time_window)
+        after = self.collect(procs)
+        self.metrics = {}
+        ta = []
+        for key, values in after.items():
+            if key not in before:
+                continue       # process has come or gone
+            metrics = {}
+            score = 0.0
+            for name, weight in self.weights.items():
+                is_counter, scale, collector = HOG_COLLECTORS[name]
+                value = values[name]
+                if value is None:
+                    continue
+                if is_counter:
+                    if before[key][name] is None:
+                        continue
+                    value = (value - before[key][name]) / float(time_window)
+                metrics[name] = value
+                score += weight * value / scale
+            self.metrics[key[0]] = metrics
+            ta.append((score, key[0]))
+        ta_sorted = sorted(ta, key=lambda a: a[0], reverse=True)
+        return [ta for ta in ta_sorted if ta[0] >= threshold]
+
+class RendererSnapshot(object):
+    """The renderers at one moment, as parallel arrays.
+
+    Index i of pids, start_times, cpu_ticks, rss (in bytes) and states
+    (the state character, as a byte) describes one renderer, in
+    process ID order.  time is when the snapshot was taken.
+    """
+
+    __slots__ = ("time", "pids", "start_times", "cpu_ticks", "rss", "states")
+
+    def __init__(self, when=0.0):
+        self.time = when
+        self.pids = array("l")
+        self.start_times = array("L")
+        self.cpu_ticks = array("L")
+        self.rss = array("L")
+        self.states = array("B")
+
+    def __len__(self):
+        return len(self.pids)
+
+    def pid_states(self):
+        """Return the list of (process_ID, status) that
+        get_chromium_renderers() would."""
+
+        return [(pid, chr(state)) for pid, state in zip(self.pids, self.states)]
+
+    def records(self):
+        """Return the renderers as StatsRecorder records."""
+
+        return [(self.time, self.start_times[i], self.cpu_ticks[i],
+                 self.rss[i], self.pids[i], chr(self.states[i]).encode("ascii"))
+                for i in range(len(self))]
+
+class RendererMonitor(object):
+    """Take snapshots of the Chromium renderers, for use as a library.
+
+    CACHE (a RendererCache, RendererTreeCache or ProcessTracker) finds
+    the renderers, and the state, start_time and resident size of each
+    are taken from the stat fields the cache read while doing so.  CPU
+    time is read with a CpuSampler for CLOCK, whose files are kept
+    open, so polling often costs at most one read of each file and no
+    new objects per renderer beyond the array entries.  cpu_ticks
+    count ticks_per_second: nanoseconds with schedstat, otherwise
+    jiffies.
+
+    delta() turns two snapshots into CPU shares and top() picks the
+    largest values without sorting them all.
+    """
+
+    def __init__(self, cache=None, clock="auto", now=time.time):
+        if cache is None:
+            cache = RendererCache()
+        self.cache = cache
+        self.sampler = CpuSampler(clock)
+        self.now = now
+        self.last = None      # the latest snapshot
+
+    @property
+    def ticks_per_second(self):
+        return self.sampler.ticks_per_second
+
+    def snapshot(self, pids=None):
+        """Return a RendererSnapshot of the renderers now.
+
+        If PIDS is given, those processes are looked at instead of the
+        renderers found by the cache.
+        """
+
+        if pids is None:
+            pids = [ps[0] for ps in self.cache.refresh()]
+            stats = self.cache.stats
+        else:
+            stats = {}
+        snap = RendererSnapshot(self.now())
+        for pid in pids:
+            try:
+                key, flds, ticks = self.sampler.read(pid, stats.get(pid))
+                rss = int(flds[STAT_RSS]) * PAGE_SIZE
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+            snap.pids.append(pid)
+            snap.start_times.append(key[1])
+            snap.cpu_ticks.append(ticks)
+            snap.rss.append(rss)
+            snap.states.append(ord(flds[STAT_STATE][:1]))
+        self.sampler.forget(snap.pids)
+        self.last = snap
+        return snap
+
+    @staticmethod
+    def align(prev, cur):
+        """Return the index in PREV of each renderer of CUR, or -1."""
+
+        if prev.pids == cur.pids and prev.start_times == cur.start_times:
+            return array("l", range(len(cur)))
+        index = dict(zip(zip(prev.pids, prev.start_times), range(len(prev))))
+        return array("l", [index.get(key, -1)
+                           for key in zip(cur.pids, cur.start_times)])
+
+    def delta(self, prev, cur):
+        """Return the CPU share of each renderer of CUR since PREV.
+
+        The result is an array of floats in the order of CUR, with
+        NaN for renderers not in PREV (new, or a reused process ID).
+        """
+
+        nan = float("nan")
+        elapsed = cur.time - prev.time
+        shares = array("d", [nan]) * len(cur)
+        if elapsed <= 0:
+            return shares
+        scale = 1.0 / (elapsed * self.ticks_per_second)
+        for i, j in enumerate(self.align(prev, cur)):
+            if j >= 0:
+                shares[i] = (cur.cpu_ticks[i] - prev.cpu_ticks[j]) * scale
+        return shares
+
+    @staticmethod
+    def top(snap, values, k=None, threshold=0.0):
+        """Return list of (value, process_ID) at or above THRESHOLD.
+
+        VALUES are in the order of SNAP.  Only the K largest are
+        returned if K is given, chosen with a heap.
+        """
+
+        candidates = [i for i in range(len(values)) if values[i] >= threshold]
+        if k is None:
+            candidates.sort(key=values.__getitem__, reverse=True)
+        else:
+            candidates = heapq.nlargest(k, candidates, key=values.__getitem__)
+        return [(values[i], snap.pids[i]) for i in candidates]
+
+    def find_cpu_piggies(self, time_window, threshold, samples=1, alpha=0.5,
+                         k=None, sleep=time.sleep, pids=None):
+        """Return list of (CPU share, process_ID) at or above THRESHOLD.
+
+        The CPU share is measured over TIME_WINDOW seconds.  If SAMPLES
+        is more than one, the window is split into that many shorter
+        windows and the share reported is an exponentially weighted
+        moving average of them, with weight ALPHA for the newest.
+
+        The renderers are found again for every sample, so one that
+        starts during TIME_WINDOW is measured from the first sample
+        that sees it; if PIDS is given, only those processes are
+        sampled.  Only the K largest are returned if K is given.
+        """
+
+        prev = self.snapshot(pids)
+        shares = None
+        for i in range(samples):
+            sleep(time_window / samples)
+            cur = self.snapshot(pids)
+            new = self.delta(prev, cur)
+            if shares is not None:
+                for n, j in enumerate(self.align(prev, cur)):
+                    # NaN (no earlier share) fails the comparison
+                    if j >= 0 and shares[j] >= 0:
+                        new[n] = alpha * new[n] + (1 - alpha) * shares[j]
+            prev, shares = cur, new
+        return self.top(prev, shares, k, threshold)
+
+    def close(self):
+        self.sampler.close()
+
+class PidfdSignaller(object):
+    """Signal processes through pidfds opened when they were found.
+
+    A pidfd refers to one process for as long as it is open, so a
+    signal sent through it can never reach an unrelated process that
+    has since been given the same process ID.  The pidfds are opened
+    by open() straight after discovery; send() then signals a batch of
+    processes in one tight loop and reports the outcome for each.
+
+    Where the kernel or Python lacks pidfds (Linux 5.3, Python 3.9),
+    or pidfd_open() is refused, signals are sent with kill() instead.
+    A process that has exited before its pidfd could be opened is
+    reported as gone.  PIDFD_OPEN, SEND_SIGNAL and
+    KILL may be given to replace os.pidfd_open,
+    signal.pidfd_send_signal and os.kill.
+    """
+
+    def __init__(self, pidfd_open=None, send_signal=None, kill=None):
+        self.pidfd_open = pidfd_open or getattr(os, "pidfd_open", None)
+        self.send_signal = send_signal or \
+                           getattr(signal, "pidfd_send_signal", None)
+        self.kill = kill
+        self.fds = {}         # pid -> pidfd, or None to use kill()
+        self.stale = set()
+        self.gone = set()
+
+    def open(self, pids, start_times=None):
+        """Open pidfds for PIDS.
+
+        START_TIMES may map process IDs to the start_time they had
+        when they were found; a process that no longer matches once
+        its pidfd is open has been replaced, and is marked stale.  A
+        process ID marked stale or gone before is tried again.
+        """
+
+        for pid in pids:
+            if pid in self.fds:
+                continue
+            self.stale.discard(pid)
+            self.gone.discard(pid)
+            if self.pidfd_open is None or self.send_signal is None:
+                self.fds[pid] = None
+                continue
+            try:
+                fd = self.pidfd_open(pid)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self.gone.add(pid)
+                else:
+                    # ENOSYS, or EPERM from a seccomp filter
+                    self.fds[pid] = None
+                continue
+            if start_times is not None and pid in start_times:
+                try:
+                    start_time = int(read_proc_stat(pid)[STAT_START_TIME])
+                except (IOError, OSError, IndexError, ValueError):
+                    start_time = None
+                if start_time != start_times[pid]:
+                    os.close(fd)
+                    self.stale.add(pid)
+                    continue
+            self.fds[pid] = fd
+
+    def send(self, sig, pids):
+        """Send signal SIG to each of PIDS.
+
+        Return a dictionary mapping each process ID to "ok", to
+        "gone" if the process has exited, to "stale" if the process
+        ID no longer refers to the process that was found, or to an
+        error message.
+        """
+
+        outcomes = {}
+        kill = self.kill or os.kill
+        for pid in pids:
+            if pid in self.stale:
+                outcomes[pid] = "stale"
+                continue
+            if pid in self.gone:
+                outcomes[pid] = "gone"
+                continue
+            try:
+                fd = self.fds[pid]
+            except KeyError:
+                outcomes[pid] = "stale"    # not opened at discovery
+                continue
+            try:
+                if fd is None:
+                    kill(pid, sig)
+                else:
+                    self.send_signal(fd, sig)
+                outcomes[pid] = "ok"
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    outcomes[pid] = "gone"
+                else:
+                    outcomes[pid] = str(e)
+        return outcomes
+
+    def close(self):
+        for fd in self.fds.values():
+            if fd is not None:
+                os.close(fd)
+        self.fds = {}
+        self.stale = set()
+        self.gone = set()
+
+class SignalThrottle(object):
+    """Disable renderers with SIGSTOP and enable them with SIGCONT.
+
+    A stopped renderer is frozen completely, including any audio or
+    video it is playing.  If SIGNALLER (a PidfdSignaller) is given,
+    the processes it has opened are signalled through it.
+
+    actions counts the renderers successfully disabled and enabled.
+    """
+
+    ACTIONS = {SIGSTOP: "disable", SIGCONT: "enable"}
+
+    def __init__(self, kill=None, signaller=None):
+        self.kill = kill
+        self.signaller = signaller
+        self.actions = {"disable": 0, "enable": 0}
+
+    def signal(self, pids, sig):
+        if self.signaller is not None:
+            outcomes = self.signaller.send(sig, pids)
+        else:
+            outcomes = {}
+            for pid in pids:
+                try:
+                    (self.kill or os.kill)(pid, sig)
+                    outcomes[pid] = "ok"
+                except OSError as e:
+                    outcomes[pid] = str(e)
+        self.actions[SignalThrottle.ACTIONS[sig]] += \
+            list(outcomes.values()).count("ok")
+        return outcomes
+
+    def disable_many(self, pids):
+        return self.signal(pids, SIGSTOP)
+
+    def enable_many(self, pids):
+        return self.signal(pids, SIGCONT)
+
+    def signal_one(self, pid, sig):
+        if self.signaller is None:
+            (self.kill or os.kill)(pid, sig)
+        else:
+            outcome = self.signaller.send(sig, [pid])[pid]
+            if outcome != "ok":
+                raise OSError(outcome)
+        self.actions[SignalThrottle.ACTIONS[sig]] += 1
+
+    def disable(self, pid):
+        self.signal_one(pid, SIGSTOP)
+
+    def enable(self, pid):
+        self.signal_one(pid, SIGCONT)
+
+class CgroupThrottle(object):
+    """Disable renderers by moving them into a limited cgroup.
+
+    ROOT is a cgroup v2 directory, below the cgroup2 mount MOUNT, that
+    has been delegated to the user (so that renderers can be moved in
+    and out of it) and has the cpu controller available.  Three leaf
+    groups are managed under it:
+
+      running    no limits; enabled renderers whose own group is
+                 unknown or gone are moved here
+      throttled  limited by cpu.max to QUOTA of one CPU core
+      frozen     frozen by cgroup.freeze
+
+    Disabled renderers go to "frozen" if FREEZE is true, otherwise
+    to "throttled", where they keep running slowly and pages stay
+    responsive.  The group a renderer came from is recorded when it
+    is disabled, in ORIGINS_FILE if given so that a later run can
+    enable it, and it is moved back there when enabled; a renderer
+    that is not in ROOT is left where it is.
+
+    actions counts the renderers successfully disabled and enabled.
+    """
+
+    LEAVES = ("running", "throttled", "frozen")
+
+    def __init__(self, root=CGROUP_ROOT, quota=0.1, freeze=False,
+                 period_us=100000, mount=CGROUP_MOUNT, origins_file=None):
+        self.root = root
+        self.quota = quota
+        self.freeze = freeze
+        self.period_us = period_us
+        self.mount = mount
+        self.origins_file = origins_file
+        self.origins = None   # pid -> cgroup path, read on first use
+        self.actions = {"disable": 0, "enable": 0}
+
+    def write(self, name, text):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(text)
+
+    def setup(self):
+        """Create the leaf groups and set their limits.
+
+        Raises ValueError if ROOT is not an existing cgroup v2 group,
+        or if the cpu controller needed to throttle (rather than
+        freeze) is not available in it.
+        """
+
+        try:
+            with open(os.path.join(self.root, "cgroup.controllers")) as f:
+                controllers = f.read().split()
+        except (IOError, OSError):
+            raise ValueError("%s is not a cgroup v2 group" % self.root)
+        if not self.freeze and "cpu" not in controllers:
+            raise ValueError("the cpu controller is not available in %s" %
+                             self.root)
+        for leaf in CgroupThrottle.LEAVES:
+            path = os.path.join(self.root, leaf)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        if not self.freeze:
+            self.write("cgroup.subtree_control", "+cpu")
+            self.write("throttled/cpu.max", "%d %d" %
+                       (max(1000, int(self.quota * self.period_us)),
+                        self.period_us))
+        self.write("frozen/cgroup.freeze", "1")
+
+    def move(self, pid, leaf):
+        self.write(leaf + "/cgroup.procs", "%d\n" % pid)
+
+    @staticmethod
+    def cgroup_of(pid):
+        """Return the cgroup v2 path of PID, or None if it is unknown."""
+
+        try:
+            with open(proc_path(pid, "cgroup")) as f:
+                for line in f:
+                    if line.startswith("0::"):
+                        return line[3:].rstrip("\n")
+        except (IOError, OSError):
+            pass
+        return None
+
+    def managed(self, path):
+        """Return True if cgroup PATH is ROOT or one of its leaves."""
+
+        top = "/" + os.path.relpath(self.root, self.mount)
+        return path == top or path.startswith(top + "/")
+
+    def load_origins(self):
+        if self.origins is None:
+            self.origins = {}
+            if self.origins_file:
+                try:
+                    with open(self.origins_file) as f:
+                        self.origins = dict((int(pid), path) for pid, path
+                                            in json.load(f).items())
+                except (IOError, OSError, ValueError, AttributeError):
+                    pass
+        return self.origins
+
+    def save_origins(self):
+        if not self.origins_file:
+            return
+        # forget the processes that have exited
+        origins = dict((str(pid), path) for pid, path in self.origins.items()
+                       if os.path.exists(proc_path(pid)))
+        tmp = "%s.%d.tmp" % (self.origins_file, os.getpid())
+        try:
+            dirname = os.path.dirname(self.origins_file)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp, "w") as f:
+                json.dump(origins, f)
+            os.rename(tmp, self.origins_file)
+        except (IOError, OSError):
+            pass      # enable() falls back to "running"
+
+    def disable(self, pid):
+        path = self.cgroup_of(pid)
+        self.move(pid, "frozen" if self.freeze else "throttled")
+        if path is not None and not self.managed(path):
+            self.load_origins()[pid] = path
+            self.save_origins()
+        self.actions["disable"] += 1
+
+    def enable(self, pid):
+        path = self.cgroup_of(pid)
+        if path is not None and not self.managed(path):
+            return            # never disabled
+        origin = self.load_origins().pop(pid, None)
+        if origin is not None:
+            self.save_origins()
+            try:
+                with open(os.path.join(self.mount, origin.lstrip("/"),
+                                       "cgroup.procs"), "w") as f:
+                    f.write("%d\n" % pid)
+            except (IOError, OSError):
+                origin = None     # the group has gone
+        if origin is None:
+            self.move(pid, "running")
+        self.actions["enable"] += 1
+
+    def apply_many(self, action, pids):
+        outcomes = {}
+        for pid in pids:
+            try:
+                action(pid)
+                outcomes[pid] = "ok"
+            except (IOError, OSError) as e:
+                outcomes[pid] = str(e)
+        return outcomes
+
+    def disable_many(self, pids):
+        return self.apply_many(self.disable, pids)
+
+    def enable_many(self, pids):
+        return self.apply_many(self.enable, pids)
+
+class PressureMonitor(object):
+    """Wait for pressure stall (PSI) notifications from the kernel.
+
+    A trigger asking to be told when tasks have been stalled for
+    STALL_US microseconds within any WINDOW_US window is written to
+    /proc/pressure/<resource> for each of RESOURCES, and wait() then
+    blocks in poll() until the kernel reports that a trigger has been
+    hit, so that nothing is sampled while the machine is idle.
+
+    FDS may map resource names to already open file descriptors to
+    poll instead, for testing; EVENTS is the poll() event mask that
+    means a stall on those (the kernel uses POLLPRI).
+    """
+
+    def __init__(self, resources=("cpu", "memory"), stall_us=150000,
+                 window_us=1000000, fds=None, events=select.POLLPRI):
+        self.events = events
+        self.resources = {}   # fd -> resource
+        self.owned = []
+        if fds is None:
+            fds = {}
+            trigger = "some %d %d\0" % (stall_us, window_us)
+            for resource in resources:
+                fd = os.open(proc_path("pressure", resource),
+                             os.O_RDWR | os.O_NONBLOCK)
+                self.owned.append(fd)
+                try:
+                    os.write(fd, trigger.encode("ascii"))
+                except OSError:
+                    self.close()
+                    raise
+                fds[resource] = fd
+        self.poller = select.poll()
+        for resource, fd in fds.items():
+            self.resources[fd] = resource
+            self.poller.register(fd, events)
+
+    def wait(self, timeout=None):
+        """Return the list of resources that have stalled.
+
+        TIMEOUT is in seconds; the list is empty if it expires first.
+        """
+
+        if timeout is not None:
+            timeout = timeout * 1000
+        fired = []
+        for fd, event in self.poller.poll(timeout):
+            if event & select.POLLERR:
+                raise OSError("pressure monitoring of %s stopped" %
+                              self.resources[fd])
+            if event & self.events:
+                fired.append(self.resources[fd])
+        return sorted(fired)
+
+    def close(self):
+        for fd in self.owned:
+            os.close(fd)
+        self.owned = []
+
+def throttle_on_pressure(monitor, find_piggies, cache=None, throttler=None,
+                         report=None, max_events=None):
+    """Stop renderer hogs each time MONITOR reports a stall.
+
+    FIND_PIGGIES is called with the list of renderer process IDs and
+    returns (score, process_ID) pairs, like find_cpu_piggies(), of the
+    processes to disable with THROTTLER (a SignalThrottle by
+    default).  REPORT, if given, is called with the stalled
+    resources and the pairs.  MAX_EVENTS limits the number of stalls
+    handled, mainly for testing.
+    """
+
+    throttler = throttler or SignalThrottle()
+    handled = 0
+    while max_events is None or handled < max_events:
+        fired = monitor.wait()
+        if not fired:
+            continue
+        handled += 1
+        pids = [ps[0] for ps in get_chromium_renderers(cache)]
+        piggies = find_piggies(pids)
+        for piggy in piggies:
+            try:
+                throttler.disable(piggy[1])
+            except (IOError, OSError):
+                pass
+        if report is not None:
+            report(fired, piggies)
+
+class ThrottleDaemon(object):
+    """Keep renderers that persistently use too much CPU stopped.
+
+    Every tick takes a snapshot of the known renderers with a
+    RendererMonitor and compares their CPU time with that of the
+    previous tick.
+    A renderer using at least THRESHOLD of a CPU core for HOG_WINDOWS
+    consecutive ticks is disabled with THROTTLER (by default a
+    SignalThrottle, which sends SIGSTOP).  It is enabled again once
+    COOLDOWN seconds have passed or, if RESUME_LOAD is given, once the
+    one minute load average has dropped below RESUME_LOAD.
+
+    The set of renderers is refreshed from CACHE only every
+    RESCAN_INTERVAL ticks; in between the open files of the renderers
+    already known are re-read.  Processes are identified by
+    (pid, start_time) so that a reused process ID is not mistaken
+    for the process that was stopped.
+    """
+
+    def __init__(self, cache, threshold, hog_windows=3, cooldown=60.0,
+                 resume_load=None, rescan_interval=10, throttler=None,
+                 clock=time.time, loadavg=os.getloadavg, cpu_clock="auto"):
+        self.cache = cache
+        self.threshold = threshold
+        self.hog_windows = hog_windows
+        self.cooldown = cooldown
+        self.resume_load = resume_load
+        self.rescan_interval = rescan_interval
+        self.throttler = throttler or SignalThrottle()
+        self.loadavg = loadavg
+        self.monitor = RendererMonitor(cache, cpu_clock, clock)
+        self.prev = None      # snapshot of the previous tick
+        self.hot = {}         # (pid, start_time) -> consecutive hot ticks
+        self.stopped = {}     # (pid, start_time) -> time stopped
+        self.ticks = 0
+
+    def apply(self, action, pid):
+        try:
+            action(pid)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def tick(self):
+        """Sample the renderers once.
+
+        Return a list of (action, process_ID) for the processes
+        stopped ("stop") or continued ("resume") by this tick.
+        """
+
+        if self.prev is None or self.ticks % self.rescan_interval == 0:
+            snap = self.monitor.snapshot()
+        else:
+            snap = self.monitor.snapshot(self.prev.pids)
+        self.ticks += 1
+        now = snap.time
+        usage = set(zip(snap.pids, snap.start_times))
+        actions = []
+
+        if self.prev is not None:
+            shares = self.monitor.delta(self.prev, snap)
+            for key, share in zip(zip(snap.pids, snap.start_times), shares):
+                # NaN (no earlier sample) fails the comparisons
+                if key in self.stopped or not share >= 0:
+                    continue
+                if share < self.threshold:
+                    self.hot.pop(key, None)
+                    continue
+                self.hot[key] = self.hot.get(key, 0) + 1
+                if self.hot[key] >= self.hog_windows:
+                    if self.apply(self.throttler.disable, key[0]):
+                        self.stopped[key] = now
+                        actions.append(("stop", key[0]))
+                    del self.hot[key]
+
+        load_low = self.resume_load is not None and \
+                   self.loadavg()[0] < self.resume_load
+        for key, when in list(self.stopped.items()):
+            if key not in usage:
+                del self.stopped[key]      # process has gone
+            elif load_low or now - when >= self.cooldown:
+                self.apply(self.throttler.enable, key[0])
+                del self.stopped[key]
+                actions.append(("resume", key[0]))
+
+        for key in list(self.hot):
+            if key not in usage:
+                del self.hot[key]
+        self.prev = snap
+        return actions
+
+    def resume_all(self):
+        """Enable every process disabled by this daemon."""
+
+        for key in list(self.stopped):
+            self.apply(self.throttler.enable, key[0])
+            del self.stopped[key]
+
+    def run(self, time_window, sleep=time.sleep, report=None):
+        try:
+            while True:
+                actions = self.tick()
+                if report is not None:
+                    for action in actions:
+                        report(*action)
+                sleep(time_window)
+        finally:
+            self.resume_all()
+
+def duty_for_share(share, target_share):
+    """Return the fraction of time a renderer may run.
+
+    A renderer measured using SHARE of a CPU core is allowed to run
+    for the fraction of the time that brings it down to TARGET_SHARE.
+    """
+
+    if share <= target_share:
+        return 1.0
+    return target_share / share
+
+class DutyCycleScheduler(object):
+    """Let chosen renderers run for only part of the time.
+
+    Each renderer is continued at the start of every PERIOD seconds
+    and stopped again after its duty cycle (fraction of PERIOD) has
+    passed.  The stop and continue times of all renderers are kept in
+    a single heap and driven by one loop, so the overhead does not
+    grow with the number of renderers beyond the signals themselves.
+    """
+
+    def __init__(self, period=0.5, min_slice=0.01, throttler=None,
+                 clock=time.time, sleep=time.sleep):
+        self.period = period
+        self.min_slice = min_slice
+        self.throttler = throttler or SignalThrottle()
+        self.clock = clock
+        self.sleep = sleep
+        self.duty = {}        # pid -> fraction of the period running
+        self.heap = []        # (when, sequence, pid, generation, run)
+        self.generation = {}  # pid -> generation of its heap entries
+        self.sequence = 0
+
+    def push(self, when, pid, run):
+        self.sequence += 1
+        heapq.heappush(self.heap, (when, self.sequence, pid,
+                                   self.generation[pid], run))
+
+    def set_duty(self, pid, duty):
+        """Let PID run for the fraction DUTY of each period."""
+
+        if duty * self.period >= self.period - self.min_slice:
+            self.remove(pid)
+            return
+        self.duty[pid] = max(duty, self.min_slice / self.period)
+        # entries queued for an earlier duty cycle are now stale
+        self.generation[pid] = self.generation.get(pid, 0) + 1
+        self.push(self.clock(), pid, True)
+
+    def remove(self, pid):
+        """Stop duty cycling PID and leave it running."""
+
+        if pid in self.duty:
+            del self.duty[pid]
+            self.generation[pid] += 1
+            try:
+                self.throttler.enable(pid)
+            except (IOError, OSError):
+                pass
+
+    def step(self):
+        """Carry out the actions that are due.
+
+        Return the time of the next action, or None if none are queued.
+        """
+
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            when, seq, pid, generation, run = heapq.heappop(self.heap)
+            if generation != self.generation.get(pid):
+                continue
+            try:
+                if run:
+                    self.throttler.enable(pid)
+                    self.push(when + self.duty[pid] * self.period, pid, False)
+                else:
+                    self.throttler.disable(pid)
+                    self.push(when + (1 - self.duty[pid]) * self.period,
+                              pid, True)
+            except (IOError, OSError):
+                # process has gone
+                del self.duty[pid]
+                self.generation[pid] += 1
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def run(self, duration=None):
+        """Run the schedule for DURATION seconds, or until interrupted.
+
+        Every renderer is left running afterwards.
+        """
+
+        end = None if duration is None else self.clock() + duration
+        try:
+            while True:
+                when = self.step()
+                if when is None:
+                    break
+                if end is not None and when >= end:
+                    self.sleep(max(0, end - self.clock()))
+                    break
+                self.sleep(max(0, when - self.clock()))
+        finally:
+            for pid in list(self.duty):
+                self.remove(pid)
+            self.heap = []
+
+class StatsRecorder(object):
+    """Fixed size ring file of renderer samples.
+
+    The file starts with a header (HEADER) followed by room for
+    CAPACITY fixed width records (RECORD) of:
+
+      timestamp   seconds since the epoch of the sample
+      start_time  start_time of the process, from /proc/<pid>/stat
+      cpu_ticks   utime + stime of the process in jiffies
+      rss         resident set size in bytes
+      pid         process ID
+      state       process state character
+
+    Once full, the oldest records are overwritten, so the file never
+    grows.  The file is memory mapped and batches of records are
+    packed into a buffer with struct and copied into the map, so
+    appending costs no system calls beyond the page writeback.  An
+    existing file is reopened with its own capacity; a missing one is
+    created unless CREATE is false.
+    """
+
+    MAGIC = b"CRTHROT1"
+    HEADER = struct.Struct("<8sIIdQQ")   # magic, version, record size,
+                                         # jiffies per second, capacity,
+                                         # records ever written
+    RECORD = struct.Struct("<dQQQIc3x")
+    VERSION = 1
+
+    def __init__(self, fname, capacity=1 << 20, create=True):
+        self.fname = fname
+        if create and not os.path.exists(fname):
+            with open(fname, "wb") as f:
+                f.write(StatsRecorder.HEADER.pack(
+                        StatsRecorder.MAGIC, StatsRecorder.VERSION,
+                        StatsRecorder.RECORD.size, JIFFIES_PER_SECOND,
+                        capacity, 0))
+                f.truncate(StatsRecorder.HEADER.size +
+                           capacity * StatsRecorder.RECORD.size)
+        self.f = open(fname, "r+b")
+        self.map = mmap.mmap(self.f.fileno(), 0)
+        (magic, version, record_size, self.ticks_per_second,
+         self.capacity, self.count) = StatsRecorder.HEADER.unpack_from(self.map)
+        if magic != StatsRecorder.MAGIC or \
+                version != StatsRecorder.VERSION or \
+                record_size != StatsRecorder.RECORD.size:
+            self.close()
+            raise ValueError("%s is not a renderer stats file" % fname)
+
+    def offset(self, index):
+        return StatsRecorder.HEADER.size + \
+               (index % self.capacity) * StatsRecorder.RECORD.size
+
+    def append(self, samples):
+        """Append SAMPLES, a list of tuples in record field order."""
+
+        size = StatsRecorder.RECORD.size
+        buf = bytearray(len(samples) * size)
+        for i, sample in enumerate(samples):
+            StatsRecorder.RECORD.pack_into(buf, i * size, *sample)
+        # copy in runs that do not wrap around the end of the ring
+        start = 0
+        while start < len(samples):
+            n = min(len(samples) - start,
+                    self.capacity - (self.count + start) % self.capacity)
+            offset = self.offset(self.count + start)
+            self.map[offset:offset + n*size] = \
+                memoryview(buf)[start*size:(start+n)*size]
+            start += n
+        self.count += len(samples)
+        struct.pack_into("<Q", self.map, StatsRecorder.HEADER.size - 8,
+                         self.count)
+
+    def records(self):
+        """Yield the records held, oldest first."""
+
+        for index in range(max(0, self.count - self.capacity), self.count):
+            yield StatsRecorder.RECORD.unpack_from(self.map, self.offset(index))
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+def sample_renderers(pids, now=None):
+    """Return records of the current stats of PIDS for StatsRecorder."""
+
+    monitor = RendererMonitor(clock="stat")
+    if now is not None:
+        monitor.now = lambda: now
+    try:
+        return monitor.snapshot(pids).records()
+    finally:
+        monitor.close()
+
+def replay_cpu_piggies(records, threshold, ticks_per_second):
+    """Find CPU piggies in recorded samples.
+
+    RECORDS are StatsRecorder records, oldest first.  Samples with the
+    same timestamp are taken as one tick.  Yield a 2-tuple of
+    (timestamp, piggies) for each tick after the first, where piggies
+    is a list of (CPU share, process_ID) as from find_cpu_piggies().
+    """
+
+    def piggies(prev, cur, dt):
+        ta = [((ticks - prev[key]) / (ticks_per_second * dt), key[1])
+              for key, ticks in cur.items() if key in prev]
+        ta_sorted = sorted(ta, key=lambda a: a[0], reverse=True)
+        return [ta for ta in ta_sorted if ta[0] >= threshold]
+
+    prev = None
+    cur = {}
+    now = None
+    for timestamp, start_time, cpu_ticks, rss, pid, state in records:
+        if timestamp != now:
+            if prev is not None and cur:
+                yield now, piggies(prev, cur, now - prev_time)
+            if cur:
+                prev, prev_time = cur, now
+            cur = {}
+            now = timestamp
+        cur[(start_time, pid)] = cpu_ticks
+    if prev is not None and cur:
+        yield now, piggies(prev, cur, now - prev_time)
+
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+def format_metrics(renderers, cpu, rss, actions):
+    """Return renderer metrics as OpenMetrics text.
+
+    RENDERERS is a list of (process_ID, status) as from
+    get_chromium_renderers(); CPU and RSS map process IDs to CPU share
+    and resident bytes, and ACTIONS maps throttle action names to the
+    number taken.
+    """
+
+    lines = [
+        "# TYPE chromium_renderer_cpu_ratio gauge",
+        "# HELP chromium_renderer_cpu_ratio Fraction of a CPU core used.",
+    ]
+    lines.extend(['chromium_renderer_cpu_ratio{pid="%d"} %g' % (pid, cpu[pid])
+                  for pid, state in renderers if pid in cpu])
+    lines.extend([
+        "# TYPE chromium_renderer_rss_bytes gauge",
+        "# UNIT chromium_renderer_rss_bytes bytes",
+        "# HELP chromium_renderer_rss_bytes Resident set size.",
+    ])
+    lines.extend(['chromium_renderer_rss_bytes{pid="%d"} %d' % (pid, rss[pid])
+                  for pid, state in renderers if pid in rss])
+    lines.extend([
+        "# TYPE chromium_renderer_state stateset",
+        "# HELP chromium_renderer_state Linux process state.",
+    ])
+    lines.extend(['chromium_renderer_state{pid="%d",chromium_renderer_state="%s"} 1'
+                  % (pid, state) for pid, state in renderers])
+    lines.extend([
+        "# TYPE chromium_throttle_actions counter",
+        "# HELP chromium_throttle_actions Renderers disabled and enabled.",
+    ])
+    lines.extend(['chromium_throttle_actions_total{action="%s"} %d' %
+                  (action, actions[action]) for action in sorted(actions)])
+    lines.append("# EOF")
+    return '\n'.join(lines) + '\n'
+
+class MetricsExporter(object):
+    """Serve renderer metrics as OpenMetrics text over HTTP.
+
+    A background thread refreshes a snapshot of the renderers every
+    INTERVAL seconds, using CACHE to find them; the throttle action
+    counts are read from THROTTLER.  Scrapes are answered from the
+    latest snapshot, so a scrape never scans /proc or waits for a
+    sampling window.
+    """
+
+    def __init__(self, cache, throttler, interval=1.0, address="127.0.0.1",
+                 port=9464, cpu_clock="auto"):
+        self.cache = cache
+        self.throttler = throttler
+        self.interval = interval
+        self.address = address
+        self.port = port
+        self.monitor = RendererMonitor(cache, cpu_clock)
+        self.prev = None      # RendererSnapshot of the previous refresh
+        self.snapshot = format_metrics([], {}, {}, throttler.actions).encode()
+        self.stopping = threading.Event()
+        self.server = None
+
+    def refresh(self):
+        """Take a new snapshot of the renderers."""
+
+        snap = self.monitor.snapshot()
+        cpu = {}
+        if self.prev is not None:
+            for pid, share in zip(snap.pids, self.monitor.delta(self.prev,
+                                                                snap)):
+                if share >= 0:
+                    cpu[pid] = share
+        self.prev = snap
+        rss = dict(zip(snap.pids, snap.rss))
+        self.snapshot = format_metrics(snap.pid_states(), cpu, rss,
+                                       self.throttler.actions).encode()
+
+    def refresh_loop(self):
+        while not self.stopping.is_set():
+            try:
+                self.refresh()
+            except (IOError, OSError):
+                pass
+            self.stopping.wait(self.interval)
+
+    def start(self):
+        """Start serving; return the port number served on."""
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((self.address, self.port), Handler)
+        for target in (self.refresh_loop, self.server.serve_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+DEVTOOLS_ENDPOINT = "http://127.0.0.1:9222"
+
+class TabMapper(object):
+    """Map renderer process IDs to the tabs they show, using DevTools.
+
+    ENDPOINT is the remote debugging address of the browser (started
+    with --remote-debugging-port).  The page targets are fetched from
+    its /json/list at most once every MAX_AGE seconds, and only the
+    targets that are new or have changed URL are given to RESOLVE,
+    which returns the renderer process ID of a target or None.
+
+    The default RESOLVE uses the "processId" of the target.  Chromium
+    itself does not list one; it is added by DevTools proxies, and
+    RESOLVE can be replaced by a lookup that has another way to find
+    the process.  unresolved() tells when neither has worked.
+    """
+
+    def __init__(self, endpoint=DEVTOOLS_ENDPOINT, max_age=5.0, resolve=None,
+                 clock=time.time, timeout=2.0):
+        self.endpoint = endpoint.rstrip("/")
+        self.max_age = max_age
+        self.resolve = resolve or TabMapper.target_pid
+        self.clock = clock
+        self.timeout = timeout
+        self.targets = {}     # target id -> {"url", "title", "pid"}
+        self.fetched = None
+        self.fetches = 0
+
+    @staticmethod
+    def target_pid(target):
+        try:
+            return int(target["processId"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def fetch(self, path):
+        f = urlopen(self.endpoint + path, timeout=self.timeout)
+        try:
+            return json.loads(f.read().decode("utf-8"))
+        finally:
+            f.close()
+
+    def refresh(self, force=False):
+        """Fetch the target list again if it is older than max_age."""
+
+        now = self.clock()
+        if not force and self.fetched is not None and \
+                now - self.fetched < self.max_age:
+            return
+        targets = {}
+        for target in self.fetch("/json/list"):
+            if target.get("type") != "page":
+                continue
+            old = self.targets.get(target["id"])
+            if old is not None and old["url"] == target.get("url"):
+                pid = old["pid"]
+            else:
+                pid = self.resolve(target)
+            targets[target["id"]] = {"url": target.get("url", ""),
+                                     "title": target.get("title", ""),
+                                     "pid": pid}
+        self.targets = targets
+        self.fetched = now
+        self.fetches += 1
+
+    def unresolved(self):
+        """Return True if there are tabs but none has a renderer process
+        ID, as with a browser whose targets list no "processId"."""
+
+        self.refresh()
+        return bool(self.targets) and \
+               all(t["pid"] is None for t in self.targets.values())
+
+    def tabs(self, pid):
+        """Return the list of (URL, title) of the tabs of renderer PID."""
+
+        self.refresh()
+        return sorted((t["url"], t["title"]) for t in self.targets.values()
+                      if t["pid"] == pid)
+
+    def url(self, pid):
+        """Return the URLs of the tabs of renderer PID, or "-"."""
+
+        return ' '.join(url for url, title in self.tabs(pid)) or "-"
+
+    def match(self, patterns, pids):
+        """Return the renderers of PIDS showing a tab whose URL or
+        title matches one of the shell-style PATTERNS."""
+
+        self.refresh()
+        found = set()
+        for t in self.targets.values():
+            if t["pid"] in pids and \
+                    any(fnmatch.fnmatchcase(t["url"], pattern) or
+                        fnmatch.fnmatchcase(t["title"], pattern)
+                        for pattern in patterns):
+                found.add(t["pid"])
+        return sorted(found)
+
 def parse_pid(s):
     """Convert processID as string to integer.
 
@@ -168,46 +2099,451 @@ if __name__ == '__main__':
     op.add_option("--disable-cpu-hogs",
                   action="store_true", dest="disable_cpu_hogs", default=False,
                   help="Disable heaviest CPU-using renderer processes.")
+    op.add_option("--threads",
+                  action="store", dest="threads", type="int", default=0,
+                  help="With --find-cpu-hogs, also show the CPU use of each"
+                       " thread of the worst THREADS renderers.")
+    op.add_option("--find-memory-hogs",
+                  action="store_true", dest="find_memory_hogs", default=False,
+                  help="Find heaviest memory-using renderer processes.")
+    op.add_option("--disable-memory-hogs",
+                  action="store_true", dest="disable_memory_hogs",
+                  default=False,
+                  help="Disable heaviest memory-using renderer processes.")
+    op.add_option("--memory-threshold",
+                  action="store", dest="memory_threshold", type="float",
+                  default=200.0,
+                  help="Number of MiB above which a renderer process is a"
+                       " memory \"piggy\".")
+    op.add_option("--find-hogs",
+                  action="store_true", dest="find_hogs", default=False,
+                  help="Find renderer processes with the highest score"
+                       " on the metrics given by --weights.")
+    op.add_option("--disable-hogs",
+                  action="store_true", dest="disable_hogs", default=False,
+                  help="Disable renderer processes with the highest score"
+                       " on the metrics given by --weights.")
+    op.add_option("--weights",
+                  action="store", dest="weights", default="cpu=1",
+                  help="Comma separated metric=weight pairs for --find-hogs"
+                       " and --disable-hogs.  Metrics are: " +
+                       ", ".join(sorted(HOG_COLLECTORS)) + ".")
+    op.add_option("--score-threshold",
+                  action="store", dest="score_threshold", type="float",
+                  default=0.5,
+                  help="Score at or above which a renderer is a hog.")
+    op.add_option("--show-costs",
+                  action="store_true", dest="show_costs", default=False,
+                  help="Show the time spent collecting each metric.")
     op.add_option("--time-window",
                   action="store", dest="time_window", type="float", default=1.0,
                   help="Number of seconds to sample CPU use of renderer processes.")
     op.add_option("--threshold",
                   action="store", dest="threshold", type="float", default=0.05,
                   help="Threshold for determining CPU \"piggyness\" of renderer processes.")
+    op.add_option("--samples",
+                  action="store", dest="samples", type="int", default=1,
+                  help="Split the time window into SAMPLES shorter windows"
+                       " and report a moving average of the CPU use.")
+    op.add_option("--ewma-alpha",
+                  action="store", dest="ewma_alpha", type="float", default=0.5,
+                  help="Weight of the newest sample in the moving average.")
+    op.add_option("--cpu-clock",
+                  action="store", dest="cpu_clock", type="choice",
+                  choices=["auto", "schedstat", "stat"], default="auto",
+                  help="Where to read CPU time from: \"schedstat\""
+                       " (nanoseconds), \"stat\" (jiffies) or \"auto\".")
+    op.add_option("--discovery",
+                  action="store", dest="discovery", type="choice",
+                  choices=["sweep", "tree", "events"], default="sweep",
+                  help="How to find renderer processes: \"sweep\" examines"
+                       " every process, \"tree\" only descendants of the"
+                       " Chromium browser process, \"events\" follows process"
+                       " events from the kernel after one sweep.")
+    op.add_option("--proc-root",
+                  action="store", dest="proc_root", default=PROC_ROOT,
+                  help="Directory to read process information from instead"
+                       " of /proc, such as a copy or a test fixture.")
+    op.add_option("--daemon",
+                  action="store_true", dest="daemon", default=False,
+                  help="Keep running, stopping renderers that stay above"
+                       " the threshold and continuing them later.")
+    op.add_option("--duty-cycle",
+                  action="store_true", dest="duty_cycle", default=False,
+                  help="Let CPU hogs run only part of the time.")
+    op.add_option("--duty-period",
+                  action="store", dest="duty_period", type="float",
+                  default=0.5,
+                  help="Length in seconds of each run/stop cycle.")
+    op.add_option("--target-share",
+                  action="store", dest="target_share", type="float",
+                  help="Fraction of a CPU core duty cycled renderers are"
+                       " limited to (default the threshold).")
+    op.add_option("--duration",
+                  action="store", dest="duration", type="float",
+                  help="Number of seconds to duty cycle for (default until"
+                       " interrupted).")
+    op.add_option("--record",
+                  action="store", dest="record",
+                  help="Keep appending renderer samples to the ring file"
+                       " RECORD every time window.")
+    op.add_option("--record-size",
+                  action="store", dest="record_size", type="int",
+                  default=1 << 20,
+                  help="Number of samples a new --record file holds before"
+                       " the oldest are overwritten.")
+    op.add_option("--replay",
+                  action="store", dest="replay",
+                  help="Find CPU hogs in the samples recorded in REPLAY"
+                       " instead of in the running browser.")
+    op.add_option("--export-port",
+                  action="store", dest="export_port", type="int",
+                  help="Serve renderer metrics in OpenMetrics format on"
+                       " EXPORT_PORT, refreshed every time window, until"
+                       " interrupted.  May be combined with --daemon, but"
+                       " not with other modes.")
+    op.add_option("--export-address",
+                  action="store", dest="export_address", default="127.0.0.1",
+                  help="Address to serve metrics on.")
+    op.add_option("--devtools",
+                  action="store", dest="devtools", default=None,
+                  help="Chromium remote debugging endpoint, such as "
+                       + DEVTOOLS_ENDPOINT + ", used to show the URLs of"
+                       " CPU hogs and to accept URL patterns for --enable"
+                       " and --disable.  Chromium does not give the"
+                       " renderer process IDs of its tabs, so this must be"
+                       " a proxy that adds \"processId\" to each target.")
+    op.add_option("--backend",
+                  action="store", dest="backend", type="choice",
+                  choices=["signal", "cpu-quota", "freeze"], default="signal",
+                  help="How to disable renderers: \"signal\" (SIGSTOP),"
+                       " \"cpu-quota\" (cgroup v2 cpu.max) or \"freeze\""
+                       " (cgroup v2 cgroup.freeze).")
+    op.add_option("--cgroup-root",
+                  action="store", dest="cgroup_root", default=CGROUP_ROOT,
+                  help="Delegated cgroup v2 directory to manage for the"
+                       " cpu-quota and freeze backends.")
+    op.add_option("--cgroup-origins",
+                  action="store", dest="cgroup_origins",
+                  default=CGROUP_ORIGINS,
+                  help="File recording the cgroup each renderer disabled by"
+                       " the cpu-quota and freeze backends came from, so"
+                       " that --enable can move it back (default"
+                       " %default).")
+    op.add_option("--cpu-quota",
+                  action="store", dest="cpu_quota", type="float", default=0.1,
+                  help="Fraction of one CPU core allowed to renderers"
+                       " disabled by the cpu-quota backend.")
+    op.add_option("--on-pressure",
+                  action="store_true", dest="on_pressure", default=False,
+                  help="Keep running, and only look for and disable hogs when"
+                       " the kernel reports CPU or memory pressure.")
+    op.add_option("--psi-stall",
+                  action="store", dest="psi_stall", type="float", default=150.0,
+                  help="Milliseconds of stall within the PSI window that"
+                       " count as pressure.")
+    op.add_option("--psi-window",
+                  action="store", dest="psi_window", type="float",
+                  default=1000.0,
+                  help="Length in milliseconds of the PSI window.")
+    op.add_option("--hog-windows",
+                  action="store", dest="hog_windows", type="int", default=3,
+                  help="Number of consecutive time windows a renderer must"
+                       " be above the threshold before it is stopped.")
+    op.add_option("--cooldown",
+                  action="store", dest="cooldown", type="float", default=60.0,
+                  help="Number of seconds before a stopped renderer is"
+                       " continued.")
+    op.add_option("--resume-load",
+                  action="store", dest="resume_load", type="float",
+                  help="Continue stopped renderers early once the load"
+                       " average drops below RESUME_LOAD.")
+    op.add_option("--rescan-interval",
+                  action="store", dest="rescan_interval", type="int",
+                  default=10,
+                  help="Number of time windows between searches for new"
+                       " renderer processes in daemon mode.")
 
     
     op.disable_interspersed_args()
     
     op.epilog = """\
     Selectively enable or disable Chromium browser process instances.
-    This is done by issuing SIGSTOP and SIGCONT signals.  This program
-    only runs on Linux.
+    This is done by issuing SIGSTOP and SIGCONT signals or, with
+    --backend, by moving them in and out of a cgroup v2 group that
+    limits their CPU use to "cpu_quota" of a core or freezes them.
+    Enabling moves a renderer back to the cgroup it was disabled from,
+    as recorded in CGROUP_ORIGINS; renderers that were not disabled
+    are left where they are.  This program only runs on Linux.
 
-    The determination of "piggyness" is by sampling the CPU "jiffies"
+    The determination of "piggyness" is by sampling the CPU time
     before and after a wait of "time_window" which defaults to one second.
+    The CPU time is read in nanoseconds from /proc/<pid>/schedstat where
+    available, so windows of 0.1 to 0.2 seconds are usable.  With
+    --samples the window is split up and a moving average reported.
     The threshold is the fraction of one CPU core equivalent and defaults
     to 0.05.
+
+    Memory "piggyness" is the proportional set size of a renderer in MiB
+    as given by /proc/<pid>/smaps_rollup (resident set size on older
+    kernels); the memory threshold defaults to 200 MiB.
+
+    --find-hogs and --disable-hogs score renderers on a weighted mix of
+    metrics: "cpu" (cores), "rss" (per GiB), "majflt" (per 100 major
+    faults a second) and "io" (per 10 MiB/s read or written), each
+    measured over "time_window".
+
+    With --on-pressure nothing is sampled until the kernel reports
+    that tasks have stalled for "psi_stall" milliseconds within a
+    "psi_window" (see /proc/pressure); the hogs are then found and
+    disabled as for --disable-cpu-hogs or --disable-memory-hogs.
+
+    With --duty-cycle each CPU hog is stopped and continued every
+    "duty_period" seconds so that it runs only for the fraction of the
+    time that brings its CPU use down to "target_share".
+
+    With --record the time, process ID, start time, CPU jiffies, RSS and
+    state of every renderer are appended to a fixed size ring file every
+    "time_window" seconds.  --replay finds CPU hogs in such a file using
+    "threshold", so that it can be tuned without a running browser.
+
+    With --daemon the sampling is repeated every "time_window" seconds.
+    Renderers above the threshold for "hog_windows" windows in a row are
+    stopped and are continued after "cooldown" seconds, or sooner when
+    the load average falls below "resume_load".
+
+    With --devtools the tabs of each renderer are fetched from a
+    remote debugging endpoint.  --find-cpu-hogs then shows their URLs,
+    and --enable and --disable accept shell-style patterns matched
+    against tab URLs and titles as well as process IDs.  Chromium's own
+    endpoint does not say which renderer shows a tab, so it has to be
+    reached through a DevTools proxy that adds the "processId" of each
+    target (or TabMapper given another resolve function).
 """
     
     (opts, args) = op.parse_args()
-    arg_pids = [parse_pid(arg) for arg in args]
+    arg_pids = []
+    url_patterns = []
+    for arg in args:
+        try:
+            arg_pids.append(parse_pid(arg))
+        except ValueError:
+            url_patterns.append(arg)
+    if not os.path.isdir(opts.proc_root):
+        op.error("--proc-root %s is not a directory." % opts.proc_root)
+    PROC_ROOT = opts.proc_root
+
+    if url_patterns and not opts.devtools:
+        op.error("URL patterns need --devtools.")
     
     if opts.enable == True and opts.disable == True:
         op.error("Cannot mix --disable and --enable options.")
     
     if opts.enable_all == True and opts.disable_all == True:
         op.error("Cannot mix --disable-all and --enable-all options.")
+
+    if opts.samples < 1:
+        op.error("--samples must be at least 1.")
+
+    if opts.export_port is not None:
+        modes = [opts.show_all, opts.enable, opts.disable, opts.enable_all,
+                 opts.disable_all, opts.find_cpu_hogs, opts.disable_cpu_hogs,
+                 opts.find_memory_hogs, opts.disable_memory_hogs,
+                 opts.find_hogs, opts.disable_hogs, opts.duty_cycle,
+                 opts.on_pressure, opts.record, opts.replay, args]
+        if any(modes):
+            op.error("--export-port can only be combined with --daemon.")
+
+    try:
+        weights = parse_weights(opts.weights)
+    except ValueError as e:
+        op.error("--weights: %s" % e)
     
-    pid_states = get_chromium_renderers()
-    avail_pids = [ps[0] for ps in pid_states]
+    def make_cache():
+        if opts.discovery == "tree":
+            return RendererTreeCache()
+        elif opts.discovery == "events":
+            return ProcessTracker(RendererTreeCache())
+        return None
+
+    cache = make_cache()
+
+    if opts.replay:
+        try:
+            recorder = StatsRecorder(opts.replay, create=False)
+        except (IOError, OSError, ValueError) as e:
+            print("Cannot replay %s: %s" % (opts.replay, e), file=sys.stderr)
+            sys.exit(5)
+        for timestamp, piggies in replay_cpu_piggies(recorder.records(),
+                opts.threshold, recorder.ticks_per_second):
+            if piggies:
+                print(time.strftime("%Y%m%d%H%M%S", time.localtime(timestamp)),
+                      piggies)
+        recorder.close()
+        sys.exit(0)
+
+    if opts.record:
+        try:
+            recorder = StatsRecorder(opts.record, opts.record_size)
+        except (IOError, OSError, ValueError) as e:
+            print("Cannot record to %s: %s" % (opts.record, e), file=sys.stderr)
+            sys.exit(5)
+        signal.signal(SIGTERM, lambda signum, frame: sys.exit(0))
+        # records hold jiffies, so CPU time comes from the stat file
+        monitor = RendererMonitor(cache, "stat")
+        ticks = 0
+        try:
+            while True:
+                if ticks % opts.rescan_interval == 0:
+                    snap = monitor.snapshot()
+                else:
+                    snap = monitor.snapshot(snap.pids)
+                ticks += 1
+                recorder.append(snap.records())
+                time.sleep(opts.time_window)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+        sys.exit(0)
+
+    if opts.backend == "signal":
+        throttler = SignalThrottle()
+    else:
+        throttler = CgroupThrottle(opts.cgroup_root, opts.cpu_quota,
+                                   opts.backend == "freeze",
+                                   origins_file=opts.cgroup_origins)
+        try:
+            throttler.setup()
+        except (IOError, OSError, ValueError) as e:
+            print("Cannot set up cgroup %s: %s" % (opts.cgroup_root, e),
+                  file=sys.stderr)
+            sys.exit(6)
+
+    if opts.export_port is not None:
+        # the exporter runs in its own threads, so has its own cache
+        exporter = MetricsExporter(make_cache() or RendererCache(), throttler,
+                                   opts.time_window, opts.export_address,
+                                   opts.export_port, opts.cpu_clock)
+        try:
+            exporter.start()
+        except (IOError, OSError) as e:
+            print("Cannot serve metrics on port %d: %s" %
+                  (opts.export_port, e), file=sys.stderr)
+            sys.exit(6)
+        if not opts.daemon:
+            signal.signal(SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+            sys.exit(0)
+
+    if opts.daemon:
+        def report(action, pid):
+            print(time.strftime("%Y%m%d%H%M%S"), action, pid)
+            sys.stdout.flush()
+
+        signal.signal(SIGTERM, lambda signum, frame: sys.exit(0))
+        daemon = ThrottleDaemon(cache or RendererCache(), opts.threshold,
+                                opts.hog_windows, opts.cooldown,
+                                opts.resume_load, opts.rescan_interval,
+                                throttler, cpu_clock=opts.cpu_clock)
+        try:
+            daemon.run(opts.time_window, report=report)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if opts.on_pressure:
+        if opts.disable_cpu_hogs:
+            resource = "cpu"
+            sampler = RendererMonitor(clock=opts.cpu_clock)
+            def find_piggies(pids):
+                return sampler.find_cpu_piggies(opts.time_window,
+                                                opts.threshold, opts.samples,
+                                                opts.ewma_alpha, pids=pids)
+        elif opts.disable_memory_hogs:
+            resource = "memory"
+            def find_piggies(pids):
+                return find_memory_piggies(pids, opts.memory_threshold)
+        else:
+            op.error("--on-pressure needs --disable-cpu-hogs or"
+                     " --disable-memory-hogs.")
+
+        def report(fired, piggies):
+            print(time.strftime("%Y%m%d%H%M%S"), ','.join(fired), piggies)
+            sys.stdout.flush()
+
+        signal.signal(SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            monitor = PressureMonitor([resource], int(opts.psi_stall*1000),
+                                      int(opts.psi_window*1000))
+        except (IOError, OSError) as e:
+            print("Cannot monitor %s pressure: %s" % (resource, e),
+                  file=sys.stderr)
+            sys.exit(6)
+        try:
+            throttle_on_pressure(monitor, find_piggies, cache or RendererCache(),
+                                 throttler, report=report)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    monitor = RendererMonitor(cache, opts.cpu_clock)
+    snap = monitor.snapshot()
+    pid_states = snap.pid_states()
+    avail_pids = list(snap.pids)
     if len(pid_states) == 0:
         print("No Chromium renderers found.", file=sys.stderr)
         sys.exit(4)
+
+    if opts.backend == "signal":
+        # pin the renderers found so that later signals cannot reach
+        # a process that has reused one of their process IDs
+        signaller = PidfdSignaller()
+        signaller.open(avail_pids, dict(zip(snap.pids, snap.start_times)))
+        throttler = SignalThrottle(signaller=signaller)
+
+    def pin_piggies(piggies):
+        # pin renderers first seen while sampling, as for those found
+        # at the start
+        if opts.backend == "signal":
+            snap = monitor.last
+            signaller.open([p[1] for p in piggies if p[1] not in signaller.fds],
+                           dict(zip(snap.pids, snap.start_times)))
+
+    def report_outcomes(outcomes):
+        for pid in sorted(outcomes):
+            if outcomes[pid] != "ok":
+                print("%d: %s" % (pid, outcomes[pid]), file=sys.stderr)
     
     if opts.show_all:
         print(' '.join(["%s%s" % ps for ps in pid_states]))
     
+    if opts.devtools:
+        mapper = TabMapper(opts.devtools)
+        try:
+            mapper.refresh()
+        except (IOError, OSError, ValueError) as e:
+            print("Cannot read tabs from %s: %s" % (opts.devtools, e),
+                  file=sys.stderr)
+            sys.exit(7)
+        if mapper.unresolved():
+            print("The tabs from %s have no renderer process IDs; a DevTools"
+                  " proxy that adds \"processId\" to each target is needed."
+                  % opts.devtools, file=sys.stderr)
+            sys.exit(7)
+
     if opts.enable or opts.disable:
+        for pattern in url_patterns:
+            matched = mapper.match([pattern], avail_pids)
+            if len(matched) == 0:
+                print("No renderer shows a tab matching %s." % pattern,
+                      file=sys.stderr)
+                sys.exit(3)
+            arg_pids.extend(pid for pid in matched if pid not in arg_pids)
         if len(arg_pids) == 0:
             print("No process IDs specified.", file=sys.stderr)
             sys.exit(5)
@@ -217,26 +2553,74 @@ if __name__ == '__main__':
                   file=sys.stderr)
             sys.exit(3)
         if opts.enable:
-            sig = SIGCONT
+            report_outcomes(throttler.enable_many(arg_pids))
         else:
-            sig = SIGSTOP
-        for pid in arg_pids:
-            os.kill(pid, sig)
+            report_outcomes(throttler.disable_many(arg_pids))
             
     elif opts.enable_all or opts.disable_all:
         if opts.enable_all:
-            sig = SIGCONT
+            report_outcomes(throttler.enable_many(avail_pids))
         else:
-            sig = SIGSTOP
-        for pid in avail_pids:
-            os.kill(pid, sig)
+            report_outcomes(throttler.disable_many(avail_pids))
 
     elif opts.find_cpu_hogs:
-        print(find_cpu_piggies(avail_pids, opts.time_window, opts.threshold))
+        piggies = monitor.find_cpu_piggies(opts.time_window, opts.threshold,
+                                           opts.samples, opts.ewma_alpha)
+        print(piggies)
+        if opts.devtools:
+            for share, pid in piggies:
+                print("%d %.3f %s" % (pid, share, mapper.url(pid)))
+        if opts.threads > 0:
+            for share, pid, threads in find_thread_hogs(piggies,
+                    opts.time_window, opts.threads):
+                print("%d %.3f" % (pid, share))
+                for thread in threads:
+                    print("    %d %.3f %s" % (thread[1], thread[0], thread[2]))
 
     elif opts.disable_cpu_hogs:
         # list of (piggyness, processID)
-        piggies = find_cpu_piggies(avail_pids, opts.time_window, opts.threshold)
-        for piggy in piggies:
-            os.kill(piggy[1], SIGSTOP)
+        piggies = monitor.find_cpu_piggies(opts.time_window, opts.threshold,
+                                           opts.samples, opts.ewma_alpha)
+        pin_piggies(piggies)
+        report_outcomes(throttler.disable_many([p[1] for p in piggies]))
+
+    elif opts.find_hogs or opts.disable_hogs:
+        scorer = HogScorer(weights)
+        # list of (score, processID)
+        piggies = scorer.find_piggies(avail_pids, opts.time_window,
+                                      opts.score_threshold)
+        if opts.find_hogs:
+            print(piggies)
+            for piggy in piggies:
+                metrics = scorer.metrics[piggy[1]]
+                print("%d %s" % (piggy[1], ' '.join(["%s=%g" % (k, metrics[k])
+                                                     for k in sorted(metrics)])))
+        else:
+            report_outcomes(throttler.disable_many([p[1] for p in piggies]))
+        if opts.show_costs:
+            for name in sorted(scorer.costs):
+                print("%s: %.6f s" % (name, scorer.costs[name]), file=sys.stderr)
+
+    elif opts.duty_cycle:
+        # list of (piggyness, processID)
+        piggies = monitor.find_cpu_piggies(opts.time_window, opts.threshold,
+                                           opts.samples, opts.ewma_alpha)
+        pin_piggies(piggies)
+        target = opts.target_share or opts.threshold
+        scheduler = DutyCycleScheduler(opts.duty_period, throttler=throttler)
+        for share, pid in piggies:
+            scheduler.set_duty(pid, duty_for_share(share, target))
+        signal.signal(SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            scheduler.run(opts.duration)
+        except KeyboardInterrupt:
+            pass
+
+    elif opts.find_memory_hogs:
+        print(find_memory_piggies(avail_pids, opts.memory_threshold))
+
+    elif opts.disable_memory_hogs:
+        # list of (MiB, processID)
+        piggies = find_memory_piggies(avail_pids, opts.memory_threshold)
+        report_outcomes(throttler.disable_many([p[1] for p in piggies]))
 
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+Build a fake /proc tree on disk for testing and benchmarking chrome_throttle.
+
+The tree is written below a directory on tmpfs (/dev/shm where it
+exists) and is used by pointing chrome_throttle.PROC_ROOT at it.
+Unlike the mocks in test_chrome_throttle it goes through the real
+open() and os.listdir(), so it also shows the cost of the system calls.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+
+TMPFS = "/dev/shm"
+
+CR_BROWSER = "/usr/lib/chromium/chromium"
+
+CMDLINES = {
+    "browser":  [CR_BROWSER, "--password-store=detect"],
+    "zygote":   [CR_BROWSER, "--type=zygote"],
+    "renderer": [CR_BROWSER, "--type=renderer", "--lang=en-US"],
+    "gpu":      [CR_BROWSER, "--type=gpu-process"],
+    "other":    ["/bin/bash"],
+}
+
+STATES = {'R': "running", 'S': "sleeping", 'T': "stopped",
+          'D': "disk sleep", 'Z': "zombie"}
+
+class FakeProc(object):
+    """One process of a FakeProcTree."""
+
+    def __init__(self, pid, kind, ppid, start_time, rss_pages):
+        self.pid = pid
+        self.kind = kind
+        self.ppid = ppid
+        self.start_time = start_time
+        self.state = 'S'
+        self.args = CMDLINES[kind]
+        if kind == "other":
+            self.name = "bash"
+        else:
+            self.name = "chromium"
+        self.utime = 0
+        self.stime = 0
+        self.runtime_ns = 0
+        self.maj_flt = 0
+        self.rss_pages = rss_pages
+        self.children = []
+
+    def use_cpu(self, seconds, hz):
+        self.runtime_ns += int(seconds * 1e9)
+        jiffies = int(self.runtime_ns * hz / 1e9)
+        self.stime = jiffies // 10
+        self.utime = jiffies - self.stime
+
+    def stat_file(self):
+        flds = [0] * 49
+        flds[3-3] = self.ppid
+        flds[4-3] = self.pid
+        flds[5-3] = self.pid
+        flds[11-3] = self.maj_flt
+        flds[13-3] = self.utime
+        flds[14-3] = self.stime
+        flds[17-3] = 20
+        flds[19-3] = 1
+        flds[21-3] = self.start_time
+        flds[22-3] = self.rss_pages * 4 * 4096
+        flds[23-3] = self.rss_pages
+        return "%d (%s) %s %s\n" % (self.pid, self.name, self.state,
+                                    ' '.join(map(str, flds)))
+
+    def status_file(self):
+        return ("Name:\t%s\nUmask:\t0022\nState:\t%s (%s)\nTgid:\t%d\n"
+                "Ngid:\t0\nPid:\t%d\nPPid:\t%d\nThreads:\t1\n") % (
+                self.name, self.state, STATES[self.state], self.pid,
+                self.pid, self.ppid)
+
+    def statm_file(self):
+        return "%d %d %d 0 0 %d 0\n" % (self.rss_pages * 4, self.rss_pages,
+                                        self.rss_pages // 4,
+                                        self.rss_pages // 2)
+
+    def schedstat_file(self):
+        return "%d 0 %d\n" % (self.runtime_ns, self.runtime_ns // 1000000)
+
+    def cmdline_file(self):
+        if self.name == "chromium":
+            # Chromium rewrites its argument area as one string
+            return ' '.join(self.args) + '\0'
+        return '\0'.join(self.args) + '\0'
+
+    def children_file(self):
+        return ''.join("%d " % c for c in self.children)
+
+class FakeProcTree(object):
+    """A fake /proc of N_PROCS processes, N_RENDERERS of them renderers.
+
+    The Chromium processes form a browser -> zygote -> renderer tree
+    as on a real desktop, the rest are children of init.  advance()
+    lets time pass: the renderers (and a few of the other processes)
+    use CPU time and memory, and their stat, statm and schedstat files
+    are rewritten.  Call cleanup() to remove the tree.
+    """
+
+    def __init__(self, n_procs=10000, n_renderers=300, root=None, seed=0,
+                 hz=100):
+        if root is None:
+            root = tempfile.mkdtemp(prefix="proc.",
+                                    dir=TMPFS if os.path.isdir(TMPFS) else None)
+        self.root = root
+        self.hz = hz
+        self.random = random.Random(seed)
+        self.procs = {}
+        self.building = True
+        self.next_pid = 300
+        self.uptime = int(1000 * hz)
+        for name in ("uptime", "loadavg", "meminfo"):
+            with open(os.path.join(root, name), "w") as f:
+                f.write("0\n")
+
+        init = self.add("other", 0)
+        browser = self.add("browser", init.pid)
+        zygote = self.add("zygote", browser.pid)
+        self.add("gpu", browser.pid)
+        self.zygote = zygote.pid
+        for i in range(n_renderers):
+            self.add("renderer", zygote.pid)
+        while len(self.procs) < n_procs:
+            self.add("other", init.pid)
+        self.building = False
+        for proc in self.procs.values():
+            if proc.children:
+                self.write(proc, "children")
+
+    def add(self, kind, ppid):
+        """Start a new process of KIND and return it."""
+
+        pid = self.next_pid
+        self.next_pid += self.random.randint(1, 3)
+        self.uptime += 1
+        proc = FakeProc(pid, kind, ppid, self.uptime,
+                        self.random.randint(500, 50000))
+        self.procs[pid] = proc
+        if ppid in self.procs:
+            self.procs[ppid].children.append(pid)
+            if not self.building:
+                self.write(self.procs[ppid], "children")
+        os.makedirs(os.path.join(self.root, str(pid), "task", str(pid)))
+        self.write(proc, "stat", "status", "statm", "schedstat", "cmdline",
+                   "children")
+        return proc
+
+    def remove(self, pid):
+        """Make process PID exit."""
+
+        proc = self.procs.pop(pid)
+        if proc.ppid in self.procs:
+            self.procs[proc.ppid].children.remove(pid)
+            self.write(self.procs[proc.ppid], "children")
+        shutil.rmtree(os.path.join(self.root, str(pid)))
+
+    def write(self, proc, *names):
+        pdir = os.path.join(self.root, str(proc.pid))
+        for name in names:
+            if name == "children":
+                path = os.path.join(pdir, "task", str(proc.pid), name)
+            else:
+                path = os.path.join(pdir, name)
+            with open(path, "w") as f:
+                f.write(getattr(proc, name + "_file")())
+
+    def renderers(self):
+        return sorted(pid for pid, proc in self.procs.items()
+                      if proc.kind == "renderer")
+
+    def advance(self, seconds, busy=()):
+        """Let SECONDS pass.
+
+        The renderers in BUSY use a whole CPU, the other renderers
+        up to a tenth of one, and one in a hundred of the remaining
+        processes a little.
+        """
+
+        busy = set(busy)
+        rand = self.random
+        self.uptime += int(seconds * self.hz)
+        for proc in self.procs.values():
+            if proc.kind == "renderer":
+                if proc.pid in busy:
+                    share = 1.0
+                else:
+                    share = rand.uniform(0.0, 0.1)
+                proc.rss_pages += rand.randint(0, 64)
+                proc.maj_flt += rand.randint(0, 2)
+            elif rand.random() < 0.01:
+                share = rand.uniform(0.0, 0.05)
+            else:
+                continue
+            proc.use_cpu(share * seconds, self.hz)
+            proc.state = 'R' if share > 0.5 else 'S'
+            self.write(proc, "stat", "status", "statm", "schedstat")
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -3,8 +3,74 @@
 import unittest
 import sys
 import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import datetime
+import json
 
-from ..chrome_lib import CrTimeStamp
+from ..chrome_lib import CrTimeStamp, CrHistory, OrderSpecificationError, \
+     make_row_formatter, format_header, HISTORY_COLUMNS, snapshot_history, \
+     ResultCache, SinceState, merge_visits, iter_visits_in_thread, \
+     STATS_REPORTS, visit_stats_of_files, url_base, _sql_url_base
+
+SCHEMA = """
+CREATE TABLE urls(id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR,
+    visit_count INTEGER DEFAULT 0 NOT NULL,
+    typed_count INTEGER DEFAULT 0 NOT NULL,
+    last_visit_time INTEGER NOT NULL, hidden INTEGER DEFAULT 0 NOT NULL);
+CREATE TABLE visits(id INTEGER PRIMARY KEY, url INTEGER NOT NULL,
+    visit_time INTEGER NOT NULL, from_visit INTEGER,
+    transition INTEGER DEFAULT 0 NOT NULL, segment_id INTEGER,
+    visit_duration INTEGER DEFAULT 0 NOT NULL);
+CREATE INDEX visits_time_index ON visits (visit_time);
+"""
+
+T2015 = int(CrTimeStamp.parse_tstamp("2015"))
+HOUR = 3600 * 1000000
+
+def make_history(fname, n_urls=20, visits_per_url=3, start=T2015,
+                 untitled=()):
+    """Create a History database with N_URLS URLs on a few hosts.
+
+    URL i is visited VISITS_PER_URL times, an hour apart, starting
+    i hours after START.  The URLs in UNTITLED have no title.
+    """
+
+    conn = sqlite3.connect(fname)
+    conn.executescript(SCHEMA)
+    visit_id = 1
+    for i in range(1, n_urls+1):
+        times = [start + (i + n_urls*j) * HOUR for j in range(visits_per_url)]
+        title = None if i in untitled else u"Page \u00e9 %d" % i
+        conn.execute("insert into urls values (?,?,?,?,0,?,0)",
+                     (i, "https://host%d.example.com/page/%d" % (i % 3, i),
+                      title, visits_per_url, times[-1]))
+        for t in times:
+            conn.execute("insert into visits (id, url, visit_time, from_visit)"
+                         " values (?,?,?,0)", (visit_id, i, t))
+            visit_id += 1
+    conn.commit()
+    conn.close()
+
+HISTORY_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+                              os.path.abspath(__file__))), "chrome_history.py")
+
+def run_history(*args, **kwargs):
+    """Run chrome_history.py with ARGS and return its output lines.
+
+    The result cache is not used unless CACHE_DIR is given.
+    """
+
+    cache_dir = kwargs.get("cache_dir")
+    if cache_dir is None:
+        args = ("--no-cache",) + args
+    else:
+        args = ("--cache-dir", cache_dir) + args
+    out = subprocess.check_output([sys.executable, HISTORY_SCRIPT] +
+                                  list(args))
+    return out.decode("utf-8").splitlines()
 
 class ChromeHistoryTest(unittest.TestCase):
    
@@ -47,6 +113,16 @@ class ChromeHistoryTest(unittest.TestCase):
                  CrTimeStamp.parse_tstamp("1601"),
                  CrTimeStamp.parse_tstamp("16010101000000"))
 
+    def test_CrTimeStamp_fmt(self):
+        for ts in (0, 1, 999999, 1000000, 86399999999, T2015 + 12345678901,
+                   13080000000000000.6):
+            t = CrTimeStamp.epoch + datetime.timedelta(microseconds=ts)
+            self.assertEqual(CrTimeStamp.fmt_tstamp(ts),
+                             t.strftime("%Y%m%d%H%M%S"))
+        self.assertEqual(CrTimeStamp.fmt_tstamp(
+                         CrTimeStamp.parse_tstamp("20150628212001")),
+                         "20150628212001")
+
     def test_CrTimeStamp_diff_one_year(self):
         self.assertEqual(
                  CrTimeStamp.parse_tstamp("2015") -
@@ -55,6 +131,557 @@ class ChromeHistoryTest(unittest.TestCase):
 
 
 
+class RowFormatterTest(unittest.TestCase):
+
+    visit = (3, 1, T2015 + HOUR, 0, "https://a.example.com/x?q=1",
+             u'Say "hi",\tall', 2, T2015, 0)
+
+    def test_space(self):
+        fmt = make_row_formatter(["visit_id", "visit_time", "urlbase",
+                                  "visit_count"])
+        self.assertEqual(fmt(self.visit),
+                         "3 20150101010000 https://a.example.com/ 2 \n")
+        fmt = make_row_formatter(["visit_time"], raw_times=True)
+        self.assertEqual(fmt(self.visit), "%d \n" % (T2015 + HOUR))
+        self.assertEqual(make_row_formatter([])(self.visit),
+                         "%s " % (self.visit,))
+
+    def test_csv(self):
+        columns = ["visit_id", "title", "url"]
+        self.assertEqual(format_header(columns, "csv"), "visit_id,title,url\n")
+        self.assertEqual(make_row_formatter(columns, "csv")(self.visit),
+                         u'3,"Say ""hi"",\tall",https://a.example.com/x?q=1\n')
+
+    def test_tsv(self):
+        columns = ["visit_id", "title"]
+        self.assertEqual(format_header(columns, "tsv"), "visit_id\ttitle\n")
+        self.assertEqual(make_row_formatter(columns, "tsv")(self.visit),
+                         u'3\tSay "hi", all\n')
+
+    def test_jsonl(self):
+        columns = [c[0] for c in HISTORY_COLUMNS]
+        self.assertEqual(format_header(columns, "jsonl"), "")
+        row = json.loads(make_row_formatter(columns, "jsonl")(self.visit))
+        self.assertEqual(row["title"], self.visit[5])
+        self.assertEqual(row["visit_time"], "20150101010000")
+        self.assertEqual(row["last_visit_time"], "20150101000000")
+        self.assertEqual(sorted(row), sorted(columns))
+        row = json.loads(make_row_formatter([], "jsonl")(self.visit))
+        self.assertEqual(row["visits.id"], 3)
+        self.assertEqual(len(row), len(CrHistory.FIELDS))
+
+    def test_columns_match_fields(self):
+        fields = [f.split(".")[-1] for f in CrHistory.FIELDS]
+        fields[0:2] = ["visit_id", "url_id"]
+        for name, expr, is_time in HISTORY_COLUMNS:
+            if expr.startswith("v["):
+                self.assertEqual(fields[int(expr[2:-1])], name)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            make_row_formatter([], "xml")
+
+class HistoryQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "History")
+        make_history(self.fname)
+        self.crh = CrHistory(self.fname)
+
+    def tearDown(self):
+        self.crh.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_matches_fetchall(self):
+        orderings = ["visit_time desc"]
+        filters = ["visit_time>%d" % (T2015 + 10*HOUR)]
+        for batch_size in (1, 7, 1000):
+            self.assertEqual(list(self.crh.iter_url_visits(filters, orderings,
+                                  batch_size=batch_size)),
+                             self.crh.geturl_visits(filters, orderings))
+
+    def test_limit_offset(self):
+        orderings = ["visits.id"]
+        visits = self.crh.geturl_visits([], orderings)
+        self.assertEqual(len(visits), 60)
+        self.assertEqual(list(self.crh.iter_url_visits([], orderings, 5)),
+                         visits[:5])
+        self.assertEqual(list(self.crh.iter_url_visits([], orderings, 5, 10)),
+                         visits[10:15])
+        self.assertEqual(list(self.crh.iter_url_visits([], orderings,
+                                                       offset=55)),
+                         visits[55:])
+
+    def test_limit_in_sql(self):
+        statements = []
+        self.crh.conn.set_trace_callback(statements.append)
+        list(self.crh.iter_url_visits([], ["visits.id"], 5, 10))
+        self.assertTrue(statements[-1].endswith(" limit 5 offset 10"))
+
+    def test_bad_ordering_raised_on_call(self):
+        with self.assertRaises(OrderSpecificationError):
+            self.crh.iter_url_visits([], ["nonesuch"])
+
+    def test_script_limit_offset(self):
+        lines = run_history("--show-visit-id", "--order-by", "visits.id",
+                            "--limit", "3", "--offset", "2",
+                            "--batch-size", "2", self.fname)
+        self.assertEqual(lines, ["3 ", "4 ", "5 "])
+
+    def test_script_formats(self):
+        args = ["--show-visit-id", "--show-title", "--order-by", "visits.id",
+                "--limit", "2"]
+        self.assertEqual(run_history(*(args + [self.fname])),
+                         [u"1 Page \u00e9 1 ", u"2 Page \u00e9 1 "])
+        self.assertEqual(run_history(*(["--format", "csv"] + args +
+                                       [self.fname])),
+                         ["visit_id,title", u"1,Page \u00e9 1",
+                          u"2,Page \u00e9 1"])
+        lines = run_history(*(["--format", "jsonl"] + args + [self.fname]))
+        self.assertEqual(json.loads(lines[1]),
+                         {"visit_id": 2, "title": u"Page \u00e9 1"})
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "History")
+        make_history(self.fname)
+        self.visits = CrHistory(self.fname).geturl_visits([], ["visits.id"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_memory_copy(self):
+        mtime = os.stat(self.fname).st_mtime
+        crh = CrHistory(self.fname, ":memory:")
+        self.assertEqual(crh.geturl_visits([], ["visits.id"]), self.visits)
+        crh.conn.execute("delete from visits")
+        crh.conn.commit()
+        self.assertEqual(CrHistory(self.fname).geturl_visits([], []),
+                         self.visits)
+        self.assertEqual(os.stat(self.fname).st_mtime, mtime)
+
+    def test_file_copy(self):
+        copy = os.path.join(self.tmpdir, "copy")
+        snapshot_history(self.fname, copy, pages=1).close()
+        self.assertEqual(CrHistory(copy).geturl_visits([], ["visits.id"]),
+                         self.visits)
+
+    def test_writer_active(self):
+        writer = sqlite3.connect(self.fname)
+        writer.execute("begin immediate")
+        writer.execute("delete from visits")
+        conn = snapshot_history(self.fname, pages=1)
+        self.assertEqual(conn.execute("select count(*) from visits")
+                         .fetchone()[0], 60)
+        writer.rollback()
+        writer.close()
+
+    def test_locked_by_browser(self):
+        browser = sqlite3.connect(self.fname)
+        browser.execute("pragma locking_mode=exclusive")
+        browser.execute("delete from visits where id > 50")
+        browser.commit()
+        with self.assertRaises(sqlite3.OperationalError):
+            sqlite3.connect(self.fname, timeout=0.1).execute(
+                "select count(*) from visits").fetchone()
+        conn = snapshot_history(self.fname, timeout=0.1)
+        self.assertEqual(conn.execute("select count(*) from visits")
+                         .fetchone()[0], 50)
+        browser.close()
+
+    def test_script_snapshot(self):
+        args = ["--show-visit-id", "--show-url", "--order-by", "visits.id"]
+        self.assertEqual(run_history(*(["--snapshot"] + args + [self.fname])),
+                         run_history(*(args + [self.fname])))
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "History")
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        make_history(self.fname)
+        self.crh = CrHistory(self.fname)
+        self.cache = ResultCache(self.cache_dir, batch_size=7)
+        self.orderings = ["last_visit_time desc", "visits.id"]
+        self.filters = ["visit_time>%d" % T2015]
+
+    def tearDown(self):
+        self.crh.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def query(self):
+        return self.crh.iter_url_visits(self.filters, self.orderings)
+
+    def test_round_trip(self):
+        key = self.cache.key(self.fname, self.filters, self.orderings)
+        self.assertIsNone(self.cache.get(key))
+        expected = list(self.query())
+        self.assertEqual(list(self.cache.put(key, self.query())), expected)
+        self.assertEqual(list(self.cache.get(key)), expected)
+
+    def test_partial_read_not_stored(self):
+        key = self.cache.key(self.fname, self.filters, self.orderings)
+        rows = self.cache.put(key, self.query())
+        next(rows)
+        rows.close()
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_too_large_not_stored(self):
+        key = self.cache.key(self.fname, self.filters, self.orderings)
+        self.cache.max_bytes = 100
+        expected = list(self.query())
+        rows = self.cache.put(key, self.query())
+        next(rows)
+        # writing stopped with the first batch, long before the end
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual([expected[0]] + list(rows), expected)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_key(self):
+        key = self.cache.key(self.fname, self.filters, self.orderings)
+        self.assertEqual(key, self.cache.key(self.fname,
+                         [" VISIT_TIME>%d" % T2015],
+                         ["last_visit_time  DESC", "visits.id"]))
+        self.assertNotEqual(key, self.cache.key(self.fname, self.filters,
+                                                self.orderings[::-1]))
+        self.assertNotEqual(key, self.cache.key(self.fname, self.filters,
+                                                self.orderings, limit=5))
+        self.assertNotEqual(key, self.cache.key(self.fname, [],
+                                                self.orderings))
+        self.crh.conn.execute("delete from visits where id = 1")
+        self.crh.conn.commit()
+        os.utime(self.fname, (0, 0))
+        self.assertNotEqual(key, self.cache.key(self.fname, self.filters,
+                                                self.orderings))
+
+    def test_lru_eviction(self):
+        keys = []
+        for limit in (10, 20, 30):
+            key = self.cache.key(self.fname, [], ["visits.id"], limit)
+            list(self.cache.put(key, self.crh.iter_url_visits([],
+                                ["visits.id"], limit)))
+            keys.append(key)
+        sizes = [os.path.getsize(self.cache.path(k)) for k in keys]
+        os.utime(self.cache.path(keys[0]), (1000, 1000))
+        os.utime(self.cache.path(keys[1]), (3000, 3000))
+        os.utime(self.cache.path(keys[2]), (2000, 2000))
+        self.cache.max_bytes = sizes[1] + sizes[2]
+        self.cache.evict()
+        self.assertEqual([os.path.exists(self.cache.path(k)) for k in keys],
+                         [False, True, True])
+        self.cache.max_bytes = sizes[1]
+        self.cache.evict()
+        self.assertEqual([os.path.exists(self.cache.path(k)) for k in keys],
+                         [False, True, False])
+        # reading a result makes it the most recently used
+        list(self.cache.get(keys[1]))
+        self.assertGreater(os.path.getmtime(self.cache.path(keys[1])), 3000)
+
+    def test_unwritable_cache_dir(self):
+        cache = ResultCache(os.path.join(self.fname, "cache"))
+        key = cache.key(self.fname, [], [])
+        self.assertEqual(len(list(cache.put(key, self.query()))), 60)
+
+    def test_script_uses_cache(self):
+        args = ["--show-visit-id", "--show-title", "--order-by", "visits.id",
+                self.fname]
+        expected = run_history(*args)
+        self.assertEqual(run_history(*args, cache_dir=self.cache_dir),
+                         expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # a cache hit does not open the history file: spoil it, keeping
+        # its inode, size and modification time
+        st = os.stat(self.fname)
+        with open(self.fname, "r+b") as f:
+            f.write(b"\0" * st.st_size)
+        os.utime(self.fname, (st.st_atime, st.st_mtime))
+        self.assertEqual(run_history(*args, cache_dir=self.cache_dir),
+                         expected)
+
+class SinceStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "History")
+        self.state_file = os.path.join(self.tmpdir, "state")
+        make_history(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_visits(self, n):
+        conn = sqlite3.connect(self.fname)
+        for i in range(n):
+            conn.execute("insert into visits (url, visit_time, from_visit)"
+                         " values (1, ?, 0)", (T2015 + (1000+i) * HOUR,))
+        conn.commit()
+        conn.close()
+
+    def test_state(self):
+        state = SinceState(self.state_file, self.fname)
+        self.assertEqual(state.filters(), [])
+        crh = CrHistory(self.fname)
+        self.assertEqual(len(list(state.track(crh.iter_url_visits(
+                         state.filters(), ["visit_time"])))), 60)
+        state.save()
+        crh.conn.close()
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {os.path.abspath(self.fname): 60})
+        state = SinceState(self.state_file, self.fname)
+        self.assertEqual(state.filters(), ["visits.id>60"])
+        other = SinceState(self.state_file, self.fname + "2")
+        self.assertEqual(other.filters(), [])
+
+    def test_uses_primary_key(self):
+        crh = CrHistory(self.fname)
+        stmt, params = crh._visits_stmt(["visits.id>60"], ["visits.id"])
+        plan = ' '.join(str(row[-1]) for row in
+                        crh.conn.execute("explain query plan " + stmt, params))
+        crh.conn.close()
+        self.assertIn("INTEGER PRIMARY KEY", plan)
+
+    def test_bad_state_file(self):
+        for text in ("[]", '{"%s": "abc"}' % self.fname,
+                     '{"other": 1.5}', '{"other": true}', "{"):
+            with open(self.state_file, "w") as f:
+                f.write(text)
+            with self.assertRaises(ValueError):
+                SinceState(self.state_file, self.fname)
+
+    def test_script_bad_state_file(self):
+        with open(self.state_file, "w") as f:
+            json.dump({os.path.abspath(self.fname): "abc"}, f)
+        p = subprocess.Popen([sys.executable, HISTORY_SCRIPT, "--no-cache",
+                              "--since-state", self.state_file, self.fname],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 8)
+        self.assertIn(b"bad visit ID", err)
+
+    def test_script_incremental(self):
+        args = ["--format", "csv", "--show-visit-id", "--since-state",
+                self.state_file, self.fname]
+        lines = run_history(*args)
+        self.assertEqual(lines[0], "visit_id")
+        self.assertEqual(lines[1:], [str(i) for i in range(1, 61)])
+        self.assertEqual(run_history(*args), [])
+        self.add_visits(3)
+        self.assertEqual(run_history(*args), ["61", "62", "63"])
+        self.assertEqual(run_history(*args), [])
+
+    def test_script_not_cached(self):
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        args = ["--show-visit-id", "--since-state", self.state_file,
+                self.fname]
+        self.assertEqual(len(run_history(*args, cache_dir=cache_dir)), 60)
+        self.assertFalse(os.path.exists(cache_dir))
+
+    def test_script_incremental_limit(self):
+        args = ["--show-visit-id", "--limit", "25", "--since-state",
+                self.state_file, self.fname]
+        seen = []
+        for i in range(3):
+            seen.extend(run_history(*args))
+        self.assertEqual(seen, ["%d " % i for i in range(1, 61)])
+
+class MultiFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fnames = []
+        for i, untitled in enumerate([(2, 5), (), (7,)]):
+            fname = os.path.join(self.tmpdir, "History%d" % i)
+            make_history(fname, 10 + 5*i, 2, T2015 + i * HOUR // 3, untitled)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_merge(self, orderings):
+        streams = [iter_visits_in_thread(fname, [], orderings, batch_size=4)
+                   for fname in self.fnames]
+        merged = list(merge_visits(streams, orderings))
+        key_fields = [CrHistory.FIELDS.index(o.split()[0]) for o in orderings]
+        def keys(rows):
+            return [tuple(row[i] for i in key_fields) for row in rows]
+        expected = []
+        for fname in self.fnames:
+            crh = CrHistory(fname)
+            expected.extend(crh.geturl_visits([], []))
+            crh.conn.close()
+        self.assertEqual(sorted(merged), sorted(expected))
+        sql = sqlite3.connect(":memory:")
+        sql.execute("create table v (%s)" % ','.join("f%d" % i for i in
+                                                     range(len(expected[0]))))
+        sql.executemany("insert into v values (%s)" %
+                        ','.join('?' * len(expected[0])), expected)
+        order = ','.join(o.replace(o.split()[0], "f%d" %
+                                   CrHistory.FIELDS.index(o.split()[0]))
+                         for o in orderings)
+        self.assertEqual(keys(merged),
+                         keys(sql.execute("select * from v order by " +
+                                          order).fetchall()))
+
+    def test_merge_time_desc(self):
+        self.check_merge(["visit_time desc"])
+        self.check_merge(["title desc", "visit_time desc"])
+
+    def test_merge_mixed_directions_and_nulls(self):
+        self.check_merge(["title", "visit_time desc"])
+        self.check_merge(["title desc", "visits.id"])
+
+    def test_merge_unordered(self):
+        streams = [iter([(1,), (3,)]), iter([(2,)])]
+        self.assertEqual(list(merge_visits(streams, [])), [(1,), (3,), (2,)])
+
+    def test_merge_bad_field(self):
+        with self.assertRaises(OrderSpecificationError):
+            merge_visits([], ["urls.title desc"])
+
+    def test_thread_error(self):
+        fname = os.path.join(self.tmpdir, "empty")
+        with open(fname, "w") as f:
+            f.write("not a database")
+        rows = iter_visits_in_thread(fname, [], [])
+        with self.assertRaises(sqlite3.DatabaseError):
+            list(rows)
+
+    def test_script(self):
+        args = ["--show-visit-time", "--show-title", "--report-raw-times",
+                "--order-by", "visit_time desc"]
+        lines = run_history(*(args + self.fnames))
+        self.assertEqual(len(lines), 2*10 + 2*15 + 2*20)
+        times = [int(line.split()[0]) for line in lines]
+        self.assertEqual(times, sorted(times, reverse=True))
+        self.assertEqual(run_history(*(args + ["--limit", "7", "--offset",
+                                               "5"] + self.fnames)),
+                         lines[5:12])
+
+    def test_script_snapshot_file(self):
+        snap = os.path.join(self.tmpdir, "snap.db")
+        args = ["--show-visit-id", "--show-url", "--order-by", "visits.id"]
+        expected = run_history(*(args + self.fnames))
+        for i in range(3):
+            self.assertEqual(run_history(*(args + ["--snapshot-file", snap] +
+                                           self.fnames)), expected)
+        self.assertEqual(sorted(n for n in os.listdir(self.tmpdir)
+                                if n.startswith("snap")),
+                         ["snap.db.0", "snap.db.1", "snap.db.2"])
+        self.assertEqual(run_history("--stats", "host", "--snapshot-file",
+                                     snap, *self.fnames),
+                         run_history("--stats", "host", *self.fnames))
+
+    def test_script_since_state(self):
+        state = os.path.join(self.tmpdir, "state")
+        args = ["--show-visit-id", "--since-state", state] + self.fnames
+        self.assertEqual(len(run_history(*args)), 90)
+        self.assertEqual(run_history(*args), [])
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fnames = []
+        for i in range(2):
+            fname = os.path.join(self.tmpdir, "History%d" % i)
+            make_history(fname, 30, 3, T2015 + i * 40 * HOUR, (4, 9))
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def expected(self, report, fnames, filters=()):
+        """Count the visits of REPORT in Python, from all the rows."""
+
+        counts = {}
+        for fname in fnames:
+            crh = CrHistory(fname)
+            for v in crh.geturl_visits(list(filters), []):
+                t = CrTimeStamp.epoch + \
+                    datetime.timedelta(microseconds=v[2])
+                group = {"host": url_base(v[4]),
+                         "day": t.strftime("%Y%m%d"),
+                         "hour-of-week": t.strftime("%a %H"),
+                         "title": v[5]}[report]
+                counts[group] = counts.get(group, 0) + 1
+            crh.conn.close()
+        return counts
+
+    def test_reports(self):
+        for report in STATS_REPORTS:
+            crh = CrHistory(self.fnames[0])
+            rows = crh.visit_stats(report, [])
+            crh.conn.close()
+            self.assertEqual(dict(rows), self.expected(report, self.fnames[:1]))
+
+    def test_order(self):
+        rows = visit_stats_of_files(self.fnames[:1], "host", [])
+        counts = [visits for group, visits in rows]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        rows = visit_stats_of_files(self.fnames[:1], "day", [])
+        self.assertEqual(rows, sorted(rows))
+        rows = visit_stats_of_files(self.fnames[:1], "hour-of-week", [])
+        self.assertEqual(len(rows), 90)
+        # 2015-01-01 was a Thursday
+        self.assertEqual([r[0] for r in rows[:3]],
+                         ["Sun 00", "Sun 01", "Sun 02"])
+        self.assertEqual(rows[-1][0], "Sat 23")
+
+    def test_several_files(self):
+        for report in STATS_REPORTS:
+            rows = visit_stats_of_files(self.fnames, report, [])
+            self.assertEqual(dict(rows), self.expected(report, self.fnames))
+            # the same order as one file holding all the visits
+            merged = os.path.join(self.tmpdir, "merged-" + report)
+            conn = sqlite3.connect(merged)
+            conn.executescript(SCHEMA)
+            for i, fname in enumerate(self.fnames):
+                conn.execute("attach ? as h", (fname,))
+                conn.execute("insert into urls select id + %d, url, title,"
+                             " visit_count, typed_count, last_visit_time,"
+                             " hidden from h.urls" % (i * 1000))
+                conn.execute("insert into visits (url, visit_time)"
+                             " select url + %d, visit_time from h.visits" %
+                             (i * 1000))
+                conn.commit()
+                conn.execute("detach h")
+            conn.close()
+            self.assertEqual(rows, visit_stats_of_files([merged], report, []))
+
+    def test_filters(self):
+        after = "visit_time>%d" % (T2015 + 50 * HOUR)
+        rows = visit_stats_of_files(self.fnames, "day", [after])
+        self.assertEqual(dict(rows), self.expected("day", self.fnames,
+                                                   [after]))
+
+    def test_sql_url_base(self):
+        conn = sqlite3.connect(":memory:")
+        for url in ["https://example.com/a/b?c", "http://h:8080/",
+                    "file:///tmp/x", "about:blank", "https://example.com",
+                    "chrome-extension://abc/x://y/", ""]:
+            self.assertEqual(conn.execute("select " + _sql_url_base("?1"),
+                                          (url,)).fetchone()[0],
+                             url_base(url))
+
+    def test_script(self):
+        lines = run_history("--stats", "host", "--format", "csv",
+                            "--limit", "2", *self.fnames)
+        self.assertEqual(lines, ["host,visits",
+                                 "https://host0.example.com/,60",
+                                 "https://host1.example.com/,60"])
+        lines = run_history("--stats", "title", "--before", "2015010316",
+                            "--use-last", self.fnames[0])
+        self.assertEqual(lines[0], "Page \u00e9 1 3")
+        self.assertEqual(len(lines), 3)
+
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -7,11 +7,40 @@ Mock code to support testing of chrome_throttle.
 import unittest
 import sys
 import os
-from signal import SIGSTOP, SIGCONT
+from signal import SIGSTOP, SIGCONT, SIGTERM
 import io
 import re
+import errno
+import time
+import select
+import shutil
+import tempfile
+import subprocess
+import struct
+import json
+import threading
 
-from ..chrome_throttle import get_chromium_renderers
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ..chrome_throttle import get_chromium_renderers, RendererCache, \
+     RendererTreeCache, ThrottleDaemon, JIFFIES_PER_SECOND, CpuSampler, \
+     find_cpu_piggies, memory_usage, find_memory_piggies, PAGE_SIZE, \
+     PressureMonitor, throttle_on_pressure, CgroupThrottle, \
+     DutyCycleScheduler, duty_for_share, PidfdSignaller, SignalThrottle, \
+     ProcessTracker, parse_proc_events, thread_cpu_times, find_thread_hogs, \
+     HogScorer, parse_weights, MIB, StatsRecorder, sample_renderers, \
+     replay_cpu_piggies, format_metrics, MetricsExporter, OPENMETRICS_TYPE, \
+     cpu_usage, RendererMonitor, TabMapper
+from .. import chrome_throttle
+from .proc_fixture import FakeProcTree
 
 """
  2 /usr/lib/chromium/chromium --password-store=detect
@@ -28,11 +57,40 @@ CMD_BASH        = "/bin/bash"
 CMD_STRACE      = "/usr/bin/strace /usr/lib/chromium/chromium"
 
 class MockProcess(object):
-    def __init__(self, pid, cmdline, status='S'):
+    def __init__(self, pid, cmdline, status='S', start_time=None, ppid=1):
         self.pid = pid
+        self.ppid = ppid
         self.cmdline = cmdline
         self.cmd = cmdline.split()[0].split('/')[-1]
         self.status = status
+        if start_time is None:
+            start_time = pid * 10
+        self.start_time = start_time
+        self.utime = 0
+        self.stime = 0
+        self.runtime_ns = 0
+        self.rss_kb = 10240
+        self.pss_kb = 8192
+        self.threads = {pid: [self.cmd, 0]}   # tid -> [name, jiffies]
+        self.maj_flt = 0
+        self.io_bytes = 0
+
+    def use_cpu(self, seconds, tid=None):
+        self.runtime_ns += int(seconds * 1e9)
+        self.utime = int(self.runtime_ns * JIFFIES_PER_SECOND / 1e9)
+        self.threads[tid or self.pid][1] += int(seconds * JIFFIES_PER_SECOND)
+
+    def add_thread(self, tid, name):
+        self.threads[tid] = [name, 0]
+
+    def thread_stat_file(self, tid):
+        flds = [0] * 41
+        flds[3-3] = self.ppid
+        flds[13-3] = self.threads[tid][1]
+        flds[21-3] = self.start_time
+        return "{0} ({1}) {2} {3}\n".format(
+                tid, self.threads[tid][0], self.status,
+                ' '.join(map(str, flds)))
 
     def pause(self):
         self.status = 'T'
@@ -51,6 +109,36 @@ class MockProcess(object):
         return "Name:\t{0}\nState:\t{1} ({2})\n".format(
                 self.cmd, self.status, status_str)
 
+    def statm_file(self):
+        pages = self.rss_kb * 1024 // PAGE_SIZE
+        return "{0} {1} 0 0 0 0 0\n".format(pages * 4, pages)
+
+    def smaps_rollup_file(self):
+        return ("00400000-7fffffffffff ---p 00000000 00:00 0  [rollup]\n"
+                "Rss:            {0} kB\n"
+                "Pss:            {1} kB\n"
+                "Shared_Clean:   0 kB\n").format(self.rss_kb, self.pss_kb)
+
+    def schedstat_file(self):
+        return "{0} 0 0\n".format(self.runtime_ns)
+
+    def io_file(self):
+        return ("rchar: 0\nwchar: 0\nsyscr: 0\nsyscw: 0\n"
+                "read_bytes: {0}\nwrite_bytes: {1}\n"
+                "cancelled_write_bytes: 0\n").format(self.io_bytes // 2,
+                                                     self.io_bytes // 2)
+
+    def stat_file(self):
+        flds = [0] * 41
+        flds[3-3] = self.ppid
+        flds[11-3] = self.maj_flt
+        flds[23-3] = self.rss_kb * 1024 // PAGE_SIZE
+        flds[13-3] = self.utime
+        flds[14-3] = self.stime
+        flds[21-3] = self.start_time
+        return "{0} ({1}) {2} {3}\n".format(
+                self.pid, self.cmd, self.status, ' '.join(map(str, flds)))
+
 class StringFile(io.StringIO):
     def __init__(self, s):
         try:
@@ -59,6 +147,33 @@ class StringFile(io.StringIO):
             super(self.__class__, self).__init__(unicode(s))
  
 
+class ProcFile(io.StringIO):
+    """An open /proc file that is regenerated when rewound.
+
+    Like a real /proc file, it can no longer be read once its
+    process has exited, even if the process ID has been reused.
+    """
+
+    def __init__(self, proc, render):
+        self.proc = proc
+        self.render = render
+        io.StringIO.__init__(self, self.text())
+
+    def text(self):
+        text = self.render(self.proc)
+        try:
+            return unicode(text)
+        except NameError:
+            return text
+
+    def seek(self, pos, whence=0):
+        if pos == 0 and whence == 0:
+            if MockProcList.procs.get(self.proc.pid) is not self.proc:
+                raise OSError(errno.ESRCH, "No such process")
+            io.StringIO.seek(self, 0)
+            self.truncate()
+            self.write(self.text())
+        return io.StringIO.seek(self, pos, whence)
 
 
 class MockProcListException(Exception):
@@ -92,8 +207,20 @@ class MockProcList(object):
         procs = MockProcList.procs
         if dir_name == "/proc":
             return sorted([str(i) for i in procs.keys()] + ["acpi", "self", "sys"])
+        m = re.match(r"/proc/(\d+)/task$", dir_name)
+        if m is not None:
+            if int(m.group(1)) not in procs:
+                raise OSError("[Errno 2] No such file or directory")
+            return [str(tid) for tid in sorted(procs[int(m.group(1))].threads)]
         return os.real_listdir(dir_name)
 
+    @staticmethod
+    def children_file(proc):
+        if not MockProcList.has_children:
+            raise KeyError(proc.pid)
+        return ' '.join([str(p.pid) for p in MockProcList.procs.values()
+                         if p.ppid == proc.pid])
+
     @staticmethod
     def kill(pid, sig):
         procs = MockProcList.procs
@@ -109,24 +236,36 @@ class MockProcList(object):
     @staticmethod
     def open(fname, mode='r'):   # FIXME: there is a buffered argument
         procs = MockProcList.procs
-        try:
+        for pat, method in MockProcList.proc_files:
+            m = pat.match(fname)
+            if m is None:
+                continue
+            args = m.groups()[1:]
             try:
-                pid = int(re.compile("/proc/(\d+)/status").match(fname).groups(0)[0])
-                return StringFile(procs[pid].status_file())
-            except AttributeError:
-                pass
-            try:
-                pid = int(re.compile("/proc/(\d+)/cmdline").match(fname).groups(0)[0])
-                return StringFile(procs[pid].cmdline)
-            except AttributeError:
-                pass
+                return ProcFile(procs[int(m.group(1))],
+                                lambda p: method(p, *args))
+            except KeyError:
+                raise IOError("IOError: [Errno 2] No such file or directory: '{}'".format(fname))
 
-        except KeyError:
-            raise IOError("IOError: [Errno 2] No such file or directory: '{}'".format(fname))
-        
         return real_open(fname, mode)
 
+    proc_files = [
+        (re.compile(r"/proc/(\d+)/status$"), lambda p: p.status_file()),
+        (re.compile(r"/proc/(\d+)/cmdline$"), lambda p: p.cmdline),
+        (re.compile(r"/proc/(\d+)/stat$"), lambda p: p.stat_file()),
+        (re.compile(r"/proc/(\d+)/schedstat$"), lambda p: p.schedstat_file()),
+        (re.compile(r"/proc/(\d+)/statm$"), lambda p: p.statm_file()),
+        (re.compile(r"/proc/(\d+)/io$"), lambda p: p.io_file()),
+        (re.compile(r"/proc/(\d+)/smaps_rollup$"),
+                    lambda p: p.smaps_rollup_file()),
+        (re.compile(r"/proc/(\d+)/task/\d+/children$"),
+                    lambda p: MockProcList.children_file(p)),
+        (re.compile(r"/proc/(\d+)/task/(\d+)/stat$"),
+                    lambda p, tid: p.thread_stat_file(int(tid))),
+    ]
+
     procs = None
+    has_children = True
 
     def __init__(self, *args):
         if MockProcList.procs is not None:
@@ -140,6 +279,7 @@ class MockProcList(object):
             del self.procs[k]
         self.procs = None
         MockProcList.procs = self.procs
+        MockProcList.has_children = True
  
 
 class ChromeThrottleTest(unittest.TestCase):
@@ -196,6 +336,1334 @@ class ChromeThrottleTest(unittest.TestCase):
     def test_procs_stop_non_existent_process(self):
         self.assertRaises(OSError, os.kill, 5000, SIGSTOP)
 
+    def test_cache_matches_uncached(self):
+        cache = RendererCache()
+        os.kill(4002, SIGSTOP)
+        self.assertEqual(get_chromium_renderers(cache),
+                         get_chromium_renderers())
+
+    def test_cache_rescan_is_cheaper(self):
+        clock = FakeClock()
+        cache = RendererCache(clock=clock)
+        get_chromium_renderers(cache)
+        clock.advance(2.0)
+        # the browser and zygotes are remembered once they have settled
+        get_chromium_renderers(cache)
+        first_cost = cache.scan_cost
+        os.kill(4001, SIGSTOP)
+        self.assertEqual(get_chromium_renderers(cache),
+             [(4000, 'S'), (4001, 'T'), (4002, 'S'),
+              (4003, 'S'), (4004, 'R'), (4005, 'S')])
+        # only the stat file of each process is read again
+        self.assertEqual(cache.scan_cost - first_cost, len(self.mpl.procs))
+
+    def test_cache_zygote_child_becomes_renderer(self):
+        cache = RendererCache(clock=FakeClock())
+        # forked from the zygote, command line not yet rewritten
+        self.mpl.procs[4006] = MockProcess(4006, CMD_CR_ZYGOTE, 'S')
+        self.assertNotIn(4006, [ps[0] for ps in
+                                get_chromium_renderers(cache)])
+        self.mpl.procs[4006].cmdline = CMD_CR_RENDERER
+        self.assertIn((4006, 'S'), get_chromium_renderers(cache))
+
+    def test_cache_remembers_settled_non_renderers(self):
+        clock = FakeClock()
+        cache = RendererCache(clock=clock)
+        get_chromium_renderers(cache)
+        self.assertNotIn(3002, cache.entries)
+        clock.advance(2.0)
+        get_chromium_renderers(cache)
+        self.assertEqual(cache.entries[3002], (30020, False))
+        self.assertEqual(cache.pending, {})
+
+    def test_cache_detects_pid_reuse(self):
+        cache = RendererCache()
+        get_chromium_renderers(cache)
+        self.mpl.procs[4003] = MockProcess(4003, CMD_BASH, 'S', 99999)
+        self.mpl.procs[1000] = MockProcess(1000, CMD_CR_RENDERER, 'R', 99998)
+        self.assertEqual(get_chromium_renderers(cache),
+             [(1000, 'R'), (4000, 'S'), (4001, 'S'), (4002, 'S'),
+              (4004, 'R'), (4005, 'S')])
+
+    def test_cache_forgets_exited_processes(self):
+        cache = RendererCache()
+        get_chromium_renderers(cache)
+        del self.mpl.procs[4005]
+        self.assertEqual([ps[0] for ps in get_chromium_renderers(cache)],
+                         [4000, 4001, 4002, 4003, 4004])
+        self.assertNotIn(4005, cache.entries)
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class ThrottleDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (1000, CMD_BASH, 'S'),
+           (3000, CMD_CR_PASSWD, 'S'),
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'),
+           (4002, CMD_CR_RENDERER, 'S'))
+        self.clock = FakeClock()
+        self.load = [5.0]
+        self.daemon = ThrottleDaemon(RendererCache(), 0.5, hog_windows=2,
+                                     cooldown=30.0, clock=self.clock,
+                                     loadavg=lambda: self.load)
+
+    def tearDown(self):
+        self.mpl.reset()
+
+    def window(self, busy):
+        self.clock.advance(1.0)
+        for pid in busy:
+            self.mpl.procs[pid].use_cpu(0.9)
+        return self.daemon.tick()
+
+    def test_daemon_stops_persistent_hog(self):
+        self.assertEqual(self.daemon.tick(), [])
+        self.assertEqual(self.window([4001, 4002]), [])
+        self.assertEqual(self.window([4001]), [("stop", 4001)])
+        self.assertEqual(self.mpl.procs[4001].status, 'T')
+        self.assertEqual(self.mpl.procs[4002].status, 'S')
+
+    def test_daemon_resumes_after_cooldown(self):
+        self.daemon.tick()
+        self.window([4001])
+        self.window([4001])
+        self.clock.advance(29.0)
+        self.assertEqual(self.daemon.tick(), [])
+        self.assertEqual(self.window([]), [("resume", 4001)])
+        self.assertEqual(self.mpl.procs[4001].status, 'S')
+
+    def test_daemon_resumes_when_load_drops(self):
+        self.daemon.resume_load = 1.0
+        self.daemon.tick()
+        self.window([4000])
+        self.window([4000])
+        self.load = [0.5]
+        self.assertEqual(self.window([]), [("resume", 4000)])
+
+    def test_daemon_ignores_reused_pid(self):
+        self.daemon.rescan_interval = 1
+        self.daemon.tick()
+        self.window([4001])
+        self.mpl.procs[4001] = MockProcess(4001, CMD_CR_RENDERER, 'S', 99)
+        self.mpl.procs[4001].use_cpu(1000.0)
+        self.assertEqual(self.window([4001]), [])
+
+    def test_daemon_resume_all(self):
+        self.daemon.tick()
+        self.window([4000, 4002])
+        self.window([4000, 4002])
+        self.daemon.resume_all()
+        self.assertEqual([self.mpl.procs[pid].status for pid in (4000, 4002)],
+                         ['S', 'S'])
+
+class CpuSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'),
+           (4002, CMD_CR_RENDERER, 'S'))
+        self.sampler = CpuSampler()
+
+    def tearDown(self):
+        self.sampler.close()
+        self.mpl.reset()
+
+    def test_sampler_first_sample_insufficient(self):
+        self.assertEqual(self.sampler.sample([4000, 4001]),
+                         {(4000, 40000): None, (4001, 40010): None})
+
+    def test_sampler_deltas(self):
+        self.sampler.sample([4000, 4001])
+        self.mpl.procs[4001].use_cpu(0.5)
+        self.assertEqual(self.sampler.sample([4000, 4001]),
+                         {(4000, 40000): 0, (4001, 40010): 0.5})
+
+    def test_sampler_schedstat_resolution(self):
+        self.sampler.sample([4000])
+        self.mpl.procs[4000].use_cpu(0.0012)
+        delta = self.sampler.sample([4000])[(4000, 40000)]
+        self.assertAlmostEqual(delta, 0.0012)
+
+    def test_sampler_stat_clock(self):
+        sampler = CpuSampler("stat")
+        sampler.sample([4000])
+        self.mpl.procs[4000].use_cpu(2.0)
+        self.assertAlmostEqual(sampler.sample([4000])[(4000, 40000)], 2.0)
+        sampler.close()
+
+    def test_sampler_falls_back_to_stat(self):
+        real_schedstat = MockProcess.schedstat_file
+        def no_schedstat(proc):
+            raise KeyError(proc.pid)
+        MockProcess.schedstat_file = no_schedstat
+        try:
+            self.sampler.sample([4000])
+            self.mpl.procs[4000].use_cpu(1.0)
+            self.assertAlmostEqual(self.sampler.sample([4000])[(4000, 40000)],
+                                   1.0)
+            self.assertRaises(IOError, CpuSampler("schedstat").open, 4000)
+        finally:
+            MockProcess.schedstat_file = real_schedstat
+
+    def test_sampler_keeps_files_open(self):
+        self.sampler.sample([4000])
+        f = self.sampler.files[4000][1]
+        self.sampler.sample([4000])
+        self.assertIs(self.sampler.files[4000][1], f)
+
+    def test_sampler_process_exited(self):
+        self.sampler.sample([4000, 4001, 4002])
+        del self.mpl.procs[4001]
+        self.assertEqual(sorted(self.sampler.sample([4000, 4001, 4002])),
+                         [(4000, 40000), (4002, 40020)])
+        self.assertNotIn(4001, self.sampler.files)
+
+    def test_sampler_pid_reused(self):
+        self.sampler.sample([4000, 4001])
+        self.mpl.procs[4001] = MockProcess(4001, CMD_CR_RENDERER, 'S', 5)
+        self.mpl.procs[4001].use_cpu(100.0)
+        self.assertEqual(self.sampler.sample([4000, 4001]),
+                         {(4000, 40000): 0, (4001, 5): None})
+
+    def test_sampler_new_process(self):
+        self.sampler.sample([4000])
+        self.assertEqual(self.sampler.sample([4000, 4002]),
+                         {(4000, 40000): 0, (4002, 40020): None})
+
+    def test_find_cpu_piggies_survives_exit(self):
+        procs = self.mpl.procs
+        procs[4002].use_cpu(10.0)
+        def sleep(seconds):
+            procs[4000].use_cpu(0.3)
+            procs[4002].use_cpu(0.8)
+            del procs[4001]
+        real_sleep = time.sleep
+        time.sleep = sleep
+        try:
+            piggies = find_cpu_piggies([4000, 4001, 4002], 1.0, 0.05)
+        finally:
+            time.sleep = real_sleep
+        self.assertEqual([piggy[1] for piggy in piggies], [4002, 4000])
+        self.assertAlmostEqual(piggies[0][0], 0.8)
+        self.assertAlmostEqual(piggies[1][0], 0.3)
+
+    def test_find_cpu_piggies_ewma(self):
+        procs = self.mpl.procs
+        use = [0.1, 0.5, 0.3]
+        def sleep(seconds):
+            procs[4001].use_cpu(use.pop(0) * seconds)
+        real_sleep = time.sleep
+        time.sleep = sleep
+        try:
+            piggies = find_cpu_piggies([4000, 4001], 0.3, 0.05, samples=3,
+                                       alpha=0.5)
+        finally:
+            time.sleep = real_sleep
+        self.assertEqual(len(piggies), 1)
+        self.assertEqual(piggies[0][1], 4001)
+        self.assertAlmostEqual(piggies[0][0], 0.5*0.3 + 0.5*(0.5*0.5 + 0.5*0.1))
+
+class ThreadHogsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'))
+        procs = self.mpl.procs
+        procs[4000].add_thread(4010, "Compositor")
+        procs[4000].add_thread(4011, "DedicatedWorker")
+        procs[4001].add_thread(4020, "Compositor")
+        self.real_sleep = time.sleep
+
+    def tearDown(self):
+        time.sleep = self.real_sleep
+        self.mpl.reset()
+
+    def test_thread_cpu_times(self):
+        self.mpl.procs[4000].use_cpu(2.0, 4011)
+        self.assertEqual(thread_cpu_times(4000),
+             {4000: (0.0, "chromium"), 4010: (0.0, "Compositor"),
+              4011: (2.0, "DedicatedWorker")})
+
+    def test_find_thread_hogs(self):
+        procs = self.mpl.procs
+        def sleep(seconds):
+            procs[4000].use_cpu(0.7, 4011)
+            procs[4000].use_cpu(0.1, 4010)
+            procs[4001].use_cpu(0.5, 4020)
+        time.sleep = sleep
+        hogs = find_thread_hogs([(0.8, 4000), (0.5, 4001)], 1.0, top_n=1)
+        self.assertEqual(len(hogs), 1)
+        share, pid, threads = hogs[0]
+        self.assertEqual(pid, 4000)
+        self.assertAlmostEqual(share, 0.8)
+        self.assertEqual(threads,
+             [(0.7, 4011, "DedicatedWorker"), (0.1, 4010, "Compositor"),
+              (0.0, 4000, "chromium")])
+
+    def test_find_thread_hogs_process_gone(self):
+        procs = self.mpl.procs
+        def sleep(seconds):
+            del procs[4001]
+        time.sleep = sleep
+        hogs = find_thread_hogs([(0.8, 4000), (0.5, 4001)], 1.0)
+        self.assertEqual([hog[1] for hog in hogs], [4000])
+
+class MemoryPiggiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'),
+           (4002, CMD_CR_RENDERER, 'S'))
+        procs = self.mpl.procs
+        procs[4001].pss_kb = 300 * 1024
+        procs[4002].pss_kb = 500 * 1024
+
+    def tearDown(self):
+        self.mpl.reset()
+
+    def test_memory_usage_pss(self):
+        self.assertEqual(memory_usage(4000), 8192 * 1024)
+
+    def test_memory_usage_statm_fallback(self):
+        real_smaps_rollup = MockProcess.smaps_rollup_file
+        def no_smaps_rollup(proc):
+            raise KeyError(proc.pid)
+        MockProcess.smaps_rollup_file = no_smaps_rollup
+        try:
+            self.assertEqual(memory_usage(4000), 10240 * 1024)
+        finally:
+            MockProcess.smaps_rollup_file = real_smaps_rollup
+
+    def test_find_memory_piggies(self):
+        self.assertEqual(find_memory_piggies([4000, 4001, 4002], 200.0),
+                         [(500.0, 4002), (300.0, 4001)])
+
+    def test_find_memory_piggies_gone(self):
+        del self.mpl.procs[4002]
+        self.assertEqual(find_memory_piggies([4000, 4001, 4002], 0.0),
+                         [(300.0, 4001), (8.0, 4000)])
+
+class HogScorerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'),
+           (4002, CMD_CR_RENDERER, 'S'))
+        self.real_sleep = time.sleep
+        procs = self.mpl.procs
+        procs[4002].rss_kb = 2 * 1024 * 1024
+        def sleep(seconds):
+            procs[4000].use_cpu(0.6 * seconds)
+            procs[4001].maj_flt += int(300 * seconds)
+            procs[4001].io_bytes += int(20 * MIB * seconds)
+        time.sleep = sleep
+
+    def tearDown(self):
+        time.sleep = self.real_sleep
+        self.mpl.reset()
+
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights("cpu=1,rss=0.5,io"),
+                         {"cpu": 1.0, "rss": 0.5, "io": 1.0})
+        self.assertRaises(ValueError, parse_weights, "cpu=1,disk=2")
+        self.assertRaises(ValueError, parse_weights, "cpu=x")
+
+    def test_score_cpu_only(self):
+        scorer = HogScorer({"cpu": 1.0})
+        piggies = scorer.find_piggies([4000, 4001, 4002], 2.0, 0.5)
+        self.assertEqual([piggy[1] for piggy in piggies], [4000])
+        self.assertAlmostEqual(piggies[0][0], 0.6)
+
+    def test_score_mixed(self):
+        scorer = HogScorer({"cpu": 1.0, "rss": 0.5, "majflt": 1.0, "io": 1.0})
+        piggies = scorer.find_piggies([4000, 4001, 4002], 1.0, 0.0)
+        self.assertEqual([piggy[1] for piggy in piggies], [4001, 4002, 4000])
+        self.assertAlmostEqual(piggies[0][0], 3.0 + 2.0 + 0.5 * 10 / 1024.0)
+        self.assertEqual(scorer.metrics[4001]["majflt"], 300.0)
+        self.assertEqual(scorer.metrics[4001]["io"], 20 * MIB)
+
+    def test_score_costs(self):
+        scorer = HogScorer({"cpu": 1.0, "io": 1.0})
+        scorer.find_piggies([4000, 4001], 1.0, 0.0)
+        self.assertEqual(sorted(scorer.costs), ["cpu", "io", "stat"])
+        self.assertTrue(scorer.costs["io"] > 0.0)
+
+    def test_score_process_gone(self):
+        procs = self.mpl.procs
+        def sleep(seconds):
+            del procs[4001]
+        time.sleep = sleep
+        scorer = HogScorer({"cpu": 1.0})
+        self.assertEqual([p[1] for p in
+                          scorer.find_piggies([4000, 4001, 4002], 1.0, 0.0)],
+                         [4000, 4002])
+
+class PressureMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (3000, CMD_CR_PASSWD, 'S'),
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'))
+        self.cpu = os.pipe()
+        self.memory = os.pipe()
+        self.monitor = PressureMonitor(
+                fds={"cpu": self.cpu[0], "memory": self.memory[0]},
+                events=select.POLLIN)
+
+    def tearDown(self):
+        for fd in self.cpu + self.memory:
+            os.close(fd)
+        self.mpl.reset()
+
+    def test_pressure_timeout(self):
+        self.assertEqual(self.monitor.wait(0.01), [])
+
+    def test_pressure_stall(self):
+        os.write(self.memory[1], b"x")
+        self.assertEqual(self.monitor.wait(0.01), ["memory"])
+        os.write(self.cpu[1], b"x")
+        self.assertEqual(self.monitor.wait(0.01), ["cpu", "memory"])
+
+    def test_throttle_on_pressure(self):
+        os.write(self.cpu[1], b"x")
+        reports = []
+        def find_piggies(pids):
+            return [(0.9, pids[-1])]
+        throttle_on_pressure(self.monitor, find_piggies, RendererCache(),
+                             report=lambda *args: reports.append(args),
+                             max_events=1)
+        self.assertEqual(reports, [(["cpu"], [(0.9, 4001)])])
+        self.assertEqual(self.mpl.procs[4001].status, 'T')
+        self.assertEqual(self.mpl.procs[4000].status, 'S')
+
+class RecordingThrottle(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.log = []
+        self.gone = set()
+
+    def disable(self, pid):
+        if pid in self.gone:
+            raise OSError("No such process")
+        self.log.append((round(self.clock() - 1000.0, 3), "stop", pid))
+
+    def enable(self, pid):
+        if pid in self.gone:
+            raise OSError("No such process")
+        self.log.append((round(self.clock() - 1000.0, 3), "cont", pid))
+
+class DutyCycleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.throttle = RecordingThrottle(self.clock)
+        self.scheduler = DutyCycleScheduler(0.5, 0.01, self.throttle,
+                                            self.clock, self.clock.advance)
+
+    def test_duty_for_share(self):
+        self.assertEqual(duty_for_share(0.8, 0.2), 0.25)
+        self.assertEqual(duty_for_share(0.1, 0.2), 1.0)
+
+    def test_duty_cycle_one(self):
+        self.scheduler.set_duty(4000, 0.1)
+        self.scheduler.run(1.0)
+        self.assertEqual(self.throttle.log,
+             [(0.0, "cont", 4000), (0.05, "stop", 4000),
+              (0.5, "cont", 4000), (0.55, "stop", 4000),
+              (1.0, "cont", 4000)])
+
+    def test_duty_cycle_two(self):
+        self.scheduler.set_duty(4000, 0.2)
+        self.scheduler.set_duty(4001, 0.6)
+        self.scheduler.run(0.5)
+        self.assertEqual(self.throttle.log,
+             [(0.0, "cont", 4000), (0.0, "cont", 4001),
+              (0.1, "stop", 4000), (0.3, "stop", 4001),
+              (0.5, "cont", 4000), (0.5, "cont", 4001)])
+
+    def test_duty_cycle_full(self):
+        self.scheduler.set_duty(4000, 0.1)
+        self.scheduler.set_duty(4000, 1.0)
+        self.assertEqual(self.scheduler.step(), None)
+        self.assertEqual(self.throttle.log, [(0.0, "cont", 4000)])
+
+    def test_duty_cycle_process_gone(self):
+        self.scheduler.set_duty(4000, 0.1)
+        self.scheduler.set_duty(4001, 0.1)
+        self.scheduler.step()
+        self.throttle.gone.add(4001)
+        self.clock.advance(0.05)
+        self.scheduler.step()
+        self.assertEqual(list(self.scheduler.duty), [4000])
+
+    def test_duty_cycle_many(self):
+        for pid in range(100):
+            self.scheduler.set_duty(pid, 0.25)
+        self.scheduler.run(2.0)
+        self.assertEqual(len(self.scheduler.heap), 0)
+        stops = [entry for entry in self.throttle.log if entry[1] == "stop"]
+        self.assertEqual(len(stops), 400)
+
+class FakePidfds(object):
+    """Stand-in for os.pidfd_open and signal.pidfd_send_signal."""
+
+    def __init__(self):
+        self.fds = {}
+
+    def pidfd_open(self, pid):
+        proc = MockProcList.procs.get(pid)
+        if proc is None:
+            raise OSError(errno.ESRCH, "No such process")
+        # a real descriptor, so that it can be closed
+        fd = os.open(os.devnull, os.O_RDONLY)
+        self.fds[fd] = proc
+        return fd
+
+    def send_signal(self, fd, sig):
+        proc = self.fds[fd]
+        if MockProcList.procs.get(proc.pid) is not proc:
+            raise OSError(errno.ESRCH, "No such process")
+        if sig == SIGSTOP:
+            proc.pause()
+        elif sig == SIGCONT:
+            proc.unpause()
+
+class PidfdSignallerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'),
+           (4002, CMD_CR_RENDERER, 'S'))
+        self.pidfds = FakePidfds()
+        self.signaller = PidfdSignaller(self.pidfds.pidfd_open,
+                                        self.pidfds.send_signal)
+
+    def tearDown(self):
+        self.signaller.close()
+        self.mpl.reset()
+
+    def test_pidfd_batch(self):
+        self.signaller.open([4000, 4001, 4002])
+        self.assertEqual(self.signaller.send(SIGSTOP, [4000, 4002]),
+                         {4000: "ok", 4002: "ok"})
+        self.assertEqual([p.status for p in
+                          (self.mpl.procs[4000], self.mpl.procs[4002])],
+                         ['T', 'T'])
+
+    def test_pidfd_gone(self):
+        self.signaller.open([4000, 4001])
+        del self.mpl.procs[4001]
+        self.assertEqual(self.signaller.send(SIGSTOP, [4000, 4001]),
+                         {4000: "ok", 4001: "gone"})
+
+    def test_pidfd_reused_after_open(self):
+        self.signaller.open([4000, 4001])
+        new = MockProcess(4001, CMD_BASH, 'S', 5)
+        self.mpl.procs[4001] = new
+        self.assertEqual(self.signaller.send(SIGSTOP, [4001]),
+                         {4001: "gone"})
+        self.assertEqual(new.status, 'S')
+
+    def test_pidfd_reused_before_open(self):
+        self.mpl.procs[4001] = MockProcess(4001, CMD_BASH, 'S', 5)
+        self.signaller.open([4000, 4001], {4000: 40000, 4001: 40010})
+        self.assertEqual(self.signaller.send(SIGSTOP, [4000, 4001]),
+                         {4000: "ok", 4001: "stale"})
+        self.assertEqual(self.mpl.procs[4001].status, 'S')
+
+    def test_pidfd_not_opened(self):
+        self.signaller.open([4000])
+        self.assertEqual(self.signaller.send(SIGSTOP, [4002]),
+                         {4002: "stale"})
+
+    def test_pidfd_opened_later(self):
+        # a hog first seen while sampling is opened after the others
+        self.mpl.procs[4001] = MockProcess(4001, CMD_CR_RENDERER, 'S', 5)
+        self.signaller.open([4000, 4001], {4000: 40000, 4001: 40010})
+        self.signaller.open([4001, 4002], {4001: 5, 4002: 40020})
+        self.assertEqual(self.signaller.send(SIGSTOP, [4001, 4002]),
+                         {4001: "ok", 4002: "ok"})
+        self.assertEqual(self.mpl.procs[4001].status, 'T')
+
+    def test_pidfd_unavailable_uses_kill(self):
+        signaller = PidfdSignaller()
+        signaller.pidfd_open = None
+        signaller.open([4000, 4001])
+        self.assertEqual(signaller.send(SIGSTOP, [4001]), {4001: "ok"})
+        self.assertEqual(self.mpl.procs[4001].status, 'T')
+
+    def test_pidfd_open_refused_uses_kill(self):
+        for err in (errno.ENOSYS, errno.EPERM):
+            def pidfd_open(pid):
+                raise OSError(err, os.strerror(err))
+            signaller = PidfdSignaller(pidfd_open, self.pidfds.send_signal)
+            signaller.open([4000, 4001])
+            self.assertEqual(signaller.send(SIGSTOP, [4001]), {4001: "ok"})
+            self.assertEqual(self.mpl.procs[4001].status, 'T')
+            self.mpl.procs[4001].unpause()
+
+    def test_pidfd_gone_before_open(self):
+        del self.mpl.procs[4001]
+        self.signaller.open([4000, 4001])
+        self.assertEqual(self.signaller.send(SIGSTOP, [4000, 4001]),
+                         {4000: "ok", 4001: "gone"})
+
+    def test_signal_throttle_with_signaller(self):
+        self.signaller.open([4000, 4001])
+        throttle = SignalThrottle(signaller=self.signaller)
+        self.assertEqual(throttle.disable_many([4000, 4001]),
+                         {4000: "ok", 4001: "ok"})
+        throttle.enable(4001)
+        self.assertEqual(self.mpl.procs[4001].status, 'S')
+        del self.mpl.procs[4000]
+        self.assertRaises(OSError, throttle.enable, 4000)
+
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "needs pidfd support")
+    def test_pidfd_real_process(self):
+        child = subprocess.Popen([sys.executable, "-c",
+                                  "import time; time.sleep(30)"])
+        try:
+            signaller = PidfdSignaller()
+            signaller.open([child.pid])
+            self.assertEqual(signaller.send(SIGTERM, [child.pid]),
+                             {child.pid: "ok"})
+            child.wait()
+            self.assertEqual(signaller.send(SIGTERM, [child.pid]),
+                             {child.pid: "gone"})
+            signaller.close()
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+
+class MetricsExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (3000, CMD_CR_PASSWD, 'S'),
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'R'))
+        self.throttle = SignalThrottle()
+        self.exporter = MetricsExporter(RendererCache(), self.throttle,
+                                        interval=60.0, port=0)
+
+    def tearDown(self):
+        self.exporter.stop()
+        self.mpl.reset()
+
+    def test_format_metrics(self):
+        text = format_metrics([(4000, 'S'), (4001, 'T')], {4000: 0.25},
+                              {4000: 4096, 4001: 8192},
+                              {"disable": 2, "enable": 1})
+        lines = text.splitlines()
+        self.assertIn('chromium_renderer_cpu_ratio{pid="4000"} 0.25', lines)
+        self.assertIn('chromium_renderer_rss_bytes{pid="4001"} 8192', lines)
+        self.assertIn('chromium_renderer_state{pid="4001",'
+                      'chromium_renderer_state="T"} 1', lines)
+        self.assertIn('chromium_throttle_actions_total{action="disable"} 2',
+                      lines)
+        self.assertEqual(lines[-1], "# EOF")
+
+    def test_throttle_counts(self):
+        self.throttle.disable_many([4000, 4001, 9999])
+        self.throttle.enable(4000)
+        self.assertEqual(self.throttle.actions, {"disable": 2, "enable": 1})
+
+    def test_refresh(self):
+        self.exporter.refresh()
+        self.mpl.procs[4001].use_cpu(5.0)
+        self.exporter.refresh()
+        text = self.exporter.snapshot.decode()
+        self.assertIn('chromium_renderer_cpu_ratio{pid="4000"} 0\n', text)
+        self.assertIn('chromium_renderer_rss_bytes{pid="4001"} 10485760', text)
+        self.assertIn('chromium_renderer_state{pid="4001",'
+                      'chromium_renderer_state="R"} 1', text)
+
+    def test_scrape_uses_snapshot(self):
+        port = self.exporter.start()
+        for i in range(100):
+            if b'pid="4000"' in self.exporter.snapshot:
+                break
+            time.sleep(0.01)
+        cost = self.exporter.cache.scan_cost
+        for i in range(2):
+            response = urlopen("http://127.0.0.1:%d/metrics" % port)
+            self.assertEqual(response.headers["Content-Type"],
+                             OPENMETRICS_TYPE)
+            body = response.read().decode()
+        self.assertIn('chromium_renderer_state{pid="4000",'
+                      'chromium_renderer_state="S"} 1', body)
+        # a scrape must not scan /proc
+        self.assertEqual(self.exporter.cache.scan_cost, cost)
+
+class DevToolsStandIn(object):
+    """Serve a target list on /json/list as a Chromium browser would."""
+
+    def __init__(self):
+        self.targets = []
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                if self.path != "/json/list":
+                    self.send_error(404)
+                    return
+                body = json.dumps(stand_in.targets).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, id, url, title, pid, type="page"):
+        self.targets.append({"id": id, "type": type, "url": url,
+                             "title": title, "processId": pid,
+                             "webSocketDebuggerUrl":
+                             "ws://127.0.0.1/devtools/page/" + id})
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TabMapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devtools = DevToolsStandIn()
+        self.devtools.add("A", "https://dash.example.com/cpu", "Dashboard",
+                          4000)
+        self.devtools.add("B", "https://news.example.com/", "News", 4001)
+        self.devtools.add("C", "https://mail.example.com/", "Mail", 4001)
+        self.devtools.add("D", "chrome-extension://x/bg.html", "Ext", 4002,
+                          "background_page")
+        self.clock = FakeClock()
+        self.resolved = []
+
+        def resolve(target):
+            self.resolved.append(target["id"])
+            return TabMapper.target_pid(target)
+
+        self.mapper = TabMapper(self.devtools.endpoint, max_age=5.0,
+                                resolve=resolve, clock=self.clock)
+
+    def tearDown(self):
+        self.devtools.close()
+
+    def test_tabs(self):
+        self.assertEqual(self.mapper.url(4000), "https://dash.example.com/cpu")
+        self.assertEqual(self.mapper.tabs(4001),
+                         [("https://mail.example.com/", "Mail"),
+                          ("https://news.example.com/", "News")])
+        self.assertEqual(self.mapper.url(4002), "-")
+
+    def test_match(self):
+        pids = [4000, 4001, 4002]
+        self.assertEqual(self.mapper.match(["*dash*"], pids), [4000])
+        self.assertEqual(self.mapper.match(["News", "Dash*"], pids),
+                         [4000, 4001])
+        self.assertEqual(self.mapper.match(["*dash*"], [4001]), [])
+        self.assertEqual(self.mapper.match(["*bg.html"], pids), [])
+
+    def test_cached(self):
+        for pid in (4000, 4001, 4000):
+            self.mapper.url(pid)
+        self.assertEqual(self.devtools.requests, 1)
+        self.clock.advance(6.0)
+        self.mapper.url(4000)
+        self.assertEqual(self.devtools.requests, 2)
+
+    def test_incremental(self):
+        self.mapper.refresh()
+        self.assertEqual(sorted(self.resolved), ["A", "B", "C"])
+        del self.resolved[:]
+        self.devtools.targets[0]["url"] = "https://dash.example.com/mem"
+        del self.devtools.targets[1]
+        self.devtools.add("E", "https://docs.example.com/", "Docs", 4003)
+        self.mapper.refresh(force=True)
+        self.assertEqual(sorted(self.resolved), ["A", "E"])
+        self.assertEqual(sorted(self.mapper.targets), ["A", "C", "E"])
+        self.assertEqual(self.mapper.url(4000), "https://dash.example.com/mem")
+
+    def test_unresolved(self):
+        self.assertFalse(self.mapper.unresolved())
+        for target in self.devtools.targets:
+            del target["processId"]
+        mapper = TabMapper(self.devtools.endpoint)
+        self.assertTrue(mapper.unresolved())
+        self.assertEqual(mapper.url(4000), "-")
+        self.devtools.targets = []
+        self.assertFalse(TabMapper(self.devtools.endpoint).unresolved())
+
+    def test_unreachable(self):
+        self.devtools.close()
+        mapper = TabMapper(self.devtools.endpoint, timeout=0.5)
+        self.devtools = DevToolsStandIn()
+        self.assertRaises((IOError, OSError), mapper.refresh)
+
+class StatsRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "stats")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sample(self, t, pid, ticks):
+        return (t, pid * 10, ticks, 4096, pid, b'S')
+
+    def test_record_and_read(self):
+        recorder = StatsRecorder(self.fname, 10)
+        samples = [self.sample(1.0, 4000, 5), self.sample(1.0, 4001, 7)]
+        recorder.append(samples)
+        self.assertEqual(list(recorder.records()), samples)
+        recorder.close()
+        self.assertEqual(os.path.getsize(self.fname),
+                         StatsRecorder.HEADER.size +
+                         10 * StatsRecorder.RECORD.size)
+
+    def test_record_reopen(self):
+        recorder = StatsRecorder(self.fname, 10)
+        recorder.append([self.sample(1.0, 4000, 5)])
+        recorder.close()
+        recorder = StatsRecorder(self.fname, 1000, create=False)
+        self.assertEqual(recorder.capacity, 10)
+        recorder.append([self.sample(2.0, 4000, 6)])
+        self.assertEqual([r[0] for r in recorder.records()], [1.0, 2.0])
+        recorder.close()
+
+    def test_record_wraps(self):
+        recorder = StatsRecorder(self.fname, 5)
+        for t in range(3):
+            recorder.append([self.sample(float(t), 4000 + i, t) for i in range(3)])
+        self.assertEqual([(r[0], r[4]) for r in recorder.records()],
+             [(1.0, 4001), (1.0, 4002), (2.0, 4000), (2.0, 4001), (2.0, 4002)])
+        recorder.close()
+
+    def test_record_missing_file(self):
+        self.assertRaises(IOError, StatsRecorder, self.fname, create=False)
+
+    def test_record_bad_file(self):
+        with open(self.fname, "wb") as f:
+            f.write(b"x" * 100)
+        self.assertRaises(ValueError, StatsRecorder, self.fname)
+
+    def test_replay(self):
+        j = JIFFIES_PER_SECOND
+        records = [self.sample(10.0, 4000, 0), self.sample(10.0, 4001, 0),
+                   self.sample(12.0, 4000, int(1.6 * j)),
+                   self.sample(12.0, 4001, int(0.02 * j)),
+                   self.sample(13.0, 4001, int(0.52 * j)),
+                   (13.0, 99, 0, 0, 4000, b'S')]        # pid reused
+        self.assertEqual(list(replay_cpu_piggies(records, 0.05, j)),
+                         [(12.0, [(0.8, 4000)]), (13.0, [(0.5, 4001)])])
+
+    def test_sample_renderers(self):
+        mpl = MockProcList((4000, CMD_CR_RENDERER, 'R'))
+        try:
+            mpl.procs[4000].use_cpu(3.0)
+            self.assertEqual(sample_renderers([4000, 4001], 5.0),
+                 [(5.0, 40000, int(3.0 * JIFFIES_PER_SECOND),
+                   10240 * 1024, 4000, b'R')])
+        finally:
+            mpl.reset()
+
+class CgroupThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mount = tempfile.mkdtemp()
+        self.root = os.path.join(self.mount, "chrome_throttle")
+        os.mkdir(self.root)
+        self.set_controllers("cpu memory pids")
+        chrome_throttle.PROC_ROOT = os.path.join(self.mount, "proc")
+        self.origins = os.path.join(self.mount, "origins")
+
+    def tearDown(self):
+        chrome_throttle.PROC_ROOT = "/proc"
+        shutil.rmtree(self.mount)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return f.read()
+
+    def set_controllers(self, controllers):
+        with open(os.path.join(self.root, "cgroup.controllers"), "w") as f:
+            f.write(controllers + "\n")
+
+    def throttler(self, **kwargs):
+        return CgroupThrottle(self.root, mount=self.mount,
+                              origins_file=self.origins, **kwargs)
+
+    def set_cgroup(self, pid, path):
+        """Put PID in cgroup PATH, as the kernel would show it."""
+
+        pdir = os.path.join(chrome_throttle.PROC_ROOT, str(pid))
+        if not os.path.isdir(pdir):
+            os.makedirs(pdir)
+        with open(os.path.join(pdir, "cgroup"), "w") as f:
+            f.write("0::%s\n" % path)
+        group = os.path.join(self.mount, path.lstrip("/"))
+        if not os.path.isdir(group):
+            os.makedirs(group)
+
+    def test_cgroup_setup(self):
+        CgroupThrottle(self.root, 0.25).setup()
+        self.assertEqual(self.read("cgroup.subtree_control"), "+cpu")
+        self.assertEqual(self.read("throttled/cpu.max"), "25000 100000")
+        self.assertEqual(self.read("frozen/cgroup.freeze"), "1")
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "running")))
+
+    def test_cgroup_setup_not_a_cgroup(self):
+        for root in (os.path.join(self.mount, "nonexistent"), self.mount):
+            self.assertRaises(ValueError, CgroupThrottle(root).setup)
+        self.assertFalse(os.path.exists(os.path.join(self.mount,
+                                                     "nonexistent")))
+
+    def test_cgroup_setup_without_cpu(self):
+        self.set_controllers("memory pids")
+        self.assertRaises(ValueError, CgroupThrottle(self.root).setup)
+        CgroupThrottle(self.root, freeze=True).setup()
+        self.assertEqual(self.read("frozen/cgroup.freeze"), "1")
+        self.assertFalse(os.path.exists(os.path.join(self.root,
+                                                     "throttled", "cpu.max")))
+
+    def test_cgroup_setup_twice(self):
+        CgroupThrottle(self.root).setup()
+        CgroupThrottle(self.root, 0.5).setup()
+        self.assertEqual(self.read("throttled/cpu.max"), "50000 100000")
+
+    def test_cgroup_throttle_and_restore(self):
+        throttler = self.throttler()
+        throttler.setup()
+        throttler.disable(4001)
+        self.assertEqual(self.read("throttled/cgroup.procs"), "4001\n")
+        throttler.enable(4001)
+        # where it came from is not known
+        self.assertEqual(self.read("running/cgroup.procs"), "4001\n")
+
+    def test_cgroup_restore_to_origin(self):
+        scope = "/user.slice/app-chromium.scope"
+        self.set_cgroup(4001, scope)
+        throttler = self.throttler()
+        throttler.setup()
+        throttler.disable(4001)
+        self.assertEqual(self.read("throttled/cgroup.procs"), "4001\n")
+        self.set_cgroup(4001, "/chrome_throttle/throttled")
+        # a later run enables it
+        throttler = self.throttler()
+        throttler.enable(4001)
+        with open(os.path.join(self.mount, scope.lstrip("/"),
+                               "cgroup.procs")) as f:
+            self.assertEqual(f.read(), "4001\n")
+        self.assertFalse(os.path.exists(os.path.join(self.root, "running",
+                                                     "cgroup.procs")))
+        self.assertEqual(throttler.actions["enable"], 1)
+
+    def test_cgroup_origin_gone(self):
+        scope = "/user.slice/app-chromium.scope"
+        self.set_cgroup(4001, scope)
+        throttler = self.throttler()
+        throttler.setup()
+        throttler.disable(4001)
+        self.set_cgroup(4001, "/chrome_throttle/throttled")
+        shutil.rmtree(os.path.join(self.mount, "user.slice"))
+        throttler.enable(4001)
+        self.assertEqual(self.read("running/cgroup.procs"), "4001\n")
+
+    def test_cgroup_enable_not_disabled(self):
+        self.set_cgroup(4002, "/user.slice/app-chromium.scope")
+        throttler = self.throttler()
+        throttler.setup()
+        self.assertEqual(throttler.enable_many([4002]), {4002: "ok"})
+        self.assertFalse(os.path.exists(os.path.join(self.root, "running",
+                                                     "cgroup.procs")))
+        self.assertEqual(throttler.actions["enable"], 0)
+
+    def test_cgroup_origins_forget_exited(self):
+        self.set_cgroup(4001, "/user.slice/a.scope")
+        self.set_cgroup(4002, "/user.slice/b.scope")
+        throttler = self.throttler()
+        throttler.setup()
+        throttler.disable(4001)
+        shutil.rmtree(os.path.join(chrome_throttle.PROC_ROOT, "4001"))
+        throttler.disable(4002)
+        with open(self.origins) as f:
+            self.assertEqual(json.load(f), {"4002": "/user.slice/b.scope"})
+
+    def test_cgroup_freeze(self):
+        throttler = self.throttler(freeze=True)
+        throttler.setup()
+        throttler.disable(4002)
+        self.assertEqual(self.read("frozen/cgroup.procs"), "4002\n")
+
+    def test_cgroup_missing_root(self):
+        throttler = CgroupThrottle(os.path.join(self.root, "x"))
+        self.assertRaises(IOError, throttler.disable, 4000)
+
+class FakeEventSource(object):
+    def __init__(self):
+        self.events = []
+        self.error = None
+
+    def read_events(self, timeout=0):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise OSError(error, os.strerror(error))
+        events, self.events = self.events, []
+        return events
+
+def proc_event_message(what, *pids):
+    event = struct.pack("=IIQ", what, 0, 0) + \
+            struct.pack("=%dI" % len(pids), *pids)
+    cn_msg = struct.pack("=IIIIHH", 1, 1, 0, 0, len(event), 0)
+    return struct.pack("=IHHII", 16 + len(cn_msg) + len(event), 3, 0, 0, 0) + \
+           cn_msg + event
+
+class ProcessTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (1000, CMD_BASH, 'S'),
+           (3000, CMD_CR_PASSWD, 'S'),
+           (3002, CMD_CR_ZYGOTE, 'S'),
+           (4000, CMD_CR_RENDERER, 'S'),
+           (4001, CMD_CR_RENDERER, 'S'))
+        self.source = FakeEventSource()
+        self.clock = FakeClock()
+        self.tracker = ProcessTracker(RendererCache(), self.source,
+                                      clock=self.clock)
+        self.tracker.refresh()
+
+    def tearDown(self):
+        self.mpl.reset()
+
+    def test_parse_proc_events(self):
+        data = proc_event_message(0x1, 3002, 3002, 4005, 4005) + \
+               proc_event_message(0x1, 4000, 4000, 4006, 4000) + \
+               proc_event_message(0x2, 4005, 4005) + \
+               proc_event_message(0x80000000, 4001, 4001, 0, 9) + \
+               proc_event_message(0x80000000, 4007, 4000, 0, 0)
+        self.assertEqual(parse_proc_events(data),
+             [("fork", 4005), ("exec", 4005), ("exit", 4001)])
+
+    def test_tracker_no_scan_after_start(self):
+        cost = self.tracker.cache.scan_cost
+        self.assertEqual(self.tracker.refresh(), [(4000, 'S'), (4001, 'S')])
+        self.assertEqual(self.tracker.cache.scan_cost, cost)
+
+    def test_tracker_new_renderer(self):
+        self.mpl.procs[4002] = MockProcess(4002, CMD_CR_RENDERER, 'R')
+        self.mpl.procs[5000] = MockProcess(5000, CMD_BASH, 'S')
+        self.source.events = [("fork", 4002), ("fork", 5000), ("exec", 5000)]
+        self.assertEqual(self.tracker.refresh(),
+                         [(4000, 'S'), (4001, 'S'), (4002, 'R')])
+        self.assertEqual(self.tracker.pending, {})
+
+    def test_tracker_events_lost(self):
+        # renderer 4002 was forked, but its event overflowed the socket
+        self.mpl.procs[4002] = MockProcess(4002, CMD_CR_RENDERER, 'R')
+        del self.mpl.procs[4000]
+        self.source.error = errno.ENOBUFS
+        cost = self.tracker.cache.scan_cost
+        self.assertEqual(self.tracker.refresh(), [(4001, 'S'), (4002, 'R')])
+        self.assertGreater(self.tracker.cache.scan_cost, cost)
+        self.assertEqual(self.tracker.renderers, set([4001, 4002]))
+
+    def test_tracker_other_error(self):
+        self.source.error = errno.EBADF
+        self.assertRaises(OSError, self.tracker.refresh)
+
+    def test_tracker_exit(self):
+        del self.mpl.procs[4000]
+        self.source.events = [("exit", 4000)]
+        self.assertEqual(self.tracker.refresh(), [(4001, 'S')])
+        self.assertNotIn(4000, self.tracker.entries)
+
+    def test_tracker_renderer_settles(self):
+        # forked from the zygote, still with the zygote's command line
+        self.mpl.procs[4002] = MockProcess(4002, CMD_CR_ZYGOTE, 'S')
+        self.source.events = [("fork", 4002)]
+        self.assertEqual(len(self.tracker.refresh()), 2)
+        self.assertIn(4002, self.tracker.pending)
+        self.mpl.procs[4002].cmdline = CMD_CR_RENDERER
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.tracker.refresh()), 3)
+
+    def test_tracker_gives_up_on_non_renderer(self):
+        self.mpl.procs[3003] = MockProcess(3003, CMD_CR_ZYGOTE, 'S')
+        self.source.events = [("fork", 3003)]
+        self.tracker.refresh()
+        self.clock.advance(2.0)
+        self.tracker.refresh()
+        self.assertEqual(self.tracker.pending, {})
+
+    def test_tracker_without_source(self):
+        tracker = ProcessTracker(RendererCache(), None)
+        tracker.close()
+        tracker.source = None     # as if the connector were unavailable
+        self.mpl.procs[4002] = MockProcess(4002, CMD_CR_RENDERER, 'S')
+        self.assertEqual(get_chromium_renderers(tracker),
+                         get_chromium_renderers())
+
+class ChromeThrottleTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpl = MockProcList(
+           (1, "/sbin/init", 'S', 1, 0),
+           (1000, CMD_BASH, 'S', None, 1),
+           (2000, CMD_STRACE, 'R', None, 1000),
+           (3000, CMD_CR_PASSWD, 'S', None, 1000),
+           (3004, CMD_CR_SANDBOX, 'S', None, 3000),
+           (3002, CMD_CR_ZYGOTE, 'S', None, 3004),
+           (3003, CMD_CR_ZYGOTE, 'S', None, 3002),
+           (4000, CMD_CR_RENDERER, 'S', None, 3003),
+           (4001, CMD_CR_RENDERER, 'S', None, 3003),
+           (4002, CMD_CR_RENDERER, 'R', None, 3003),
+           (5000, CMD_BASH, 'S', None, 1),
+           (5001, CMD_BASH, 'S', None, 5000))
+
+    def tearDown(self):
+        self.mpl.reset()
+
+    def test_tree_matches_sweep(self):
+        self.assertEqual(get_chromium_renderers(RendererTreeCache()),
+                         get_chromium_renderers())
+
+    def test_tree_ignores_unrelated_processes(self):
+        cache = RendererTreeCache()
+        get_chromium_renderers(cache)
+        self.assertEqual(cache.roots, [(3000, 30000)])
+        cost = cache.scan_cost
+        get_chromium_renderers(cache)
+        sweep = RendererCache()
+        get_chromium_renderers(sweep)
+        get_chromium_renderers(sweep)
+        self.assertLess(cache.scan_cost - cost, sweep.scan_cost / 2)
+        self.assertNotIn(5001, cache.entries)
+
+    def test_tree_notices_new_renderer(self):
+        cache = RendererTreeCache()
+        get_chromium_renderers(cache)
+        self.mpl.procs[4003] = MockProcess(4003, CMD_CR_RENDERER, 'S',
+                                           None, 3003)
+        self.assertEqual([ps[0] for ps in get_chromium_renderers(cache)],
+                         [4000, 4001, 4002, 4003])
+
+    def test_tree_browser_restart(self):
+        cache = RendererTreeCache()
+        get_chromium_renderers(cache)
+        self.mpl.procs[3000] = MockProcess(3000, CMD_CR_PASSWD, 'S',
+                                           77777, 1000)
+        for pid in (3004, 3002, 3003, 4000, 4001, 4002):
+            del self.mpl.procs[pid]
+        self.mpl.procs[6000] = MockProcess(6000, CMD_CR_RENDERER, 'S',
+                                           None, 3000)
+        self.assertEqual(get_chromium_renderers(cache), [(6000, 'S')])
+        self.assertEqual(cache.roots, [(3000, 77777)])
+
+    def test_tree_zygote_child_becomes_renderer(self):
+        cache = RendererTreeCache()
+        get_chromium_renderers(cache)
+        self.mpl.procs[4003] = MockProcess(4003, CMD_CR_ZYGOTE, 'S',
+                                           None, 3003)
+        self.assertNotIn(4003, [ps[0] for ps in
+                                get_chromium_renderers(cache)])
+        self.mpl.procs[4003].cmdline = CMD_CR_RENDERER
+        self.assertIn((4003, 'S'), get_chromium_renderers(cache))
+
+    def test_tree_no_browser(self):
+        for pid in (3000, 3004, 3002, 3003, 4000, 4001, 4002):
+            del self.mpl.procs[pid]
+        cache = RendererTreeCache()
+        self.assertEqual(get_chromium_renderers(cache), [])
+        cost = cache.scan_cost
+        self.assertEqual(get_chromium_renderers(cache), [])
+        # only the stat file of each process is read again
+        self.assertEqual(cache.scan_cost - cost, len(self.mpl.procs))
+        self.mpl.procs[3000] = MockProcess(3000, CMD_CR_PASSWD, 'S',
+                                           None, 1000)
+        self.mpl.procs[4000] = MockProcess(4000, CMD_CR_RENDERER, 'S',
+                                           None, 3000)
+        self.assertEqual(get_chromium_renderers(cache), [(4000, 'S')])
+
+    def test_tree_without_children_files(self):
+        MockProcList.has_children = False
+        self.assertEqual(get_chromium_renderers(RendererTreeCache()),
+                         get_chromium_renderers())
+
+class ProcFixtureTest(unittest.TestCase):
+    """Run against a fake /proc tree on disk instead of the mocks."""
+
+    def setUp(self):
+        self.tree = FakeProcTree(1000, 50, hz=JIFFIES_PER_SECOND)
+        chrome_throttle.PROC_ROOT = self.tree.root
+
+    def tearDown(self):
+        chrome_throttle.PROC_ROOT = "/proc"
+        self.tree.cleanup()
+
+    def test_discovery(self):
+        expected = [(pid, 'S') for pid in self.tree.renderers()]
+        self.assertEqual(len(expected), 50)
+        self.assertEqual(get_chromium_renderers(), expected)
+        self.assertEqual(get_chromium_renderers(RendererCache()), expected)
+        self.assertEqual(get_chromium_renderers(RendererTreeCache()), expected)
+
+    def test_discovery_follows_changes(self):
+        cache = RendererTreeCache()
+        pids = self.tree.renderers()
+        get_chromium_renderers(cache)
+        self.tree.remove(pids[0])
+        new = self.tree.add("renderer", self.tree.zygote).pid
+        self.assertEqual([p for p, s in get_chromium_renderers(cache)],
+                         pids[1:] + [new])
+
+    def test_sampling(self):
+        pids = self.tree.renderers()
+        for clock in ("schedstat", "stat"):
+            sampler = CpuSampler(clock)
+            sampler.sample(pids)
+            self.tree.advance(1.0, busy=pids[:2])
+            deltas = sampler.sample(pids)
+            sampler.close()
+            self.assertEqual(len(deltas), 50)
+            busy = sorted(key[0] for key, seconds in deltas.items()
+                          if seconds > 0.5)
+            self.assertEqual(busy, pids[:2])
+        proc = self.tree.procs[pids[0]]
+        self.assertEqual(cpu_usage(pids[0]), proc.utime + proc.stime)
+
+    def test_memory(self):
+        pid = self.tree.renderers()[0]
+        self.assertEqual(memory_usage(pid),
+                         self.tree.procs[pid].rss_pages * PAGE_SIZE)
+        self.tree.advance(1.0)
+        self.assertEqual(memory_usage(pid),
+                         self.tree.procs[pid].rss_pages * PAGE_SIZE)
+
+class RendererMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = FakeProcTree(500, 20, hz=JIFFIES_PER_SECOND)
+        chrome_throttle.PROC_ROOT = self.tree.root
+        self.clock = FakeClock()
+        self.monitor = RendererMonitor(RendererTreeCache(), "stat",
+                                       self.clock)
+        self.pids = self.tree.renderers()
+
+    def tearDown(self):
+        self.monitor.close()
+        chrome_throttle.PROC_ROOT = "/proc"
+        self.tree.cleanup()
+
+    def sleep(self, seconds):
+        self.tree.advance(seconds, busy=self.pids[3:5])
+        self.clock.advance(seconds)
+
+    def test_snapshot(self):
+        snap = self.monitor.snapshot()
+        self.assertEqual(list(snap.pids), self.pids)
+        self.assertEqual(snap.pid_states(), [(pid, 'S') for pid in self.pids])
+        procs = [self.tree.procs[pid] for pid in self.pids]
+        self.assertEqual(list(snap.start_times),
+                         [proc.start_time for proc in procs])
+        self.assertEqual(list(snap.rss),
+                         [proc.rss_pages * PAGE_SIZE for proc in procs])
+        self.assertEqual(list(snap.cpu_ticks), [0] * 20)
+        self.assertEqual(self.clock.now, snap.time)
+
+    def test_delta_and_top(self):
+        prev = self.monitor.snapshot()
+        self.sleep(2.0)
+        cur = self.monitor.snapshot()
+        shares = self.monitor.delta(prev, cur)
+        self.assertEqual(len(shares), 20)
+        self.assertAlmostEqual(shares[3], 1.0, 1)
+        self.assertTrue(all(share < 0.2 for share in shares[5:]))
+        top = RendererMonitor.top(cur, shares, 1)
+        self.assertEqual(len(top), 1)
+        self.assertIn(top[0][1], self.pids[3:5])
+        self.assertEqual(sorted(p for s, p in
+                                RendererMonitor.top(cur, shares,
+                                                    threshold=0.5)),
+                         self.pids[3:5])
+
+    def test_delta_changed_renderers(self):
+        prev = self.monitor.snapshot()
+        self.tree.remove(self.pids[0])
+        new = self.tree.add("renderer", self.tree.zygote).pid
+        self.sleep(1.0)
+        cur = self.monitor.snapshot()
+        self.assertEqual(list(cur.pids), self.pids[1:] + [new])
+        shares = self.monitor.delta(prev, cur)
+        self.assertNotEqual(shares[-1], shares[-1])     # NaN
+        self.assertNotIn(new, [p for s, p in RendererMonitor.top(cur, shares)])
+        self.assertNotIn(self.pids[0], self.monitor.sampler.files)
+
+    def test_find_cpu_piggies(self):
+        piggies = self.monitor.find_cpu_piggies(1.0, 0.5, samples=4,
+                                                sleep=self.sleep)
+        self.assertEqual(sorted(p for s, p in piggies), self.pids[3:5])
+        for share, pid in piggies:
+            self.assertAlmostEqual(share, 1.0, 1)
+
+    def test_find_cpu_piggies_new_renderer(self):
+        new = []
+        def sleep(seconds):
+            if not new:
+                new.append(self.tree.add("renderer", self.tree.zygote).pid)
+            self.tree.advance(seconds, busy=new)
+            self.clock.advance(seconds)
+        piggies = self.monitor.find_cpu_piggies(1.0, 0.5, samples=4,
+                                                sleep=sleep)
+        self.assertEqual([p for s, p in piggies], new)
+        # its start_time is known, so that it can be pinned
+        last = self.monitor.last
+        self.assertEqual(dict(zip(last.pids, last.start_times))[new[0]],
+                         self.tree.procs[new[0]].start_time)
+
+    def test_snapshot_reads_stat_once(self):
+        self.monitor.snapshot()      # finds the browser with a full sweep
+        reads = []
+        real_split = chrome_throttle.split_proc_stat
+        def split_proc_stat(line):
+            reads.append(int(line.split()[0]))
+            return real_split(line)
+        chrome_throttle.split_proc_stat = split_proc_stat
+        try:
+            self.tree.advance(1.0, busy=self.pids[3:5])
+            self.monitor.snapshot()
+        finally:
+            chrome_throttle.split_proc_stat = real_split
+        self.assertEqual([reads.count(pid) for pid in self.pids], [1] * 20)
+
 if __name__ == '__main__':
     unittest.main()
 